@@ -0,0 +1,114 @@
+"""compares compiled fields setter with assignment through descriptors,
+prints memory of containers allocated per request by slots backed request objects
+and by __dict__ backed ones, which is how request objects were stored before
+
+python benchmarks/bench_request_object.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import mock  # noqa: E402
+
+from request_object import (  # noqa: E402
+    RequestObject,
+    MethodRequest,
+    OnlineScoreRequest,
+    ClientsInterestsRequest,
+)
+
+CASES = [
+    (MethodRequest, {
+        'account': 'horns&hoofs', 'login': 'h&f', 'method': 'online_score', 'token': 'token',
+        'arguments': {'phone': '79175002040', 'email': 'stupnikov@otus.ru'},
+    }),
+    (OnlineScoreRequest, {
+        'phone': '79175002040', 'email': 'stupnikov@otus.ru', 'gender': 1, 'birthday': '01.01.2000',
+        'first_name': 'a', 'last_name': 'b',
+    }),
+    (ClientsInterestsRequest, {'client_ids': [1, 2, 3, 4], 'date': '20.07.2017'}),
+]
+NUMBER = 20000
+
+
+def ops_per_sec(cls, data):
+    seconds = min(timeit.repeat(lambda: cls(data), number=NUMBER, repeat=3))
+    return NUMBER / seconds
+
+
+def dict_backed(cls):
+    """__dict__ backed version of request class, for comparison
+
+    values are validated by `cls` and set into __dict__ one by one after errors list,
+    asdict and initialized_fields build new containers on every call
+    """
+    names = cls._field_names
+
+    class DictRequest(object):
+        def __init__(self, data):
+            self._errors = []
+            request = cls(data)
+            self._errors.extend(request.get_validation_errors())
+            for name in names:
+                self.__dict__[name] = getattr(request, name)
+
+        def get_validation_errors(self):
+            return self._errors
+
+        def asdict(self):
+            data = {}
+            for name in names:
+                data[name] = self.__dict__[name]
+            return data
+
+    if hasattr(cls, 'initialized_fields'):
+        DictRequest.initialized_fields = property(
+            lambda self: [name for name in names if self.__dict__[name] is not None])
+    DictRequest.__name__ = cls.__name__
+    return DictRequest
+
+
+def request_bytes(cls, data):
+    """sys.getsizeof of request object, its __dict__ and errors, asdict and initialized_fields results
+
+    containers shared by requests, like errors of valid request, are not counted.
+    field values are the same in any representation and are not counted too
+    """
+    obj, other = cls(data), cls(data)
+    sizes = {'object': sys.getsizeof(obj)}
+    if hasattr(obj, '__dict__'):
+        sizes['object'] += sys.getsizeof(obj.__dict__)
+    if obj._errors is not other._errors:
+        sizes['errors'] = sys.getsizeof(obj._errors)
+    sizes['asdict'] = sys.getsizeof(obj.asdict())
+    if hasattr(cls, 'initialized_fields') and obj.initialized_fields is not other.initialized_fields:
+        sizes['initialized_fields'] = sys.getsizeof(obj.initialized_fields)
+    return sizes
+
+
+def main():
+    print '{:<25} {:>14} {:>14} {:>8}'.format('class', 'compiled op/s', 'descr op/s', 'speedup')
+    for cls, data in CASES:
+        compiled = ops_per_sec(cls, data)
+        with mock.patch.object(cls, '_set_fields', RequestObject.__dict__['_set_fields_with_descriptors']):
+            descriptors = ops_per_sec(cls, data)
+        print '{:<25} {:>14.0f} {:>14.0f} {:>7.2f}x'.format(cls.__name__, compiled, descriptors, compiled / descriptors)
+
+    print
+    row = '{:<25} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'
+    print row.format('class', 'values', 'object', 'errors', 'asdict', 'fields', 'bytes', 'saved')
+    for cls, data in CASES:
+        baseline = None
+        for values, request_cls in (('dict', dict_backed(cls)), ('slots', cls)):
+            sizes = request_bytes(request_cls, data)
+            total = sum(sizes.values())
+            saved = '{:.0%}'.format(1 - float(total) / baseline) if baseline else ''
+            print row.format(cls.__name__, values, sizes['object'], sizes.get('errors', 0), sizes['asdict'],
+                             sizes.get('initialized_fields', 0), total, saved)
+            baseline = total
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""compares two results files written by benchmarks/run.py
+
+python benchmarks/compare.py base.json new.json [-t 0.1]
+
+exits with code 1 if any benchmark got slower by more than the threshold
+"""
+import sys
+import json
+from optparse import OptionParser
+
+DEFAULT_THRESHOLD = 0.1
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(base, new, threshold):
+    """(name, base ops/sec, new ops/sec, change, regressed) for benchmarks present in both runs"""
+    rows = []
+    for name in sorted(set(base['results']) & set(new['results'])):
+        base_ops = base['results'][name]['ops_per_sec']
+        new_ops = new['results'][name]['ops_per_sec']
+        change = new_ops / base_ops - 1
+        rows.append((name, base_ops, new_ops, change, change < -threshold))
+    return rows
+
+
+def main():
+    op = OptionParser(usage='%prog [options] base.json new.json')
+    op.add_option('-t', '--threshold', action='store', type=float, default=DEFAULT_THRESHOLD,
+                  help='relative ops/sec drop reported as regression')
+    (opts, args) = op.parse_args()
+    if len(args) != 2:
+        op.error('two results files are required')
+
+    base, new = load(args[0]), load(args[1])
+    print 'base: {}, new: {}'.format(base.get('revision'), new.get('revision'))
+    print '{:<45} {:>12} {:>12} {:>8}'.format('benchmark', 'base ops/s', 'new ops/s', 'change')
+
+    regressions = 0
+    for name, base_ops, new_ops, change, regressed in compare(base, new, opts.threshold):
+        regressions += regressed
+        print '{:<45} {:>12.0f} {:>12.0f} {:>+7.1f}%{}'.format(
+            name, base_ops, new_ops, change * 100, '  REGRESSION' if regressed else '')
+
+    if regressions:
+        print '{} regression(s) above {:.0f}%'.format(regressions, opts.threshold * 100)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
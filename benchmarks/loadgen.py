@@ -0,0 +1,286 @@
+"""load generator replaying request samples against a running server
+
+python benchmarks/loadgen.py request_samples/score.json request_samples/interests.json \
+    [-u http://localhost:8080/method/] [-c 16] [-r 1000] [-d 10] [-P 2] [-o results.json]
+
+every .json file is the body of one request, .jsonl file holds one body per line.
+bodies are sent round robin by `concurrency` threads in each of `processes` processes.
+without --rate every thread sends the next request as soon as it gets a response,
+with --rate requests are scheduled at fixed intervals and latency is counted from
+the scheduled time, so a stalled server doesn't hide its queueing delay
+"""
+import sys
+import json
+import time
+import socket
+import httplib
+import urlparse
+import itertools
+import threading
+import multiprocessing
+from optparse import OptionParser
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+class Histogram(object):
+    """log-linear latency histogram in microseconds, hdr style
+
+    values are rounded down to SIGNIFICANT_BITS most significant bits,
+    so relative error is below 1% in the whole range
+    """
+    SIGNIFICANT_BITS = 8
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def _bucket(self, value):
+        shift = max(value.bit_length() - self.SIGNIFICANT_BITS, 0)
+        return value >> shift << shift
+
+    def record(self, seconds):
+        value = int(seconds * 10 ** 6)
+        bucket = self._bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for bucket, count in other.counts.iteritems():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        rank = max(int(round(p / 100.0 * self.count)), 1)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return bucket
+        return self.max
+
+    def mean(self):
+        return self.total / float(self.count) if self.count else 0
+
+    def to_dict(self):
+        return {'counts': self.counts, 'count': self.count, 'total': self.total, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, d):
+        hist = cls()
+        # json turns int keys into strings
+        hist.counts = {int(bucket): count for bucket, count in d['counts'].iteritems()}
+        hist.count, hist.total, hist.max = d['count'], d['total'], d['max']
+        return hist
+
+
+def load_bodies(paths):
+    bodies = []
+    for path in paths:
+        with open(path) as f:
+            if path.endswith('.jsonl'):
+                bodies.extend(json.loads(line) for line in f if line.strip())
+            else:
+                bodies.append(json.load(f))
+    return [json.dumps(body) for body in bodies]
+
+
+class Worker(threading.Thread):
+    def __init__(self, url, bodies, schedule, keep_alive, timeout):
+        super(Worker, self).__init__()
+        self.daemon = True
+        self.url = url
+        self.bodies = bodies
+        self.schedule = schedule
+        self.headers = {
+            'Content-Type': 'application/json',
+            'Connection': 'keep-alive' if keep_alive else 'close',
+        }
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        # per thread results, merged when the run is finished
+        self.histogram = Histogram()
+        self.codes = {}
+        self.connects = 0
+
+    def run(self):
+        conn = None
+        for i, scheduled_at in self.schedule:
+            delay = scheduled_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            started = scheduled_at if self.schedule.rate else time.time()
+
+            if conn is None:
+                conn = httplib.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=self.timeout)
+                self.connects += 1
+            try:
+                conn.request('POST', self.url.path, self.bodies[i % len(self.bodies)], self.headers)
+                response = conn.getresponse()
+                response.read()
+                code = response.status
+                if response.will_close or not self.keep_alive:
+                    conn.close()
+                    conn = None
+            except (socket.error, httplib.HTTPException) as e:
+                code = type(e).__name__
+                conn.close()
+                conn = None
+
+            self.histogram.record(time.time() - started)
+            self.codes[code] = self.codes.get(code, 0) + 1
+
+        if conn is not None:
+            conn.close()
+
+
+class Schedule(object):
+    """thread-safe iterator of (request number, time to send) pairs"""
+
+    def __init__(self, rate=None, duration=None, requests=None):
+        self.rate = rate
+        self.started = time.time()
+        self.deadline = self.started + duration if duration else None
+        self.requests = requests
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        with self._lock:
+            i = next(self._counter)
+        if self.requests is not None and i >= self.requests:
+            raise StopIteration
+        scheduled_at = self.started + i / self.rate if self.rate else time.time()
+        if self.deadline is not None and scheduled_at >= self.deadline:
+            raise StopIteration
+        return i, scheduled_at
+
+
+def run(url, bodies, concurrency, rate=None, duration=None, requests=None, keep_alive=True, timeout=10):
+    """runs load in the current process, results are json serializable"""
+    schedule = Schedule(rate, duration, requests)
+    workers = [Worker(url, bodies, schedule, keep_alive, timeout) for _ in range(concurrency)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - schedule.started
+
+    histogram = Histogram()
+    codes = {}
+    for w in workers:
+        histogram.merge(w.histogram)
+        for code, count in w.codes.iteritems():
+            codes[code] = codes.get(code, 0) + count
+    return {
+        'elapsed': elapsed,
+        'connects': sum(w.connects for w in workers),
+        'codes': codes,
+        'histogram': histogram.to_dict(),
+    }
+
+
+def _run_process(kwargs):
+    kwargs['url'] = urlparse.urlparse(kwargs['url'])
+    return run(**kwargs)
+
+
+def report(results, out=sys.stdout):
+    histogram = Histogram()
+    codes = {}
+    for r in results:
+        histogram.merge(Histogram.from_dict(r['histogram']))
+        for code, count in r['codes'].iteritems():
+            codes[code] = codes.get(code, 0) + count
+    elapsed = max(r['elapsed'] for r in results)
+
+    summary = {
+        'requests': histogram.count,
+        'elapsed_sec': elapsed,
+        'requests_per_sec': histogram.count / elapsed if elapsed else 0,
+        'connects': sum(r['connects'] for r in results),
+        'codes': codes,
+        'latency_ms': dict(
+            [('p%s' % p, histogram.percentile(p) / 1000.0) for p in PERCENTILES] +
+            [('mean', histogram.mean() / 1000.0), ('max', histogram.max / 1000.0)]
+        ),
+    }
+
+    print >> out, 'requests: {requests}, elapsed: {elapsed_sec:.2f} s, throughput: {requests_per_sec:.1f} req/s, ' \
+                  'connects: {connects}'.format(**summary)
+    print >> out, 'codes: ' + ', '.join('{}: {}'.format(code, count) for code, count in sorted(codes.items()))
+    print >> out, 'latency, ms:'
+    for p in PERCENTILES:
+        print >> out, '  p{:<6} {:>10.3f}'.format(p, summary['latency_ms']['p%s' % p])
+    print >> out, '  {:<7} {:>10.3f}'.format('mean', summary['latency_ms']['mean'])
+    print >> out, '  {:<7} {:>10.3f}'.format('max', summary['latency_ms']['max'])
+    return summary, histogram
+
+
+def main():
+    op = OptionParser(usage='%prog [options] sample.json|samples.jsonl ...')
+    op.add_option('-u', '--url', action='store', default='http://localhost:8080/method/')
+    op.add_option('-c', '--concurrency', action='store', type=int, default=16,
+                  help='threads per process, max requests in flight with --rate')
+    op.add_option('-r', '--rate', action='store', type=float, default=None,
+                  help='total requests per second, closed loop if not set')
+    op.add_option('-d', '--duration', action='store', type=float, default=10, help='seconds to run')
+    op.add_option('-n', '--requests', action='store', type=int, default=None,
+                  help='total requests to send, overrides duration')
+    op.add_option('-P', '--processes', action='store', type=int, default=1,
+                  help='client processes, one python process may be a bottleneck itself')
+    op.add_option('--no-keep-alive', action='store_false', dest='keep_alive', default=True)
+    op.add_option('--timeout', action='store', type=float, default=10, help='socket timeout in seconds')
+    op.add_option('--histogram', action='store_true', default=False, help='print full latency distribution')
+    op.add_option('-o', '--output', action='store', default=None, help='write json summary to the file')
+    (opts, args) = op.parse_args()
+    if not args:
+        op.error('at least one samples file is required')
+
+    bodies = load_bodies(args)
+    processes = opts.processes
+    kwargs = [{
+        'url': opts.url,
+        'bodies': bodies,
+        'concurrency': opts.concurrency,
+        'rate': opts.rate / processes if opts.rate else None,
+        'duration': None if opts.requests else opts.duration,
+        # remainder goes to the first process
+        'requests': opts.requests // processes + (i == 0) * (opts.requests % processes) if opts.requests else None,
+        'keep_alive': opts.keep_alive,
+        'timeout': opts.timeout,
+    } for i in range(processes)]
+
+    if processes == 1:
+        results = [_run_process(kwargs[0])]
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.map(_run_process, kwargs)
+        pool.close()
+
+    summary, histogram = report(results)
+    if opts.histogram:
+        print 'distribution, ms:'
+        seen = 0
+        for bucket in sorted(histogram.counts):
+            seen += histogram.counts[bucket]
+            print '  {:>10.3f} {:>8} {:>8.3f}%'.format(bucket / 1000.0, histogram.counts[bucket],
+                                                       seen * 100.0 / histogram.count)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""microbenchmarks of request hot paths
+
+python benchmarks/run.py [-o results.json] [-f filter] [-d seconds]
+
+every benchmark is run for a fixed time, results are ops/sec and
+latency percentiles of single calls in microseconds
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import datetime
+import platform
+import subprocess
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import api  # noqa: E402
+import interests_format  # noqa: E402
+import scoring  # noqa: E402
+from backends import MemoryBackend  # noqa: E402
+from request_object import MethodRequest, OnlineScoreRequest, ClientsInterestsRequest  # noqa: E402
+from storage import Storage  # noqa: E402
+
+PERCENTILES = [50, 90, 99, 99.9]
+WARMUP_SEC = 0.2
+
+
+def memory_store(data=None):
+    return Storage(backend=MemoryBackend(data))
+
+
+def make_token(account, login):
+    if login == api.ADMIN_LOGIN:
+        return hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+    return hashlib.sha512(account + login + api.SALT).hexdigest()
+
+
+def method_request(method, arguments, login='h&f'):
+    account = 'horns&hoofs'
+    return {'account': account, 'login': login, 'method': method,
+            'token': make_token(account, login), 'arguments': arguments}
+
+
+SCORE_ARGUMENTS = {
+    'phone': '79175002040', 'email': 'stupnikov@otus.ru', 'gender': 1, 'birthday': '01.01.2000',
+    'first_name': 'a', 'last_name': 'b',
+}
+INTERESTS_ARGUMENTS = {'client_ids': range(20), 'date': '20.07.2017'}
+INTERESTS = json.dumps(['cars', 'pets', 'travel', 'books'])
+
+
+def store_with_interests(n=1000):
+    return memory_store({'i:%s' % cid: INTERESTS for cid in range(n)})
+
+
+def bench_method_request():
+    data = method_request('online_score', SCORE_ARGUMENTS)
+    return lambda: MethodRequest(data)
+
+
+def bench_online_score_request():
+    return lambda: OnlineScoreRequest(SCORE_ARGUMENTS)
+
+
+def bench_clients_interests_request():
+    return lambda: ClientsInterestsRequest(INTERESTS_ARGUMENTS)
+
+
+def bench_check_auth():
+    req_obj = MethodRequest(method_request('online_score', SCORE_ARGUMENTS))
+    return lambda: api.check_auth(req_obj)
+
+
+def bench_check_auth_admin():
+    req_obj = MethodRequest(method_request('online_score', SCORE_ARGUMENTS, login=api.ADMIN_LOGIN))
+    return lambda: api.check_auth(req_obj)
+
+
+def bench_get_score_cached():
+    store = memory_store()
+    kwargs = OnlineScoreRequest(SCORE_ARGUMENTS).asdict()
+    scoring.get_score(store, **kwargs)
+    return lambda: scoring.get_score(store, **kwargs)
+
+
+def bench_get_score_uncached():
+    store = memory_store()
+    kwargs = OnlineScoreRequest(SCORE_ARGUMENTS).asdict()
+
+    def run():
+        store.backend._data.clear()
+        scoring.get_score(store, **kwargs)
+    return run
+
+
+def bench_get_interests():
+    store = store_with_interests()
+    return lambda: scoring.get_interests(store, 1)
+
+
+def bench_get_interests_many():
+    store = store_with_interests()
+    cids = INTERESTS_ARGUMENTS['client_ids']
+    return lambda: scoring.get_interests_many(store, cids)
+
+
+def bench_get_interests_many_compact():
+    store = memory_store()
+    scoring.interests_dictionary = interests_format.InterestsDictionary(store)
+    raw = interests_format.encode(json.loads(INTERESTS), interests_format.COMPACT_FORMAT, scoring.interests_dictionary)
+    store.backend.set_many([('i:%s' % cid, raw, None) for cid in range(1000)])
+    cids = INTERESTS_ARGUMENTS['client_ids']
+    return lambda: scoring.get_interests_many(store, cids)
+
+
+def _bench_method_handler(body, store):
+    def run():
+        api.method_handler({'body': body, 'headers': {}}, {}, store)
+    return run
+
+
+def bench_method_handler_online_score():
+    return _bench_method_handler(method_request('online_score', SCORE_ARGUMENTS), memory_store())
+
+
+def bench_method_handler_online_score_admin():
+    return _bench_method_handler(
+        method_request('online_score', SCORE_ARGUMENTS, login=api.ADMIN_LOGIN), memory_store())
+
+
+def bench_method_handler_clients_interests():
+    return _bench_method_handler(method_request('clients_interests', INTERESTS_ARGUMENTS), store_with_interests())
+
+
+def bench_method_handler_invalid():
+    return _bench_method_handler(method_request('online_score', {}), memory_store())
+
+
+BENCHMARKS = [
+    ('request_object.MethodRequest', bench_method_request),
+    ('request_object.OnlineScoreRequest', bench_online_score_request),
+    ('request_object.ClientsInterestsRequest', bench_clients_interests_request),
+    ('api.check_auth', bench_check_auth),
+    ('api.check_auth.admin', bench_check_auth_admin),
+    ('scoring.get_score.cached', bench_get_score_cached),
+    ('scoring.get_score.uncached', bench_get_score_uncached),
+    ('scoring.get_interests', bench_get_interests),
+    ('scoring.get_interests_many.20', bench_get_interests_many),
+    ('scoring.get_interests_many.20.compact', bench_get_interests_many_compact),
+    ('api.method_handler.online_score', bench_method_handler_online_score),
+    ('api.method_handler.online_score.admin', bench_method_handler_online_score_admin),
+    ('api.method_handler.clients_interests.20', bench_method_handler_clients_interests),
+    ('api.method_handler.invalid', bench_method_handler_invalid),
+]
+
+
+def percentile(sorted_values, p):
+    index = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(func, duration):
+    timer = time.time
+    deadline = timer() + WARMUP_SEC
+    while timer() < deadline:
+        func()
+
+    latencies = []
+    started = timer()
+    deadline = started + duration
+    now = started
+    while now < deadline:
+        func()
+        prev, now = now, timer()
+        latencies.append(now - prev)
+    total = now - started
+
+    latencies.sort()
+    result = {
+        'ops': len(latencies),
+        'ops_per_sec': len(latencies) / total,
+    }
+    for p in PERCENTILES:
+        result['p%s_us' % p] = percentile(latencies, p) * 10 ** 6
+    return result
+
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    op = OptionParser(usage='%prog [options]')
+    op.add_option('-o', '--output', action='store', default=None, help='write json results to the file')
+    op.add_option('-f', '--filter', action='store', default='', help='run benchmarks containing the substring')
+    op.add_option('-d', '--duration', action='store', type=float, default=1, help='seconds per benchmark')
+    (opts, args) = op.parse_args()
+
+    results = {}
+    print '{:<45} {:>12} {:>9} {:>9} {:>9}'.format('benchmark', 'ops/sec', 'p50 us', 'p99 us', 'p99.9 us')
+    for name, setup in BENCHMARKS:
+        if opts.filter not in name:
+            continue
+        result = results[name] = measure(setup(), opts.duration)
+        print '{:<45} {:>12.0f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            name, result['ops_per_sec'], result['p50_us'], result['p99_us'], result['p99.9_us'])
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump({
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'timestamp': time.time(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,31 @@
 # -*- coding: utf-8 -*-
 
 import json
+import time
 import datetime
 import logging
 import hashlib
+import io
 import uuid
+import urlparse
 from optparse import OptionParser
-from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from BaseHTTPServer import BaseHTTPRequestHandler
 
+from redis.exceptions import ConnectionError
+
+import interests_format
+import metrics
+import profiler
+import request_log
 import request_object
 import scoring
-from storage import Storage
+import serializers
+import server
+from backends import BALANCERS, LEAST_OUTSTANDING, MemoryBackend
+from cache import LRUCache
+from event_server import MAX_BODY_SIZE
+from snapshot import SnapshotBackend
+from storage import Storage, PrefetchStorage, CircuitBreaker, deadline, parse_nodes
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -33,44 +48,92 @@ ERRORS = {
 
 ONLINE_SCORE_METHOD = 'online_score'
 CLIENTS_INTERESTS_METHOD = 'clients_interests'
+MAX_BATCH_SIZE = 1000
+# max number of cached verified credentials
+AUTH_CACHE_SIZE = 100000
+# time budget of request in milliseconds, shared by all storage calls
+DEADLINE_HEADER = 'X-Request-Deadline'
+# request body buffers up to this size are kept for the next request of the connection
+MAX_REUSED_BUFFER_SIZE = 1024 * 1024
+
+REQUESTS = metrics.Counter('api_requests_total', 'requests by path, method and response code',
+                           ['path', 'method', 'code'])
+REQUEST_SECONDS = metrics.Histogram('api_request_duration_seconds', 'request processing time', ['path'])
+STAGE_SECONDS = metrics.Histogram('api_stage_duration_seconds', 'request processing time by stage', ['stage'])
 
 
 def is_admin(request_obj):
     return request_obj.login == ADMIN_LOGIN
 
 
+class AdminDigest(object):
+    """admin token of the current hour, computed once per hour"""
+
+    def __init__(self):
+        self._digest = None
+        self._expires_at = 0
+
+    def __call__(self):
+        if time.time() >= self._expires_at:
+            hour = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+            self._digest = hashlib.sha512(hour.strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
+            self._expires_at = time.mktime((hour + datetime.timedelta(hours=1)).timetuple())
+        return self._digest
+
+
+admin_digest = AdminDigest()
+# (account, login, token) triples with correct token
+verified_credentials = set()
+
+
 def check_auth(request):
     if is_admin(request):
-        digest = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
-    else:
-        digest = hashlib.sha512(
-            (request.account or '') +
-            (request.login or '') +
-            SALT
-        ).hexdigest()
+        return admin_digest() == request.token
+
+    credentials = (request.account, request.login, request.token)
+    if credentials in verified_credentials:
+        return True
+
+    digest = hashlib.sha512(
+        (request.account or '') +
+        (request.login or '') +
+        SALT
+    ).hexdigest()
 
     # for debug only
     logging.debug('correct digest: %s', digest)
 
-    return digest == request.token
+    if digest != request.token:
+        return False
+
+    if len(verified_credentials) >= AUTH_CACHE_SIZE:
+        # evict arbitrary entry
+        verified_credentials.pop()
+    verified_credentials.add(credentials)
+    return True
 
 
 def method_handler(request, ctx, store):
     if not isinstance(request, dict) or 'body' not in request:
         raise RuntimeError('wrong request structure')
 
+    timings = ctx.setdefault('timings', metrics.StageTimer())
     req_obj = request_object.MethodRequest(request['body'])
     errors = req_obj.get_validation_errors()
+    timings.mark('validate')
     if errors:
         return errors, INVALID_REQUEST
 
-    if not check_auth(req_obj):
+    authorized = check_auth(req_obj)
+    timings.mark('auth')
+    if not authorized:
         return ERRORS[FORBIDDEN], FORBIDDEN
 
     if req_obj.method == ONLINE_SCORE_METHOD:
         online_score_obj = request_object.OnlineScoreRequest(req_obj.arguments)
 
         errors = online_score_obj.get_validation_errors()
+        timings.mark('validate')
         if errors:
             return errors, INVALID_REQUEST
 
@@ -79,20 +142,26 @@ def method_handler(request, ctx, store):
         if is_admin(req_obj):
             score = ADMIN_SCORE
         else:
-            score = scoring.get_score(Storage(), **online_score_obj.asdict())
+            score = scoring.get_score(store, **online_score_obj.asdict())
+            timings.mark('storage')
         return {'score': score}, OK
 
     elif req_obj.method == CLIENTS_INTERESTS_METHOD:
         client_interests_obj = request_object.ClientsInterestsRequest(req_obj.arguments)
         errors = client_interests_obj.get_validation_errors()
+        timings.mark('validate')
         if errors:
             return errors, INVALID_REQUEST
 
         ctx['nclients'] = client_interests_obj.nclients
-        interests = {
-            client_id: scoring.get_interests(Storage(), client_id)
-            for client_id in client_interests_obj.client_ids
-        }
+        stream_min_clients = ctx.get('stream_min_clients')
+        if stream_min_clients and client_interests_obj.nclients >= stream_min_clients:
+            # the rest of chunks is fetched while the response is written
+            interests = scoring.stream_interests(store, client_interests_obj.client_ids, timings=timings)
+            return interests, OK
+
+        interests = scoring.get_interests_many(store, client_interests_obj.client_ids)
+        timings.mark('storage')
         return interests, OK
     else:
         err = 'unsupported method, use one of {}'.format(
@@ -101,65 +170,459 @@ def method_handler(request, ctx, store):
         return err, INVALID_REQUEST
 
 
+def build_response(response, code):
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+
+
+def _run_batch(items, headers, contexts, store):
+    results = []
+    for item, item_ctx in zip(items, contexts):
+        # stages of the last run are kept
+        item_ctx['timings'] = metrics.StageTimer()
+        try:
+            response, code = method_handler({"body": item, "headers": headers}, item_ctx, store)
+        except Exception, e:
+            logging.exception("Unexpected error in batch item: %s" % e)
+            response, code = {}, INTERNAL_ERROR
+        results.append(build_response(response, code))
+    return results
+
+
+def batch_handler(request, ctx, store):
+    """runs list of method requests
+
+    items are run twice against PrefetchStorage: the first run collects keys
+    of all the items, which are fetched in one go before the second run
+    """
+    if not isinstance(request, dict) or 'body' not in request:
+        raise RuntimeError('wrong request structure')
+
+    items = request['body']
+    if not isinstance(items, list):
+        return 'batch must be a list of method requests', INVALID_REQUEST
+    if len(items) > MAX_BATCH_SIZE:
+        return 'batch size must not exceed {}'.format(MAX_BATCH_SIZE), INVALID_REQUEST
+
+    timings = ctx.setdefault('timings', metrics.StageTimer())
+    contexts = [{} for _ in items]
+    prefetch = PrefetchStorage(store.l1_cache)
+    _run_batch(items, request['headers'], contexts, prefetch)
+    timings.mark('handler')
+
+    keys = list(prefetch.missing)
+    if keys:
+        try:
+            prefetch.values.update(zip(keys, store.get_many(keys)))
+        except ConnectionError:
+            logging.exception("failed to fetch batch keys")
+            prefetch.failed.update(keys)
+        timings.mark('storage')
+
+    prefetch.reset()
+    results = _run_batch(items, request['headers'], contexts, prefetch)
+    timings.mark('handler')
+    if prefetch.writes:
+        store.cache_set_many(prefetch.writes)
+        timings.mark('storage')
+
+    ctx['nitems'] = len(items)
+    ctx['items'] = contexts
+    return results, OK
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
-        "method": method_handler
+        "method": method_handler,
+        "batch": batch_handler,
     }
+    protocol_version = "HTTP/1.1"
+    # persistent connections, idle ones are closed after `timeout` seconds
+    keep_alive = True
+    timeout = 15
+    max_keep_alive_requests = 1000
+    # buffered writes, headers and body are sent together on flush
+    wbufsize = -1
+    rbufsize = 64 * 1024
+    disable_nagle_algorithm = True
     store = None
+    # default request time budget in seconds, if not set by DEADLINE_HEADER
+    request_timeout = None
+    # optional profiler.Profiler of POST requests
+    profiler = None
+    # clients_interests responses for at least this number of clients are streamed
+    # with chunked transfer encoding to HTTP/1.1 clients, 0 disables streaming
+    stream_min_clients = 1000
+    request_log = request_log.RequestLog()
 
-    def get_request_id(self, headers):
+    @staticmethod
+    def get_request_id(headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
+    @staticmethod
+    def get_codecs(headers):
+        """codecs of request body by Content-Type and of response by Accept header"""
+        request_codec = serializers.request_codec(headers.get("Content-Type"))
+        return request_codec, serializers.response_codec(headers.get("Accept"), request_codec)
+
+    @classmethod
+    def get_request_timeout(cls, headers):
+        value = headers.get(DEADLINE_HEADER)
+        if value is None:
+            return cls.request_timeout
+        try:
+            return max(float(value), 0) / 1000
+        except ValueError:
+            logging.warning("wrong %s header value: %s" % (DEADLINE_HEADER, value))
+            return cls.request_timeout
+
+    @classmethod
+    def route(cls, path, request, headers, context, store):
+        """call handler for the path, returns response and code"""
+        path = path.strip("/")
+        if path not in cls.router:
+            return {}, NOT_FOUND
+
+        try:
+            with deadline(cls.get_request_timeout(headers)):
+                return cls.router[path]({"body": request, "headers": headers}, context, store)
+        except Exception, e:
+            logging.exception("Unexpected error: %s" % e)
+            return {}, INTERNAL_ERROR
+
+    build_response = staticmethod(build_response)
+
+    @classmethod
+    def record_request(cls, path, request, code, timings):
+        """update request metrics, labels are limited to known values"""
+        path = path.strip("/")
+        if path not in cls.router:
+            path = "other"
+        method = ""
+        if path == "method" and isinstance(request, dict):
+            method = request.get("method")
+            if method not in (ONLINE_SCORE_METHOD, CLIENTS_INTERESTS_METHOD):
+                method = "other"
+
+        REQUESTS.inc((path, method, code))
+        REQUEST_SECONDS.observe(sum(timings.itervalues()), (path,))
+        for stage, seconds in timings.iteritems():
+            STAGE_SECONDS.observe(seconds, (stage,))
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # buffered reader which can read body into reusable buffer
+        self.rfile.close()
+        self.rfile = io.BufferedReader(server.SocketReader(self.connection), self.rbufsize)
+        self.body_buffer = bytearray()
+        self.requests_served = 0
+
+    def read_body(self, length):
+        """memoryview of request body read into the connection buffer"""
+        if not 0 <= length <= MAX_BODY_SIZE:
+            raise ValueError("wrong body length: {}".format(length))
+        if length > len(self.body_buffer):
+            buf = bytearray(length)
+            if length <= MAX_REUSED_BUFFER_SIZE:
+                self.body_buffer = buf
+        else:
+            buf = self.body_buffer
+
+        view = memoryview(buf)[:length]
+        read = 0
+        while read < length:
+            n = self.rfile.readinto(view[read:])
+            if not n:
+                raise IOError("connection closed after {} of {} body bytes".format(read, length))
+            read += n
+        return view
+
+    def log_request(self, code="-", size="-"):
+        """no access line, requests are logged by request_log"""
+
+    def log_message(self, format, *args):
+        # messages of BaseHTTPRequestHandler go through logging instead of blocking writes to stderr
+        logging.info("%s %s", self.client_address[0], format % args)
+
+    def send_connection_header(self):
+        self.requests_served += 1
+        if not self.keep_alive or self.requests_served >= self.max_keep_alive_requests:
+            self.close_connection = 1
+        self.send_header("Connection", "close" if self.close_connection else "keep-alive")
+
+    @classmethod
+    def start_profile(cls, query):
+        if cls.profiler is None:
+            return "profiler is not configured", BAD_REQUEST
+        try:
+            seconds = float(query.get("seconds", ["10"])[0])
+        except ValueError:
+            return "seconds must be a number", BAD_REQUEST
+        if not 0 < seconds <= profiler.MAX_WINDOW_SEC:
+            return "seconds must be in (0, {}]".format(profiler.MAX_WINDOW_SEC), BAD_REQUEST
+        if not cls.profiler.start_window(seconds):
+            return "profiling is already running", BAD_REQUEST
+        return {"seconds": seconds, "directory": cls.profiler.directory}, OK
+
+    @classmethod
+    def handle_get(cls, path):
+        """returns code, content type and body of GET request"""
+        url = urlparse.urlparse(path)
+        path = url.path.strip("/")
+        if path == "metrics":
+            return OK, metrics.CONTENT_TYPE, metrics.REGISTRY.render()
+
+        if path == "debug/profile":
+            response, code = cls.start_profile(urlparse.parse_qs(url.query))
+        else:
+            response, code = {}, NOT_FOUND
+        return code, "application/json", json.dumps(cls.build_response(response, code))
+
+    def do_GET(self):
+        code, content_type, data = self.handle_get(self.path)
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_connection_header()
+        self.end_headers()
+        self.wfile.write(data)
+
     def do_POST(self):
+        if self.profiler is not None:
+            return self.profiler.call(self.handle_post)
+        return self.handle_post()
+
+    def handle_post(self):
+        timings = metrics.StageTimer()
         response, code = {}, OK
-        context = {"request_id": self.get_request_id(self.headers)}
-        request = None
+        context = {"request_id": self.get_request_id(self.headers), "timings": timings}
+        request = data_string = None
+        request_codec, response_codec = self.get_codecs(self.headers)
         try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
+            body = self.read_body(int(self.headers['Content-Length']))
         except Exception:
+            # body boundary is unknown, the connection can't be reused
+            self.close_connection = 1
             code = BAD_REQUEST
+        else:
+            timings.mark("read")
+            # json decoders take str only, so the reused buffer saves a copy for msgpack bodies only
+            data_string = body if request_codec.binary else body.tobytes()
+            try:
+                request = request_codec.loads(data_string)
+            except Exception:
+                code = BAD_REQUEST
+            timings.mark("decode")
 
+        # streamed response fetches share the time budget of the handler
+        timeout = self.get_request_timeout(self.headers)
+        expires_at = time.time() + timeout if timeout is not None else None
         if request:
-            path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
-            if path in self.router:
-                try:
-                    response, code = self.router[path]({"body": request, "headers": self.headers}, context, self.store)
-                except Exception, e:
-                    logging.exception("Unexpected error: %s" % e)
-                    code = INTERNAL_ERROR
-            else:
-                code = NOT_FOUND
+            if self.stream_min_clients and self.request_version == "HTTP/1.1":
+                context["stream_min_clients"] = self.stream_min_clients
+            with deadline(expires_at=expires_at):
+                response, code = self.route(self.path, request, self.headers, context, self.store)
+            context.pop("stream_min_clients", None)
+            # handler time not covered by its own stages
+            timings.mark("handler")
 
-        self.send_response(code)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
+        if isinstance(response, serializers.StreamedMap):
+            code = self.send_stream(code, response_codec, self.build_response(serializers.PLACEHOLDER, code),
+                                    response, timings, expires_at)
+            # items are not kept for the log
+            r = {"response": "{} streamed items".format(response.length), "code": code}
         else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+            r = self.build_response(response, code)
+            data = response_codec.dumps(r)
+            timings.mark("encode")
+            self.send_response(code)
+            self.send_header("Content-Type", response_codec.content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.send_connection_header()
+            self.end_headers()
+            self.wfile.write(data)
+            self.wfile.flush()
+            timings.mark("write")
+
+        self.record_request(self.path, request, code, timings)
         context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r))
+        self.request_log.log(self.path, request, context, data_string)
         return
 
+    def send_stream(self, code, codec, frame, stream, timings, expires_at=None):
+        """sends `frame` response with `stream` in place of PLACEHOLDER using chunked encoding,
+        storage calls of the stream stop retrying at `expires_at` time
+
+        returns the response code, INTERNAL_ERROR if the stream failed after headers were sent
+        """
+        self.send_response(code)
+        self.send_header("Content-Type", codec.content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_connection_header()
+        self.end_headers()
+        try:
+            with deadline(expires_at=expires_at):
+                for piece in serializers.iter_dumps(codec, frame, stream):
+                    timings.mark("encode")
+                    if piece:
+                        self.wfile.write("%x\r\n%s\r\n" % (len(piece), piece))
+                        self.wfile.flush()
+                    timings.mark("write")
+        except Exception, e:
+            # body is left unterminated, so the client sees the response is incomplete
+            logging.exception("Failed to stream response: %s" % e)
+            self.close_connection = 1
+            return INTERNAL_ERROR
+        self.wfile.write("0\r\n\r\n")
+        self.wfile.flush()
+        timings.mark("write")
+        return code
+
 
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-m", "--mode", action="store", type="choice", choices=server.MODES, default=server.SINGLE_MODE)
+    op.add_option("-w", "--workers", action="store", type=int, default=None,
+                  help="number of worker processes in prefork mode, cpu count by default")
+    op.add_option("--cpu-affinity", action="store_true", default=False,
+                  help="pin prefork workers to cpus")
+    op.add_option("--storage", action="store", type="choice", choices=["redis", "memory"], default="redis",
+                  help="memory storage is not shared by processes, for tests and benchmarks")
+    op.add_option("--interests-snapshot", action="store", default=None,
+                  help="snapshot file made by src/snapshot.py, serves interests when redis fails")
+    op.add_option("--interests-snapshot-first", action="store_true", default=False,
+                  help="read interests from snapshot before redis")
+    op.add_option("--redis-host", action="store", default="localhost")
+    op.add_option("--redis-nodes", action="store", default=None,
+                  help="comma separated host:port list of redis shards, overrides --redis-host and --redis-port")
+    op.add_option("--redis-port", action="store", type=int, default=6379)
+    op.add_option("--redis-replicas", action="store", default=None,
+                  help="comma separated host:port list of read replicas of --redis-host and --redis-port")
+    op.add_option("--redis-replica-balance", action="store", type="choice", choices=BALANCERS,
+                  default=LEAST_OUTSTANDING, help="how reads are spread over replicas")
+    op.add_option("--redis-pool-size", action="store", type=int, default=Storage.DEFAULT_POOL_SIZE,
+                  help="max redis connections per process")
+    op.add_option("--redis-pool-timeout", action="store", type=float, default=Storage.DEFAULT_POOL_TIMEOUT_SEC,
+                  help="seconds to wait for a free connection in the pool")
+    op.add_option("--redis-socket-timeout", action="store", type=float,
+                  default=Storage.DEFAULT_REDIS_OPTS['socket_timeout'])
+    op.add_option("--redis-connect-timeout", action="store", type=float,
+                  default=Storage.DEFAULT_REDIS_OPTS['socket_connect_timeout'])
+    op.add_option("--redis-retries", action="store", type=int, default=Storage.RETRY_N)
+    op.add_option("--redis-retry-interval", action="store", type=float, default=Storage.RETRY_INTERVAL_SEC,
+                  help="base of exponential retry backoff in seconds")
+    op.add_option("--redis-retry-max-interval", action="store", type=float, default=Storage.RETRY_MAX_INTERVAL_SEC)
+    op.add_option("--circuit-failures", action="store", type=int, default=5,
+                  help="failed redis calls in a row to stop querying score cache, 0 disables circuit breaker")
+    op.add_option("--circuit-reset-timeout", action="store", type=float, default=10,
+                  help="seconds before probing redis after circuit is open")
+    op.add_option("--request-timeout", action="store", type=float, default=None,
+                  help="default time budget of request storage calls in seconds, "
+                       "can be set per request with {} header in milliseconds".format(DEADLINE_HEADER))
+    op.add_option("--l1-cache-entries", action="store", type=int, default=0,
+                  help="max entries of in-process score cache, 0 disables it")
+    op.add_option("--l1-cache-bytes", action="store", type=int, default=None,
+                  help="approximate max size of in-process score cache")
+    op.add_option("--keep-alive-timeout", action="store", type=float, default=MainHTTPHandler.timeout,
+                  help="seconds to keep idle connection open, 0 disables keep-alive")
+    op.add_option("--keep-alive-requests", action="store", type=int, default=MainHTTPHandler.max_keep_alive_requests,
+                  help="max requests per connection")
+    op.add_option("--stream-min-clients", action="store", type=int, default=MainHTTPHandler.stream_min_clients,
+                  help="stream clients_interests responses for at least this number of clients, 0 disables it")
+    op.add_option("--profile-dir", action="store", default=None,
+                  help="directory for request profiles, enables /debug/profile?seconds=S")
+    op.add_option("--profile-every", action="store", type=int, default=0,
+                  help="profile every n-th request, 0 disables sampling, requires --profile-dir")
+    op.add_option("--profile-top", action="store", type=int, default=profiler.DEFAULT_TOP,
+                  help="functions in profile summary")
+    op.add_option("--log-format", action="store", type="choice", choices=["json", "text"], default="json")
+    op.add_option("--log-sync", action="store_true", default=False,
+                  help="write logs in the serving thread instead of background one")
+    op.add_option("--log-queue-size", action="store", type=int, default=request_log.MAX_QUEUE,
+                  help="max log records waiting to be written, the rest are dropped")
+    op.add_option("--log-sample-rate", action="store", type=float, default=request_log.DEFAULT_SAMPLE_RATE,
+                  help="share of successful requests to log, failed ones are always logged")
+    op.add_option("--log-max-items", action="store", type=int, default=request_log.MAX_ITEMS,
+                  help="max logged items of request and response lists and dicts")
+    op.add_option("--log-max-string", action="store", type=int, default=request_log.MAX_STRING,
+                  help="max logged length of request and response strings")
     (opts, args) = op.parse_args()
-    logging.basicConfig(filename=opts.log, level=logging.INFO,
-                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
+    if opts.profile_every and not opts.profile_dir:
+        op.error("--profile-every requires --profile-dir")
+    redis_nodes = None
+    if opts.redis_nodes:
+        try:
+            redis_nodes = parse_nodes(opts.redis_nodes)
+        except ValueError as e:
+            op.error(str(e))
+    redis_replicas = None
+    if opts.redis_replicas:
+        try:
+            redis_replicas = parse_nodes(opts.redis_replicas)
+        except ValueError as e:
+            op.error(str(e))
+        if redis_nodes:
+            op.error("replicas of sharded nodes are not supported")
+    if opts.storage != "redis" and opts.mode == server.EVENT_MODE:
+        op.error("event mode works with redis storage only")
+    request_log.setup_logging(opts.log, json_format=opts.log_format == "json",
+                              async_=not opts.log_sync, max_queue=opts.log_queue_size)
+    MainHTTPHandler.request_log = request_log.RequestLog(
+        sample_rate=opts.log_sample_rate,
+        max_items=opts.log_max_items,
+        max_string=opts.log_max_string,
+    )
+    l1_cache = None
+    if opts.l1_cache_entries > 0:
+        l1_cache = LRUCache(max_entries=opts.l1_cache_entries, max_bytes=opts.l1_cache_bytes)
+    circuit_breaker = None
+    if opts.circuit_failures > 0:
+        circuit_breaker = CircuitBreaker(opts.circuit_failures, opts.circuit_reset_timeout)
+    MainHTTPHandler.request_timeout = opts.request_timeout
+    # single mode serves one connection at a time, idle client would block the others
+    MainHTTPHandler.keep_alive = opts.keep_alive_timeout > 0 and opts.mode != server.SINGLE_MODE
+    if opts.keep_alive_timeout > 0:
+        MainHTTPHandler.timeout = opts.keep_alive_timeout
+    MainHTTPHandler.max_keep_alive_requests = opts.keep_alive_requests
+    MainHTTPHandler.stream_min_clients = opts.stream_min_clients
+    if opts.profile_dir:
+        MainHTTPHandler.profiler = profiler.Profiler(opts.profile_dir, every=opts.profile_every, top=opts.profile_top)
+    MainHTTPHandler.store = Storage(
+        backend=MemoryBackend() if opts.storage == "memory" else None,
+        local=SnapshotBackend(opts.interests_snapshot) if opts.interests_snapshot else None,
+        local_first=opts.interests_snapshot_first,
+        nodes=redis_nodes,
+        replicas=redis_replicas,
+        replica_balance=opts.redis_replica_balance,
+        l1_cache=l1_cache,
+        retries=opts.redis_retries,
+        retry_interval=opts.redis_retry_interval,
+        retry_max_interval=opts.redis_retry_max_interval,
+        circuit_breaker=circuit_breaker,
+        pool_size=opts.redis_pool_size,
+        pool_timeout=opts.redis_pool_timeout,
+        host=opts.redis_host,
+        port=opts.redis_port,
+        socket_timeout=opts.redis_socket_timeout,
+        socket_connect_timeout=opts.redis_connect_timeout,
+    )
+    metrics.REGISTRY.add_collector(MainHTTPHandler.store.collect_metrics)
+    # event loop can't wait for storage, names added later are loaded in another thread there
+    scoring.interests_dictionary = interests_format.InterestsDictionary(
+        MainHTTPHandler.store, background_load=opts.mode == server.EVENT_MODE)
     try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        logging.error("server execution was interrupted")
-    except Exception:
-        logging.exception("exception in server")
-
-    logging.info("stopping server")
-    server.server_close()
+        # before fork, so prefork workers share the names
+        scoring.interests_dictionary.load()
+    except ConnectionError as e:
+        logging.warning("interests dictionary is not loaded: %s" % e)
+    logging.info("Starting server at %s in %s mode" % (opts.port, opts.mode))
+    server.serve(("localhost", opts.port), MainHTTPHandler,
+                 mode=opts.mode, workers=opts.workers, cpu_affinity=opts.cpu_affinity)
+    logging.info("redis pool stats: %s" % MainHTTPHandler.store.pool_stats())
+    if l1_cache is not None:
+        logging.info("l1 cache stats: %s" % l1_cache.stats())
+    if MainHTTPHandler.profiler is not None:
+        MainHTTPHandler.profiler.flush()
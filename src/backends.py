@@ -0,0 +1,530 @@
+"""key-value backends of Storage
+
+Storage adds retries, circuit breaker, l1 cache and metrics on top of a backend.
+backend calls are get, mget, get_with_ttl, set, set_many, scan, get_list and append_list,
+values are strings, ttl is in seconds like in redis.
+ShardedBackend spreads keys over several backends with consistent hashing,
+ReplicatedBackend spreads reads over replicas of one primary
+"""
+import os
+import time
+import bisect
+import struct
+import fnmatch
+import hashlib
+import logging
+import threading
+import contextlib
+from multiprocessing.pool import ThreadPool
+
+import redis
+from redis.exceptions import ConnectionError, TimeoutError
+
+import metrics
+
+# points of every node on the hash ring
+DEFAULT_VNODES = 160
+DEFAULT_FANOUT_THREADS = 50
+LEAST_OUTSTANDING = 'least-outstanding'
+ROUND_ROBIN = 'round-robin'
+BALANCERS = [LEAST_OUTSTANDING, ROUND_ROBIN]
+DEFAULT_CHECK_INTERVAL_SEC = 1
+# failed replica gets no reads for at least that long
+DEFAULT_EJECT_SEC = 10
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def deadline(timeout=None, expires_at=None):
+    """storage calls made by current thread inside the block stop retrying after timeout seconds
+    or at expires_at time, socket timeouts of redis calls are cut to the remaining time
+    """
+    prev = getattr(_local, 'deadline', None)
+    if timeout is not None:
+        expires_at = time.time() + timeout
+    if expires_at is not None:
+        _local.deadline = min(expires_at, prev) if prev is not None else expires_at
+    try:
+        yield
+    finally:
+        _local.deadline = prev
+
+
+def current_deadline():
+    """expiration time of the deadline of current thread, None without deadline"""
+    return getattr(_local, 'deadline', None)
+
+
+def remaining_time():
+    expires_at = getattr(_local, 'deadline', None)
+    return expires_at - time.time() if expires_at is not None else None
+
+
+def _call_with_deadline(expires_at, func, args):
+    with deadline(expires_at=expires_at):
+        return func(*args)
+
+
+REPLICA_EJECTIONS = metrics.Counter('storage_replica_ejections_total', 'replicas ejected from reads', ['replica'])
+PRIMARY_READS = metrics.Counter('storage_primary_reads_total',
+                                'reads served by primary because replicas failed or none is healthy')
+
+
+class StatsConnectionPool(redis.BlockingConnectionPool):
+    """bounded connection pool collecting checkout statistics"""
+
+    def __init__(self, *args, **kwargs):
+        self._stats_lock = threading.Lock()
+        self._checked_out = set()
+        self._stats = {
+            'checkouts': 0,
+            'failed_checkouts': 0,
+            'max_in_use': 0,
+            'wait_sec_total': 0.0,
+            'wait_sec_max': 0.0,
+        }
+        super(StatsConnectionPool, self).__init__(*args, **kwargs)
+
+    def get_connection(self, command_name, *keys, **options):
+        started = time.time()
+        try:
+            connection = super(StatsConnectionPool, self).get_connection(command_name, *keys, **options)
+        except ConnectionError:
+            # pool timeout or failed connect
+            with self._stats_lock:
+                self._stats['failed_checkouts'] += 1
+            raise
+
+        waited = time.time() - started
+        with self._stats_lock:
+            stats = self._stats
+            self._checked_out.add(id(connection))
+            stats['checkouts'] += 1
+            stats['max_in_use'] = max(stats['max_in_use'], len(self._checked_out))
+            stats['wait_sec_total'] += waited
+            stats['wait_sec_max'] = max(stats['wait_sec_max'], waited)
+
+        # a call should not block longer than the deadline allows
+        remaining = remaining_time()
+        if remaining is not None and connection._sock is not None and \
+                (connection.socket_timeout is None or remaining < connection.socket_timeout):
+            connection._sock.settimeout(max(remaining, 0.001))
+            connection.deadline_timeout = True
+        return connection
+
+    def release(self, connection):
+        # also called by parent class for connections failed to connect,
+        # those were never counted as checked out
+        with self._stats_lock:
+            self._checked_out.discard(id(connection))
+        if getattr(connection, 'deadline_timeout', False):
+            connection.deadline_timeout = False
+            if connection._sock is not None:
+                connection._sock.settimeout(connection.socket_timeout)
+        super(StatsConnectionPool, self).release(connection)
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+            stats['in_use'] = len(self._checked_out)
+        stats['max_connections'] = self.max_connections
+        return stats
+
+
+class RedisBackend(object):
+    def __init__(self, pool_size, pool_timeout, **redis_kwargs):
+        self.redis_kwargs = redis_kwargs
+        self.pool = StatsConnectionPool(max_connections=pool_size, timeout=pool_timeout, **redis_kwargs)
+        self.redis = redis.Redis(connection_pool=self.pool)
+
+    def stats(self):
+        return self.pool.get_stats()
+
+    def healthy(self):
+        """answers and, if it is a replica, its link to the master is up"""
+        return self.redis.info('replication').get('master_link_status', 'up') == 'up'
+
+    def get(self, key):
+        return self.redis.get(key)
+
+    def mget(self, keys):
+        return self.redis.mget(keys)
+
+    def get_with_ttl(self, key):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.ttl(key)
+        return pipe.execute()
+
+    def set(self, key, value, ttl=None):
+        self.redis.set(key, value, ex=ttl)
+
+    def set_many(self, items):
+        """(key, value, ttl) items in one pipeline, ttl may be None"""
+        pipe = self.redis.pipeline(transaction=False)
+        for key, value, ttl in items:
+            pipe.set(key, value, ex=ttl)
+        pipe.execute()
+
+    def scan(self, cursor=0, match=None, count=None):
+        return self.redis.scan(cursor, match=match, count=count)
+
+    def get_list(self, key, start=0):
+        return self.redis.lrange(key, start, -1)
+
+    def append_list(self, key, values, length):
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.llen(key) != length:
+                    return False
+                pipe.multi()
+                pipe.rpush(key, *values)
+                pipe.execute()
+            except redis.WatchError:
+                # changed concurrently
+                return False
+        return True
+
+
+class MemoryBackend(object):
+    """thread-safe in-process backend, for tests, benchmarks and runs without redis"""
+
+    def __init__(self, data=None):
+        self._data = {}  # key -> [value, expiration time or None]
+        self._lock = threading.Lock()
+        for key, value in (data or {}).iteritems():
+            self._data[key] = [value, None]
+
+    def stats(self):
+        return None
+
+    def healthy(self):
+        return True
+
+    def _entry(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.time():
+            del self._data[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entry(key)
+        return entry[0] if entry is not None else None
+
+    def mget(self, keys):
+        with self._lock:
+            entries = [self._entry(key) for key in keys]
+        return [entry[0] if entry is not None else None for entry in entries]
+
+    def get_with_ttl(self, key):
+        with self._lock:
+            entry = self._entry(key)
+        if entry is None:
+            return None, -2
+        if entry[1] is None:
+            return entry[0], -1
+        return entry[0], max(int(round(entry[1] - time.time())), 1)
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = [value, time.time() + ttl if ttl else None]
+
+    def set_many(self, items):
+        now = time.time()
+        with self._lock:
+            for key, value, ttl in items:
+                self._data[key] = [value, now + ttl if ttl else None]
+
+    def scan(self, cursor=0, match=None, count=None):
+        with self._lock:
+            keys = sorted(self._data)
+        if match is not None:
+            keys = [key for key in keys if fnmatch.fnmatchcase(key, match)]
+        end = cursor + (count or 10)
+        return (end if end < len(keys) else 0), keys[cursor:end]
+
+    def get_list(self, key, start=0):
+        return list(self.get(key) or [])[start:]
+
+    def append_list(self, key, values, length):
+        with self._lock:
+            entry = self._entry(key)
+            items = entry[0] if entry is not None else []
+            if len(items) != length:
+                return False
+            self._data[key] = [items + list(values), None]
+        return True
+
+
+def _merge_stats(backends):
+    """sum of pool statistics of the backends, None if none of them has a pool"""
+    stats = None
+    for backend_stats in (backend.stats() for backend in backends):
+        if backend_stats is None:
+            continue
+        if stats is None:
+            stats = dict(backend_stats)
+            continue
+        for name, value in backend_stats.iteritems():
+            stats[name] = max(stats[name], value) if name == 'wait_sec_max' else stats[name] + value
+    return stats
+
+
+def _ring_hash(value):
+    return struct.unpack_from('<Q', hashlib.md5(value).digest())[0]
+
+
+class HashRing(object):
+    """consistent hash ring, every node is placed on it at `vnodes` points
+
+    key belongs to the node of the first point after the key hash, so adding
+    a node moves only about 1 / nodes count of the keys
+    """
+
+    def __init__(self, nodes, vnodes=DEFAULT_VNODES):
+        points = sorted((_ring_hash('{}#{}'.format(node, i)), n) for n, node in enumerate(nodes) for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._nodes = [n for _, n in points]
+        self.size = len(nodes)
+
+    def get_node(self, key):
+        """index of the node of the key"""
+        if self.size == 1:
+            return 0
+        i = bisect.bisect(self._hashes, _ring_hash(key))
+        return self._nodes[i if i < len(self._nodes) else 0]
+
+    def group(self, keys):
+        """node index -> positions of its keys"""
+        groups = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(self.get_node(key), []).append(i)
+        return groups
+
+
+class ShardedBackend(object):
+    """routes keys to backends by consistent hashing, multi-key calls go to all shards at once
+
+    `names` identify backends on the ring, e.g. "host:port", so the ring doesn't
+    depend on the order of nodes
+    """
+
+    def __init__(self, backends, names, vnodes=DEFAULT_VNODES, fanout_threads=DEFAULT_FANOUT_THREADS):
+        self.backends = backends
+        self.ring = HashRing(names, vnodes)
+        self.fanout_threads = fanout_threads
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self):
+        # threads don't survive fork, prefork workers start their own pool
+        if self._pool_pid != os.getpid():
+            with self._pool_lock:
+                if self._pool_pid != os.getpid():
+                    self._pool = ThreadPool(self.fanout_threads)
+                    self._pool_pid = os.getpid()
+        return self._pool
+
+    def _fanout(self, calls):
+        """runs (func, args) calls concurrently, the first one in the current thread"""
+        if len(calls) == 1:
+            func, args = calls[0]
+            return [func(*args)]
+        pool = self._get_pool()
+        # deadline is thread local, pass it to the pool threads
+        expires_at = current_deadline()
+        results = [pool.apply_async(_call_with_deadline, (expires_at, call_func, call_args))
+                   for call_func, call_args in calls[1:]]
+        func, args = calls[0]
+        first = func(*args)
+        return [first] + [r.get() for r in results]
+
+    def _backend(self, key):
+        return self.backends[self.ring.get_node(key)]
+
+    def stats(self):
+        return _merge_stats(self.backends)
+
+    def get(self, key):
+        return self._backend(key).get(key)
+
+    def mget(self, keys):
+        groups = self.ring.group(keys).items()
+        results = self._fanout([(self.backends[node].mget, ([keys[i] for i in positions],))
+                                for node, positions in groups])
+        values = [None] * len(keys)
+        for (_, positions), group_values in zip(groups, results):
+            for i, value in zip(positions, group_values):
+                values[i] = value
+        return values
+
+    def get_with_ttl(self, key):
+        return self._backend(key).get_with_ttl(key)
+
+    def set(self, key, value, ttl=None):
+        self._backend(key).set(key, value, ttl)
+
+    def set_many(self, items):
+        groups = self.ring.group([key for key, _, _ in items])
+        self._fanout([(self.backends[node].set_many, ([items[i] for i in positions],))
+                      for node, positions in groups.iteritems()])
+
+    def scan(self, cursor=0, match=None, count=None):
+        """scans shards one by one, shard number is encoded in the cursor"""
+        shard, shard_cursor = cursor % len(self.backends), cursor // len(self.backends)
+        shard_cursor, keys = self.backends[shard].scan(shard_cursor, match=match, count=count)
+        if shard_cursor:
+            return shard_cursor * len(self.backends) + shard, keys
+        if shard + 1 < len(self.backends):
+            return shard + 1, keys
+        return 0, keys
+
+    def get_list(self, key, start=0):
+        return self._backend(key).get_list(key, start)
+
+    def append_list(self, key, values, length):
+        return self._backend(key).append_list(key, values, length)
+
+
+class ReplicatedBackend(object):
+    """writes go to `primary`, reads of values are spread over healthy `replicas`
+
+    replica is chosen with least outstanding reads or round-robin. replica failed
+    a read or a health check is ejected for at least `eject_sec`, health checks run
+    every `check_interval` in a background thread and return it once it is healthy.
+    reads fall back to the primary. lists and scans are read from the primary, so
+    they see the writes at once
+    """
+
+    def __init__(self, primary, replicas, names=None, balance=LEAST_OUTSTANDING,
+                 check_interval=DEFAULT_CHECK_INTERVAL_SEC, eject_sec=DEFAULT_EJECT_SEC):
+        if balance not in BALANCERS:
+            raise ValueError('unknown balance {!r}'.format(balance))
+        self.primary = primary
+        self.replicas = replicas
+        self.names = names or [str(i) for i in range(len(replicas))]
+        self.balance = balance
+        self.check_interval = check_interval
+        self.eject_sec = eject_sec
+        self._outstanding = [0] * len(replicas)
+        self._ejected_until = [None] * len(replicas)
+        self._next = 0
+        self._lock = threading.Lock()
+        self._checker_pid = None
+
+    def stats(self):
+        return _merge_stats([self.primary] + self.replicas)
+
+    def healthy_replicas(self):
+        """indexes of replicas serving reads"""
+        return [i for i, until in enumerate(self._ejected_until) if until is None]
+
+    def eject(self, replica, reason):
+        with self._lock:
+            ejected = self._ejected_until[replica] is None
+            self._ejected_until[replica] = time.time() + self.eject_sec
+        if ejected:
+            logging.warning('replica %s is ejected: %s', self.names[replica], reason)
+            REPLICA_EJECTIONS.inc((self.names[replica],))
+
+    def check(self):
+        """health checks all replicas, ejected ones return after eject_sec if they are healthy"""
+        for i, replica in enumerate(self.replicas):
+            try:
+                healthy = replica.healthy()
+            except Exception as e:
+                healthy, reason = False, e
+            else:
+                reason = 'master link is down'
+            if not healthy:
+                self.eject(i, reason)
+                continue
+            with self._lock:
+                until = self._ejected_until[i]
+                returned = until is not None and until <= time.time()
+                if returned:
+                    self._ejected_until[i] = None
+            if returned:
+                logging.info('replica %s is healthy, returned to reads', self.names[i])
+
+    def _run_checks(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self.check()
+            except Exception:
+                logging.exception('replica health check failed')
+
+    def _start_checker(self):
+        # threads don't survive fork, prefork workers start their own checker
+        with self._lock:
+            if self._checker_pid == os.getpid():
+                return
+            self._checker_pid = os.getpid()
+        thread = threading.Thread(target=self._run_checks, name='replica-checker')
+        thread.daemon = True
+        thread.start()
+
+    def acquire(self):
+        """index of replica to read from, None if none is healthy, release it after the read"""
+        if self.check_interval and self._checker_pid != os.getpid():
+            self._start_checker()
+        with self._lock:
+            healthy = self.healthy_replicas()
+            if not healthy:
+                return None
+            self._next += 1
+            # rotation breaks ties of least outstanding
+            rotated = healthy[self._next % len(healthy):] + healthy[:self._next % len(healthy)]
+            if self.balance == LEAST_OUTSTANDING:
+                replica = min(rotated, key=self._outstanding.__getitem__)
+            else:
+                replica = rotated[0]
+            self._outstanding[replica] += 1
+        return replica
+
+    def release(self, replica):
+        with self._lock:
+            self._outstanding[replica] -= 1
+
+    def _read(self, method, *args):
+        replica = self.acquire()
+        if replica is not None:
+            try:
+                return getattr(self.replicas[replica], method)(*args)
+            except (ConnectionError, TimeoutError) as e:
+                self.eject(replica, e)
+            finally:
+                self.release(replica)
+        PRIMARY_READS.inc()
+        return getattr(self.primary, method)(*args)
+
+    def get(self, key):
+        return self._read('get', key)
+
+    def mget(self, keys):
+        return self._read('mget', keys)
+
+    def get_with_ttl(self, key):
+        return self._read('get_with_ttl', key)
+
+    def set(self, key, value, ttl=None):
+        self.primary.set(key, value, ttl)
+
+    def set_many(self, items):
+        self.primary.set_many(items)
+
+    def scan(self, cursor=0, match=None, count=None):
+        return self.primary.scan(cursor, match=match, count=count)
+
+    def get_list(self, key, start=0):
+        # appends are checked against the length on the primary
+        return self.primary.get_list(key, start)
+
+    def append_list(self, key, values, length):
+        return self.primary.append_list(key, values, length)
@@ -0,0 +1,123 @@
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache(object):
+    """thread-safe in-memory cache with per-entry ttl
+
+    least recently used entries are evicted when either entries count
+    or approximate size of keys and values exceeds the limits
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (value, expires_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires_at, size = entry
+            if expires_at <= now:
+                self._bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            # reinsert to mark as most recently used
+            self._data[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl):
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+        entry = (value, time.time() + ttl, size)
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._data[key] = entry
+            self._bytes += size
+            self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+
+    def _evict(self):
+        while self._data and (
+                len(self._data) > self.max_entries or
+                self.max_bytes is not None and self._bytes > self.max_bytes):
+            _, (_, _, size) = self._data.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """runs one call per key at a time, concurrent callers with the same key get its result"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
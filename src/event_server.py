@@ -0,0 +1,657 @@
+"""single-threaded epoll based server
+
+requests are parsed here and passed to the same handlers as in MainHTTPHandler.
+handlers are run against PrefetchStorage: keys requested by the first run are
+fetched from redis with one MGET over non-blocking connection and the handler is run again.
+with several redis shards keys are routed like in backends.ShardedBackend, shards are queried at once.
+reads go to replicas chosen by backends.ReplicatedBackend of the store, if it has them
+"""
+import time
+import errno
+import select
+import socket
+import logging
+from collections import deque
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+from redis.exceptions import ConnectionError, ResponseError
+
+import metrics
+from backends import PRIMARY_READS, HashRing
+from storage import FALLBACK_READS, PrefetchStorage, decode_cache_value, encode_cache_value
+
+OK = 200
+BAD_REQUEST = 400
+RECV_SIZE = 64 * 1024
+# max request body, MainHTTPHandler.read_body uses the same limit
+MAX_BODY_SIZE = 16 * 1024 * 1024
+BACKLOG = 1024
+# handler needs one round to collect keys and one to build the response,
+# the limit guards against handlers requesting new keys on each run
+MAX_FETCH_ROUNDS = 3
+
+EPOLL_IN = select.EPOLLIN | select.EPOLLPRI
+EPOLL_OUT = select.EPOLLOUT
+EPOLL_ERR = select.EPOLLERR | select.EPOLLHUP
+
+
+class HTTPError(Exception):
+    pass
+
+
+class Headers(dict):
+    """case insensitive headers mapping"""
+
+    def __setitem__(self, key, value):
+        super(Headers, self).__setitem__(key.lower(), value)
+
+    def __getitem__(self, key):
+        return super(Headers, self).__getitem__(key.lower())
+
+    def __contains__(self, key):
+        return super(Headers, self).__contains__(key.lower())
+
+    def get(self, key, default=None):
+        return super(Headers, self).get(key.lower(), default)
+
+
+class Request(object):
+    def __init__(self, method, path, version, headers, body):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('Connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+def parse_request(buf):
+    """parse one request from the buffer head
+
+    returns request and number of consumed bytes or (None, 0) if request is incomplete
+    """
+    head_end = buf.find('\r\n\r\n')
+    if head_end == -1:
+        return None, 0
+
+    lines = buf[:head_end].split('\r\n')
+    try:
+        method, path, version = lines[0].split()
+    except ValueError:
+        raise HTTPError('bad request line {!r}'.format(lines[0]))
+
+    headers = Headers()
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise HTTPError('bad header line {!r}'.format(line))
+        headers[name.strip()] = value.strip()
+
+    body_start = head_end + 4
+    try:
+        length = int(headers.get('Content-Length', 0))
+    except ValueError:
+        raise HTTPError('bad content length')
+    if not 0 <= length <= MAX_BODY_SIZE:
+        raise HTTPError('wrong content length: {}'.format(length))
+
+    if len(buf) < body_start + length:
+        return None, 0
+    body = buf[body_start:body_start + length]
+    return Request(method, path, version, headers, body), body_start + length
+
+
+def encode_arg(arg):
+    if isinstance(arg, unicode):
+        return arg.encode('utf-8')
+    elif isinstance(arg, float):
+        return repr(arg)
+    return str(arg)
+
+
+def encode_command(args):
+    parts = ['*%d\r\n' % len(args)]
+    for arg in args:
+        arg = encode_arg(arg)
+        parts.append('$%d\r\n%s\r\n' % (len(arg), arg))
+    return ''.join(parts)
+
+
+class RespParser(object):
+    """incremental parser of redis protocol replies"""
+    INCOMPLETE = object()
+
+    def __init__(self):
+        self._buf = ''
+        self._pos = 0
+
+    def feed(self, data):
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+
+    def _parse(self, pos):
+        end = self._buf.find('\r\n', pos)
+        if end == -1:
+            return self.INCOMPLETE, pos
+
+        kind, line, pos = self._buf[pos], self._buf[pos + 1:end], end + 2
+        if kind == '+':
+            return line, pos
+        elif kind == '-':
+            return ResponseError(line), pos
+        elif kind == ':':
+            return int(line), pos
+        elif kind == '$':
+            length = int(line)
+            if length == -1:
+                return None, pos
+            if len(self._buf) < pos + length + 2:
+                return self.INCOMPLETE, pos
+            return self._buf[pos:pos + length], pos + length + 2
+        elif kind == '*':
+            length = int(line)
+            if length == -1:
+                return None, pos
+            items = []
+            for _ in range(length):
+                item, pos = self._parse(pos)
+                if item is self.INCOMPLETE:
+                    return self.INCOMPLETE, pos
+                items.append(item)
+            return items, pos
+
+        raise ResponseError('unknown reply type {!r}'.format(kind))
+
+    def gets(self):
+        """returns next reply or INCOMPLETE"""
+        reply, pos = self._parse(self._pos)
+        if reply is not self.INCOMPLETE:
+            self._pos = pos
+        return reply
+
+
+class AsyncRedis(object):
+    """non-blocking redis connection, commands are pipelined
+
+    callbacks get reply or exception instance
+    """
+
+    def __init__(self, loop, host='localhost', port=6379, socket_timeout=10):
+        self.loop = loop
+        self.address = (host, port)
+        self.socket_timeout = socket_timeout
+        self._sock = None
+        self._connected = False
+        self._outbuf = ''
+        self._pending = deque()
+        self._parser = RespParser()
+        self._last_activity = time.time()
+
+    def execute(self, callback, *args):
+        if self._sock is None:
+            self._connect()
+        if not self._pending:
+            # connection was idle, reply timeout counts from now
+            self._last_activity = time.time()
+        self._pending.append(callback)
+        self._outbuf += encode_command(args)
+        if self._connected:
+            self._flush()
+
+    def _connect(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setblocking(0)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._connected = False
+        self._parser = RespParser()
+        self._last_activity = time.time()
+        err = self._sock.connect_ex(self.address)
+        if err not in (0, errno.EINPROGRESS):
+            self.loop.call_soon(self._fail, ConnectionError('Error {} connecting to {}:{}. {}.'.format(
+                err, self.address[0], self.address[1], errno.errorcode[err])))
+            return
+        self.loop.register(self._sock.fileno(), self, EPOLL_IN | EPOLL_OUT)
+
+    def _fail(self, exc):
+        logging.warning('redis connection error: %s', exc)
+        if self._sock is not None:
+            self.loop.unregister(self._sock.fileno())
+            self._sock.close()
+        self._sock = None
+        self._connected = False
+        self._outbuf = ''
+        pending, self._pending = self._pending, deque()
+        for callback in pending:
+            callback(exc)
+
+    def _flush(self):
+        try:
+            while self._outbuf:
+                sent = self._sock.send(self._outbuf)
+                self._outbuf = self._outbuf[sent:]
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._fail(ConnectionError(str(e)))
+                return
+        self.loop.modify(self._sock.fileno(), EPOLL_IN | (EPOLL_OUT if self._outbuf else 0))
+
+    def handle_event(self, events):
+        if events & EPOLL_ERR and not self._connected:
+            err = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            self._fail(ConnectionError('Error {} connecting to {}:{}.'.format(err, *self.address)))
+            return
+
+        self._last_activity = time.time()
+        if events & EPOLL_OUT:
+            self._connected = True
+            self._flush()
+            if self._sock is None:
+                return
+
+        if events & (EPOLL_IN | EPOLL_ERR):
+            try:
+                data = self._sock.recv(RECV_SIZE)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self._fail(ConnectionError(str(e)))
+                return
+            if not data:
+                self._fail(ConnectionError('connection closed by server'))
+                return
+
+            self._parser.feed(data)
+            while self._pending:
+                reply = self._parser.gets()
+                if reply is RespParser.INCOMPLETE:
+                    break
+                self._pending.popleft()(reply)
+
+    def check_timeout(self, now):
+        if self._pending and now - self._last_activity > self.socket_timeout:
+            self._fail(ConnectionError('Timeout reading from socket'))
+
+
+class HTTPConnection(object):
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.closed = False
+        self.last_activity = time.time()
+        self._inbuf = ''
+        self._outbuf = ''
+        self.busy = False
+        self._keep_alive = True
+
+    def handle_event(self, events):
+        self.last_activity = time.time()
+        if events & EPOLL_IN:
+            self._read()
+        if events & EPOLL_OUT and not self.closed:
+            self._flush()
+        if events & EPOLL_ERR and not self.closed:
+            self.close()
+
+    def _read(self):
+        while True:
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.close()
+                return self._process()
+            if not data:
+                # client may half-close after sending request, so process what we have
+                self._keep_alive = False
+                self._process()
+                if self.busy:
+                    # stop polling for reads, eof is reported on each poll
+                    self.server.loop.modify(self.fd, 0)
+                else:
+                    self.close()
+                return
+            self._inbuf += data
+
+    def _process(self):
+        if self.busy or self.closed:
+            return
+
+        try:
+            request, consumed = parse_request(self._inbuf)
+        except HTTPError as e:
+            logging.warning('bad http request: %s', e)
+            self._keep_alive = False
+            self.send(400, '')
+            return
+
+        if request is None:
+            return
+
+        self._inbuf = self._inbuf[consumed:]
+        self._keep_alive = self._keep_alive and request.keep_alive
+        self.busy = True
+        self.server.handle_request(self, request)
+
+    def send(self, code, body, content_type='application/json'):
+        if self.closed:
+            return
+        message = BaseHTTPRequestHandler.responses.get(code, ('',))[0]
+        head = [
+            'HTTP/1.1 %d %s' % (code, message),
+            'Content-Type: %s' % content_type,
+            'Content-Length: %d' % len(body),
+            'Connection: %s' % ('keep-alive' if self._keep_alive else 'close'),
+        ]
+        self._outbuf += '\r\n'.join(head) + '\r\n\r\n' + body
+        self.busy = False
+        self._flush()
+
+    def _flush(self):
+        try:
+            while self._outbuf:
+                sent = self.sock.send(self._outbuf)
+                self._outbuf = self._outbuf[sent:]
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.close()
+                return
+
+        if self._outbuf:
+            self.server.loop.modify(self.fd, EPOLL_IN | EPOLL_OUT)
+            return
+
+        if not self._keep_alive and not self.busy:
+            self.close()
+            return
+        self.server.loop.modify(self.fd, EPOLL_IN)
+        # handle pipelined requests
+        self._process()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.server.loop.unregister(self.fd)
+        self.server.connections.pop(self.fd, None)
+        self.sock.close()
+
+
+class RequestTask(object):
+    """runs request handler, fetching requested keys from redis between runs"""
+
+    def __init__(self, server, conn, request, body, timings):
+        self.server = server
+        self.conn = conn
+        self.request = request
+        self.body = body
+        self.context = {"request_id": server.handler_cls.get_request_id(request.headers), "timings": timings}
+        self.store = PrefetchStorage(server.l1_cache)
+        self.rounds = 0
+        # redis replies the next run waits for
+        self._pending = 0
+
+    def run(self):
+        if self.rounds:
+            # time spent waiting for redis replies
+            self.context["timings"].mark("storage")
+        self.store.reset()
+        handler_cls = self.server.handler_cls
+        args = (self.request.path, self.body, self.request.headers, self.context, self.store)
+        if handler_cls.profiler is not None:
+            # each handler run is profiled separately, redis replies are awaited outside of it
+            response, code = handler_cls.profiler.call(handler_cls.route, *args)
+        else:
+            response, code = handler_cls.route(*args)
+
+        if self.store.missing and self.rounds < MAX_FETCH_ROUNDS:
+            self.rounds += 1
+            commands = []
+            for redis, keys in self.server.group_keys(list(self.store.missing)):
+                commands.append((redis, lambda reply, keys=keys: self._on_fetched(keys, reply), ['MGET'] + keys))
+            if self.server.l1_cache is not None:
+                # remaining ttl is needed to put fetched cache values into l1
+                for key in self.store.cache_missing:
+                    commands.append((self.server.get_redis(key), lambda reply, key=key: self._on_ttl(key, reply),
+                                     ['TTL', key]))
+            # handler is run again when the last reply is received,
+            # replies may come synchronously on connection errors
+            self._pending = len(commands)
+            for redis, callback, args in commands:
+                self.server.read(redis, callback, *args)
+            return
+
+        for key, value, ttl in self.store.writes:
+            if self.server.l1_cache is not None:
+                self.server.l1_cache.set(key, value, ttl)
+            self.server.get_redis(key).execute(self._on_written, 'SET', key, encode_cache_value(value), 'EX', ttl)
+        self.server.finish_request(self.conn, self.request, self.body, self.context, response, code)
+
+    def _on_fetched(self, keys, reply):
+        if isinstance(reply, Exception) and self.server.local is not None:
+            logging.warning('redis failed, reading %s keys from local backend', len(keys))
+            FALLBACK_READS.inc(('get_many',))
+            reply = self.server.local.mget(keys)
+        if isinstance(reply, Exception):
+            self.store.failed.update(keys)
+        else:
+            self.store.values.update(zip(keys, reply))
+        self._pending -= 1
+        if not self._pending:
+            self.run()
+
+    def _on_ttl(self, key, reply):
+        value = self.store.values.get(key)
+        if not isinstance(reply, Exception) and value is not None and reply > 0:
+            self.server.l1_cache.set(key, decode_cache_value(value), reply)
+        self._pending -= 1
+        if not self._pending:
+            self.run()
+
+    def _on_written(self, reply):
+        if isinstance(reply, Exception):
+            logging.warning('failed to write cache: %s', reply)
+
+
+class EventLoop(object):
+    POLL_TIMEOUT_SEC = 1
+
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._handlers = {}
+        self._soon = deque()
+        self._tickers = []
+        self.running = False
+
+    def register(self, fd, handler, events):
+        self._handlers[fd] = handler
+        self._epoll.register(fd, events)
+
+    def modify(self, fd, events):
+        self._epoll.modify(fd, events)
+
+    def unregister(self, fd):
+        if self._handlers.pop(fd, None) is not None:
+            self._epoll.unregister(fd)
+
+    def call_soon(self, callback, *args):
+        self._soon.append((callback, args))
+
+    def add_ticker(self, callback):
+        """callback is called with current time at least once per POLL_TIMEOUT_SEC"""
+        self._tickers.append(callback)
+
+    def run(self):
+        self.running = True
+        last_tick = time.time()
+        while self.running:
+            timeout = 0 if self._soon else self.POLL_TIMEOUT_SEC
+            try:
+                events = self._epoll.poll(timeout)
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            for fd, event in events:
+                handler = self._handlers.get(fd)
+                if handler is None:
+                    continue
+                try:
+                    handler.handle_event(event)
+                except Exception:
+                    logging.exception('error in event handler')
+
+            while self._soon:
+                callback, args = self._soon.popleft()
+                try:
+                    callback(*args)
+                except Exception:
+                    logging.exception('error in callback')
+
+            now = time.time()
+            if now - last_tick >= self.POLL_TIMEOUT_SEC:
+                last_tick = now
+                for ticker in self._tickers:
+                    ticker(now)
+
+    def close(self):
+        self._epoll.close()
+
+
+class EventLoopServer(object):
+    IDLE_TIMEOUT_SEC = 60
+
+    def __init__(self, address, handler_cls):
+        self.handler_cls = handler_cls
+        self.loop = EventLoop()
+        # use connection settings of the handler store, redis is accessed directly
+        store = handler_cls.store
+        redis_kwargs = store.redis_kwargs if store is not None else {}
+        self.l1_cache = store.l1_cache if store is not None else None
+        # serves keys when redis fails, like in Storage
+        self.local = store.local if store is not None else None
+        nodes = store.nodes if store is not None and store.nodes else [
+            (redis_kwargs.get('host', 'localhost'), redis_kwargs.get('port', 6379))]
+        self.redis = [AsyncRedis(self.loop, host, port, redis_kwargs.get('socket_timeout', 10)) for host, port in nodes]
+        self.ring = HashRing(['{}:{}'.format(host, port) for host, port in nodes])
+        # read replicas of the single node, replicas health is shared with ReplicatedBackend of the store
+        self.replicated = store.backend if store is not None and store.replicas else None
+        self.replicas = [AsyncRedis(self.loop, host, port, redis_kwargs.get('socket_timeout', 10))
+                         for host, port in (store.replicas if self.replicated is not None else [])]
+        self.connections = {}
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        self.socket.listen(BACKLOG)
+        self.socket.setblocking(0)
+        self.server_address = self.socket.getsockname()
+        self.loop.register(self.socket.fileno(), self, EPOLL_IN)
+        self.loop.add_ticker(self._check_timeouts)
+
+    def get_redis(self, key):
+        return self.redis[self.ring.get_node(key)]
+
+    def group_keys(self, keys):
+        """(redis connection, keys) pairs of shards"""
+        return [(self.redis[node], [keys[i] for i in positions])
+                for node, positions in self.ring.group(keys).iteritems()]
+
+    def read(self, redis, callback, *args):
+        """executes read command on a replica of `redis`, on `redis` itself if there are no healthy replicas"""
+        replica = self.replicated.acquire() if self.replicated is not None else None
+        if replica is None:
+            redis.execute(callback, *args)
+            return
+
+        def on_reply(reply):
+            self.replicated.release(replica)
+            if isinstance(reply, ConnectionError):
+                self.replicated.eject(replica, reply)
+                PRIMARY_READS.inc()
+                redis.execute(callback, *args)
+                return
+            callback(reply)
+        self.replicas[replica].execute(on_reply, *args)
+
+    def handle_event(self, events):
+        while True:
+            try:
+                sock, _ = self.socket.accept()
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logging.warning('accept failed: %s', e)
+                return
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = HTTPConnection(self, sock)
+            self.connections[conn.fd] = conn
+            self.loop.register(conn.fd, conn, EPOLL_IN)
+
+    def handle_request(self, conn, request):
+        if request.method == 'GET':
+            code, content_type, data = self.handler_cls.handle_get(request.path)
+            conn.send(code, data, content_type)
+            return
+        if request.method != 'POST':
+            conn.send(501, '')
+            return
+
+        timings = metrics.StageTimer()
+        request_codec, _ = self.handler_cls.get_codecs(request.headers)
+        body, code = None, None
+        if 'Content-Length' not in request.headers:
+            code = BAD_REQUEST
+        else:
+            try:
+                body = request_codec.loads(request.body)
+            except Exception:
+                code = BAD_REQUEST
+        timings.mark("decode")
+
+        if not body:
+            context = {"request_id": self.handler_cls.get_request_id(request.headers), "timings": timings}
+            self.finish_request(conn, request, body, context, {}, code or OK)
+            return
+
+        task = RequestTask(self, conn, request, body, timings)
+        task.run()
+
+    def finish_request(self, conn, request, body, context, response, code):
+        timings = context["timings"]
+        timings.mark("handler")
+        _, response_codec = self.handler_cls.get_codecs(request.headers)
+        r = self.handler_cls.build_response(response, code)
+        data = response_codec.dumps(r)
+        timings.mark("encode")
+        conn.send(code, data, response_codec.content_type)
+        timings.mark("write")
+
+        self.handler_cls.record_request(request.path, body, code, timings)
+        context.update(r)
+        self.handler_cls.request_log.log(request.path, body, context, request.body)
+
+    def _check_timeouts(self, now):
+        for redis in self.redis + self.replicas:
+            redis.check_timeout(now)
+        for conn in self.connections.values():
+            if not conn.busy and now - conn.last_activity > self.IDLE_TIMEOUT_SEC:
+                conn.close()
+
+    def serve_forever(self):
+        self.loop.run()
+
+    def server_close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.loop.unregister(self.socket.fileno())
+        self.socket.close()
+        self.loop.close()
+
@@ -1,3 +1,5 @@
+import re
+import time
 import datetime
 
 UNKNOWN = 0
@@ -10,6 +12,51 @@ GENDERS = {
 }
 
 DATE_FMT = '%d.%m.%Y'
+# the same as strptime builds for DATE_FMT
+DATE_RE = re.compile(r'(3[01]|[12]\d|0[1-9]|[1-9]| [1-9])\.(1[0-2]|0[1-9]|[1-9])\.(\d\d\d\d)\Z')
+DATE_CACHE_SIZE = 4096
+
+_dates = {}
+
+
+def parse_date(val):
+    """fast equivalent of datetime.strptime(val, DATE_FMT) with memoization"""
+    try:
+        return _dates[val]
+    except KeyError:
+        pass
+
+    match = DATE_RE.match(val)
+    if match is None:
+        raise ValueError('time data {!r} does not match format {!r}'.format(val, DATE_FMT))
+    day, month, year = match.groups()
+    dt = datetime.datetime(int(year), int(month), int(day))
+
+    if len(_dates) >= DATE_CACHE_SIZE:
+        _dates.clear()
+    _dates[val] = dt
+    return dt
+
+
+class _Today(object):
+    """datetime.date.today() cached until the next midnight"""
+
+    def __init__(self):
+        self._date = None
+        self._expires_at = 0
+
+    def __call__(self):
+        now = time.time()
+        if now >= self._expires_at:
+            today = datetime.date.today()
+            expires_at = time.mktime((today + datetime.timedelta(days=1)).timetuple())
+            # date is set first, threads seeing the new expiration time read the new date
+            self._date = today
+            self._expires_at = expires_at
+        return self._date
+
+
+today = _Today()
 
 
 class ValidationError(ValueError):
@@ -17,25 +64,53 @@ class ValidationError(ValueError):
 
 
 class Field(object):
-    """descriptor class for field validation"""
+    """descriptor class for field validation
+
+    subclasses define `_check` for not None values, checks of all classes
+    in mro are run base class first, so `_check` shouldn't call super
+    """
 
     def __init__(self, required=True, nullable=False, name=None):
         self.required = required
         self.nullable = nullable
         self.name = name
+        # slot of the value in request object, set by its metaclass
+        self.slot = None
+        self.checks = [
+            klass.__dict__['_check'].__get__(self, klass)
+            for klass in reversed(type(self).__mro__)
+            if '_check' in klass.__dict__
+        ]
 
     def __get__(self, obj, objtype):
-        return obj.__dict__.get(self.name)
+        if obj is None:
+            return self
+        try:
+            return self.slot.__get__(obj, objtype)
+        except AttributeError:
+            # not set
+            return None
 
     def __set__(self, obj, val):
         self._validate(val)
-        obj.__dict__[self.name] = val
+        self.slot.__set__(obj, self.to_python(val) if val is not None else None)
+
+    def to_python(self, val):
+        """convert valid not None value before assignment"""
+        return val
 
     def _validate(self, val):
-        if val is None and not self.nullable:
-            # basic validation
-            # more checks in subclasses
-            raise ValidationError('field "{}" can\'t be null'.format(self.name))
+        if val is None:
+            if not self.nullable:
+                raise ValidationError(self.null_error)
+            return
+
+        for check in self.checks:
+            check(val)
+
+    @property
+    def null_error(self):
+        return 'field "{}" can\'t be null'.format(self.name)
 
     def __repr__(self):
         return (
@@ -51,29 +126,20 @@ class Field(object):
 
 
 class CharField(Field):
-    def _validate(self, val):
-        super(CharField, self)._validate(val)
-        if val is None:
-            return
-        elif not isinstance(val, basestring):
+    def _check(self, val):
+        if not isinstance(val, basestring):
             raise ValidationError('field "{}" must be a string'.format(self.name))
 
 
 class ArgumentsField(Field):
-    def _validate(self, val):
-        super(ArgumentsField, self)._validate(val)
-        if val is None:
-            return
-        elif not isinstance(val, dict):
+    def _check(self, val):
+        if not isinstance(val, dict):
             raise ValidationError('field "{}" must be a dict'.format(self.name))
 
 
 class EmailField(CharField):
-    def _validate(self, val):
-        super(EmailField, self)._validate(val)
-        if val is None:
-            return
-        elif '@' not in val:
+    def _check(self, val):
+        if '@' not in val:
             raise ValidationError('field "{}" must be a valid email addr'.format(self.name))
 
 
@@ -81,17 +147,13 @@ class PhoneField(Field):
     STRLEN = 11
     FIRST_CHAR = '7'
 
-    def __set__(self, obj, val):
-        self._validate(val)
-        obj.__dict__[self.name] = str(val) if val else None
-
-    def _validate(self, val):
-        super(PhoneField, self)._validate(val)
-        if val is None:
-            return
+    def to_python(self, val):
+        return str(val) if val else None
 
+    def _check(self, val):
         err = 'field "{}" must be an integer or string, 11 chars len starting with 7'.format(self.name)
-        if not isinstance(val, (int, basestring)):
+        # json decoders may return long for big numbers
+        if not isinstance(val, (int, long, basestring)):
             raise ValidationError(err)
 
         val = str(val)
@@ -104,19 +166,14 @@ class PhoneField(Field):
 
 
 class DateField(CharField):
-    def __set__(self, obj, val):
-        self._validate(val)
-        obj.__dict__[self.name] = self._parse_date(val)
+    def to_python(self, val):
+        return self._parse_date(val)
 
     def _parse_date(self, val):
         if val:
-            return datetime.datetime.strptime(val, DATE_FMT)
-
-    def _validate(self, val):
-        super(DateField, self)._validate(val)
-        if val is None:
-            return
+            return parse_date(val)
 
+    def _check(self, val):
         try:
             self._parse_date(val)
         except ValueError:
@@ -126,22 +183,14 @@ class DateField(CharField):
 class BirthDayField(DateField):
     MAX_AGE = 70
 
-    def _validate(self, val):
-        super(BirthDayField, self)._validate(val)
-        if val is None:
-            return
-
-        birth_dt = datetime.datetime.strptime(val, DATE_FMT)
-        if datetime.date.today().year - birth_dt.year > self.MAX_AGE:
+    def _check(self, val):
+        birth_dt = self._parse_date(val)
+        if birth_dt is not None and today().year - birth_dt.year > self.MAX_AGE:
             raise ValidationError('age more than {} years in field "{}"'.format(self.MAX_AGE, self.name))
 
 
 class GenderField(Field):
-    def _validate(self, val):
-        super(GenderField, self)._validate(val)
-        if val is None:
-            return
-
+    def _check(self, val):
         possible_values = sorted(GENDERS.keys())
         err = 'field "{}" must be an integer, one of {}'.format(
             self.name,
@@ -153,15 +202,11 @@ class GenderField(Field):
 
 
 class ClientIDsField(Field):
-    def _validate(self, val):
-        super(ClientIDsField, self)._validate(val)
-        if val is None:
-            return
-
+    def _check(self, val):
         err = 'field "{}" must be a list of non-negative integers'.format(self.name)
         if not isinstance(val, list) or not val:
             raise ValidationError(err)
 
         for id_ in val:
-            if not isinstance(id_, int) or id_ < 0:
+            if not isinstance(id_, (int, long)) or id_ < 0:
                 raise ValidationError(err)
@@ -0,0 +1,228 @@
+"""storage formats of client interests
+
+interests of client are kept in "i:<cid>" key either as json list of names or in
+compact format: COMPACT_MARKER byte followed by 2 byte ids of names in the shared
+dictionary. dictionary is a redis list of names, id of name is its index, so names are
+decoded once per process and shared by all the decoded lists. decode reads both
+formats, keys can be migrated while the api is running
+
+python src/interests_format.py import [-f compact] interests.jsonl ...
+python src/interests_format.py migrate [-f compact]
+
+lines of imported files are {"cid": 1, "interests": ["cars", "pets"]} objects
+"""
+import sys
+import json
+import time
+import array
+import logging
+import threading
+from optparse import OptionParser
+
+from storage import Storage, parse_nodes
+
+JSON_FORMAT = 'json'
+COMPACT_FORMAT = 'compact'
+FORMATS = [JSON_FORMAT, COMPACT_FORMAT]
+COMPACT_MARKER = '\x01'
+KEY_PREFIX = 'i:'
+DICTIONARY_KEY = 'interests:names'
+MAX_NAMES = 2 ** 16
+# keys written in one pipeline
+BATCH_SIZE = 1000
+
+
+class InterestsDictionary(object):
+    """in-process copy of the shared append-only dictionary of interest names
+
+    names are loaded at startup. lookup of unknown id loads the added names, with
+    `background_load` they are loaded in another thread and the lookup fails, so
+    an event loop is never blocked by storage calls
+    """
+
+    def __init__(self, store, key=DICTIONARY_KEY, background_load=False):
+        self.store = store
+        self.key = key
+        self.background_load = background_load
+        self.names = []
+        self.ids = {}
+        self._lock = threading.Lock()
+        self._loader = None
+
+    def load(self):
+        """fetches names added since the last load"""
+        with self._lock:
+            added = self.store.get_list(self.key, len(self.names))
+            if not added:
+                return
+            names = self.names + [name.decode('utf-8') for name in added]
+            ids = dict(self.ids)
+            for i in range(len(self.names), len(names)):
+                ids[names[i]] = i
+            # readers see either the old or the new names
+            self.names, self.ids = names, ids
+
+    def load_in_background(self):
+        """starts load in a thread if it is not running yet"""
+        with self._lock:
+            if self._loader is not None and self._loader.is_alive():
+                return
+            self._loader = threading.Thread(target=self._load_logged, name='interests-dictionary-loader')
+            self._loader.daemon = True
+            self._loader.start()
+
+    def _load_logged(self):
+        try:
+            self.load()
+        except Exception:
+            logging.exception('failed to load interests dictionary')
+
+    def lookup(self, ids):
+        """names of the ids"""
+        try:
+            return [self.names[i] for i in ids]
+        except IndexError:
+            # names were added after the last load
+            if self.background_load:
+                self.load_in_background()
+                raise ValueError('unknown interest id, dictionary is being loaded')
+            self.load()
+        names = self.names
+        try:
+            return [names[i] for i in ids]
+        except IndexError:
+            raise ValueError('unknown interest id, dictionary has {} names'.format(len(names)))
+
+    def get_ids(self, names):
+        """ids of the names, missing ones are added to the shared dictionary"""
+        names = [name if isinstance(name, unicode) else name.decode('utf-8') for name in names]
+        missing = [name for name in set(names) if name not in self.ids]
+        while missing:
+            if len(self.names) + len(missing) > MAX_NAMES:
+                raise ValueError('dictionary is limited to {} names'.format(MAX_NAMES))
+            # fails if the dictionary was changed by another writer since the last load
+            self.store.append_list(self.key, [name.encode('utf-8') for name in missing], len(self.names))
+            self.load()
+            missing = [name for name in missing if name not in self.ids]
+        return [self.ids[name] for name in names]
+
+
+def encode(interests, format=JSON_FORMAT, dictionary=None):
+    if format == JSON_FORMAT:
+        return json.dumps(interests)
+    ids = array.array('H', dictionary.get_ids(interests))
+    if sys.byteorder != 'little':
+        ids.byteswap()
+    return COMPACT_MARKER + ids.tostring()
+
+
+def decode(raw, dictionary=None):
+    """interests of value in any format, empty list for missing value"""
+    if not raw:
+        return []
+    if raw[0] != COMPACT_MARKER:
+        return json.loads(raw)
+    if dictionary is None:
+        raise ValueError('dictionary is required to decode compact interests')
+    ids = array.array('H')
+    ids.fromstring(raw[1:])
+    if sys.byteorder != 'little':
+        ids.byteswap()
+    return dictionary.lookup(ids)
+
+
+def is_encoded(raw, format):
+    return (raw[:1] == COMPACT_MARKER) == (format == COMPACT_FORMAT)
+
+
+class Progress(object):
+    def __init__(self, action, every=10):
+        self.action = action
+        self.every = every
+        self.started = self._reported = time.time()
+        self.read = self.written = 0
+
+    def update(self, read, written, force=False):
+        self.read += read
+        self.written += written
+        now = time.time()
+        if force or now - self._reported >= self.every:
+            self._reported = now
+            elapsed = now - self.started
+            logging.info('%s %s of %s keys in %.1f s, %.0f keys/s', self.action, self.written, self.read,
+                         elapsed, self.read / elapsed if elapsed else 0)
+
+
+def iter_records(paths):
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record['cid'], record['interests']
+
+
+def import_records(store, records, format=JSON_FORMAT, dictionary=None, batch_size=BATCH_SIZE):
+    """writes (cid, interests) records in batches, returns number of written keys"""
+    progress = Progress('imported')
+    batch = []
+    for cid, interests in records:
+        batch.append((KEY_PREFIX + str(cid), encode(interests, format, dictionary)))
+        if len(batch) >= batch_size:
+            store.set_many(batch)
+            progress.update(len(batch), len(batch))
+            batch = []
+    if batch:
+        store.set_many(batch)
+    progress.update(len(batch), len(batch), force=True)
+    return progress.written
+
+
+def migrate(store, format=JSON_FORMAT, dictionary=None, batch_size=BATCH_SIZE):
+    """re-encodes all interests keys to the format, returns number of rewritten keys"""
+    progress = Progress('migrated')
+    cursor = None
+    while cursor != 0:
+        cursor, keys = store.scan(cursor or 0, match=KEY_PREFIX + '*', count=batch_size)
+        values = store.get_many(keys) if keys else []
+        batch = [(key, encode(decode(raw, dictionary), format, dictionary))
+                 for key, raw in zip(keys, values) if raw is not None and not is_encoded(raw, format)]
+        if batch:
+            store.set_many(batch)
+        progress.update(len(keys), len(batch))
+    progress.update(0, 0, force=True)
+    return progress.written
+
+
+def main():
+    op = OptionParser(usage='%prog import [options] interests.jsonl ...\n       %prog migrate [options]')
+    op.add_option('-f', '--format', action='store', type='choice', choices=FORMATS, default=COMPACT_FORMAT)
+    op.add_option('-b', '--batch-size', action='store', type=int, default=BATCH_SIZE,
+                  help='keys written in one pipeline')
+    op.add_option('--redis-nodes', action='store', default=None,
+                  help='comma separated host:port list of redis shards, overrides --redis-host and --redis-port')
+    op.add_option('--redis-host', action='store', default='localhost')
+    op.add_option('--redis-port', action='store', type=int, default=6379)
+    (opts, args) = op.parse_args()
+    try:
+        nodes = parse_nodes(opts.redis_nodes) if opts.redis_nodes else None
+    except ValueError as e:
+        op.error(str(e))
+    if not args or args[0] not in ('import', 'migrate'):
+        op.error('command must be import or migrate')
+    if args[0] == 'import' and len(args) < 2:
+        op.error('at least one file to import is required')
+
+    logging.basicConfig(format='[%(asctime)s] %(levelname).1s %(message)s', level=logging.INFO,
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    store = Storage(pool_size=1, nodes=nodes, host=opts.redis_host, port=opts.redis_port)
+    dictionary = InterestsDictionary(store)
+    dictionary.load()
+    if args[0] == 'import':
+        import_records(store, iter_records(args[1:]), opts.format, dictionary, opts.batch_size)
+    else:
+        migrate(store, opts.format, dictionary, opts.batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""in-process counters and histograms exposed in prometheus text format
+
+every thread records into its own shard, so the request path doesn't take locks.
+shards are merged on collection, shards of finished threads are folded into the base one
+"""
+import time
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+# shards count which triggers folding of finished threads shards on new thread
+COMPACT_SHARDS = 64
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+class StageTimer(dict):
+    """durations of consecutive request stages in seconds
+
+    each stage lasts since the previous mark, so stages don't overlap
+    """
+
+    def __init__(self):
+        super(StageTimer, self).__init__()
+        self._last = time.time()
+
+    def mark(self, stage):
+        now = time.time()
+        self[stage] = self.get(stage, 0) + now - self._last
+        self._last = now
+
+
+class _Shard(object):
+    def __init__(self, thread):
+        self.thread = thread
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [count per bucket..., count above buckets, sum]
+
+
+def _merge(dst, src):
+    # items() and list() copies are atomic, the owner thread may write concurrently
+    for key, value in src.counters.items():
+        dst.counters[key] = dst.counters.get(key, 0) + value
+    for key, values in src.histograms.items():
+        values = list(values)
+        acc = dst.histograms.get(key)
+        if acc is None:
+            dst.histograms[key] = values
+        else:
+            for i, value in enumerate(values):
+                acc[i] += value
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._base = _Shard(None)
+        self._shards = []
+        self._compact_at = COMPACT_SHARDS
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def add_collector(self, func):
+        """func returns (name, type, help, value) samples, it is called on each render"""
+        self.collectors.append(func)
+
+    def shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            pass
+
+        shard = self._local.shard = _Shard(threading.current_thread())
+        with self._lock:
+            self._shards.append(shard)
+            # threaded server runs thread per connection, keep shards list bounded
+            if len(self._shards) >= self._compact_at:
+                self._compact()
+                self._compact_at = max(COMPACT_SHARDS, 2 * len(self._shards))
+        return shard
+
+    def _compact(self):
+        alive = []
+        for shard in self._shards:
+            if shard.thread.is_alive():
+                alive.append(shard)
+            else:
+                _merge(self._base, shard)
+        self._shards = alive
+
+    def snapshot(self):
+        """merged values of all shards"""
+        total = _Shard(None)
+        with self._lock:
+            self._compact()
+            for shard in [self._base] + self._shards:
+                _merge(total, shard)
+        return total
+
+    def render(self):
+        snapshot = self.snapshot()
+        counters, histograms = {}, {}
+        for (name, labels), value in snapshot.counters.iteritems():
+            counters.setdefault(name, []).append((labels, value))
+        for (name, labels), values in snapshot.histograms.iteritems():
+            histograms.setdefault(name, []).append((labels, values))
+
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            samples = (counters if metric.type == Counter.type else histograms).get(metric.name, [])
+            for labels, value in sorted(samples):
+                metric.render(labels, value, lines)
+
+        for collector in self.collectors:
+            for name, type_, documentation, value in collector():
+                lines.append('# HELP %s %s' % (name, documentation))
+                lines.append('# TYPE %s %s' % (name, type_))
+                lines.append('%s %s' % (name, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in zip(names, values))
+
+
+def _format_value(value):
+    return repr(float(value))
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._registry = registry
+        registry.register(self)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, labels=(), value=1):
+        counters = self._registry.shard().counters
+        key = (self.name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def render(self, labels, value, lines):
+        lines.append('%s%s %s' % (self.name, _format_labels(self.labelnames, labels), _format_value(value)))
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        histograms = self._registry.shard().histograms
+        key = (self.name, labels)
+        values = histograms.get(key)
+        if values is None:
+            values = histograms[key] = [0] * (len(self.buckets) + 2)
+        # buckets bounds are inclusive
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def render(self, labels, values, lines):
+        names = self.labelnames + ('le',)
+        count = 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), values):
+            count += bucket_count
+            le = bound if bound == '+Inf' else _format_value(bound)
+            lines.append('%s_bucket%s %s' % (self.name, _format_labels(names, labels + (le,)), _format_value(count)))
+        label_str = _format_labels(self.labelnames, labels)
+        lines.append('%s_sum%s %s' % (self.name, label_str, _format_value(values[-1])))
+        lines.append('%s_count%s %s' % (self.name, label_str, _format_value(count)))
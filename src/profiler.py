@@ -0,0 +1,148 @@
+"""cProfile based request profiler
+
+profiles every n-th call and all calls during windows started on demand.
+profiles are merged and dumped to a directory as pstats files along with
+a summary of top functions by cumulative time. dumped files can be merged with
+
+python src/profiler.py [-n 30] [-o merged.pstats] profiles/*.pstats
+"""
+import os
+import time
+import pstats
+import cProfile
+import logging
+import itertools
+import threading
+from optparse import OptionParser
+
+DEFAULT_TOP = 30
+# sampled profiles are merged and dumped in batches,
+# when batch is full or its first profile is older than DUMP_INTERVAL_SEC
+SAMPLES_PER_DUMP = 100
+DUMP_INTERVAL_SEC = 60
+MAX_WINDOW_SEC = 600
+SORT_KEY = 'cumulative'
+
+
+class Profiler(object):
+    def __init__(self, directory, every=0, top=DEFAULT_TOP, samples_per_dump=SAMPLES_PER_DUMP):
+        self.directory = directory
+        self.every = every
+        self.top = top
+        self.samples_per_dump = samples_per_dump
+        self._counter = itertools.count(1)
+        self._dumps = itertools.count(1)
+        self._lock = threading.Lock()
+        self._sampled = None
+        self._nsampled = 0
+        self._sampled_since = 0
+        self._window = None
+        self._nwindow = 0
+        self._window_id = 0
+        self._window_until = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def call(self, func, *args, **kwargs):
+        """runs func, profiling it if the call is sampled or a window is open"""
+        window_id = self._window_until and time.time() < self._window_until and self._window_id
+        if not window_id and not (self.every and next(self._counter) % self.every == 0):
+            return func(*args, **kwargs)
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self._collect(profile, window_id)
+
+    def _collect(self, profile, window_id):
+        stats = pstats.Stats(profile)
+        dump = None
+        with self._lock:
+            if window_id:
+                # calls finished after their window are dropped
+                if window_id == self._window_id and self._window_until:
+                    self._window = _merge(self._window, stats)
+                    self._nwindow += 1
+            else:
+                if self._sampled is None:
+                    self._sampled_since = time.time()
+                self._sampled = _merge(self._sampled, stats)
+                self._nsampled += 1
+                if (self._nsampled >= self.samples_per_dump or
+                        time.time() - self._sampled_since >= DUMP_INTERVAL_SEC):
+                    dump = self._sampled, self._nsampled
+                    self._sampled, self._nsampled = None, 0
+
+        if dump is not None:
+            self._dump('sampled', *dump)
+
+    def start_window(self, seconds):
+        """profile all calls during next `seconds`, returns False if a window is already open"""
+        with self._lock:
+            if self._window_until:
+                return False
+            self._window_id += 1
+            self._window, self._nwindow = None, 0
+            self._window_until = time.time() + seconds
+
+        timer = threading.Timer(seconds, self.finish_window)
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def finish_window(self):
+        with self._lock:
+            stats, ncalls = self._window, self._nwindow
+            self._window, self._nwindow = None, 0
+            self._window_until = 0
+
+        if stats is None:
+            logging.info('no calls were profiled during the window')
+            return
+        self._dump('window', stats, ncalls)
+
+    def flush(self):
+        """dump sampled profiles collected so far"""
+        with self._lock:
+            stats, ncalls = self._sampled, self._nsampled
+            self._sampled, self._nsampled = None, 0
+        if stats is not None:
+            self._dump('sampled', stats, ncalls)
+
+    def _dump(self, kind, stats, ncalls):
+        name = 'profile-{}-{}-{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), os.getpid(), next(self._dumps), kind)
+        path = os.path.join(self.directory, name)
+        stats.dump_stats(path + '.pstats')
+        with open(path + '.txt', 'w') as f:
+            f.write('{} profiled calls\n'.format(ncalls))
+            stats.stream = f
+            stats.sort_stats(SORT_KEY).print_stats(self.top)
+        logging.info('profile of %s calls saved to %s', ncalls, path)
+        return path
+
+
+def _merge(acc, stats):
+    if acc is None:
+        return stats
+    acc.add(stats)
+    return acc
+
+
+def main():
+    op = OptionParser(usage='%prog [options] file.pstats ...')
+    op.add_option('-n', '--top', action='store', type=int, default=DEFAULT_TOP)
+    op.add_option('-s', '--sort', action='store', default=SORT_KEY)
+    op.add_option('-o', '--output', action='store', default=None, help='write merged pstats to the file')
+    (opts, args) = op.parse_args()
+    if not args:
+        op.error('at least one pstats file is required')
+
+    stats = pstats.Stats(*args)
+    stats.sort_stats(opts.sort).print_stats(opts.top)
+    if opts.output:
+        stats.dump_stats(opts.output)
+
+
+if __name__ == '__main__':
+    main()
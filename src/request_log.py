@@ -0,0 +1,200 @@
+"""request logging off the serving thread
+
+AsyncHandler queues records and writes them with the wrapped handler in a background
+thread. RequestLog samples requests and clips logged payloads, so logging cost
+doesn't depend on request and response size
+"""
+import os
+import json
+import random
+import logging
+import itertools
+import threading
+from collections import deque
+
+import metrics
+
+OK = 200
+DEFAULT_SAMPLE_RATE = 1.0
+# logged containers are cut to MAX_ITEMS entries, strings to MAX_STRING chars
+MAX_ITEMS = 20
+MAX_STRING = 256
+MAX_DEPTH = 5
+MAX_QUEUE = 10000
+LOG_FORMAT = '[%(asctime)s] %(levelname).1s %(message)s'
+DATE_FORMAT = '%Y.%m.%d %H:%M:%S'
+
+DROPPED = metrics.Counter('log_records_dropped_total', 'log records dropped because of full queue')
+
+
+def clip(value, max_items=MAX_ITEMS, max_string=MAX_STRING, depth=MAX_DEPTH):
+    """copy of value with containers and strings cut to the limits"""
+    if isinstance(value, basestring):
+        return value if len(value) <= max_string else value[:max_string] + '...'
+    if isinstance(value, (dict, list, tuple)):
+        if depth <= 0:
+            return '...'
+        if isinstance(value, dict):
+            result = {k: clip(v, max_items, max_string, depth - 1)
+                      for k, v in itertools.islice(value.iteritems(), max_items)}
+            if len(value) > max_items:
+                result['...'] = '{} more'.format(len(value) - max_items)
+        else:
+            result = [clip(v, max_items, max_string, depth - 1) for v in value[:max_items]]
+            if len(value) > max_items:
+                result.append('... {} more'.format(len(value) - max_items))
+        return result
+    return value
+
+
+class LogEntry(object):
+    """log message of structured fields, serialized when the record is formatted"""
+    __slots__ = ('fields',)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return json.dumps(self.fields, default=repr)
+
+
+class JSONFormatter(logging.Formatter):
+    """formats records as one-line json objects"""
+
+    def format(self, record):
+        fields = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+        }
+        if isinstance(record.msg, LogEntry):
+            fields.update(record.msg.fields)
+        else:
+            fields['message'] = record.getMessage()
+        if record.exc_info:
+            fields['exc'] = self.formatException(record.exc_info)
+        return json.dumps(fields, default=repr)
+
+
+class AsyncHandler(logging.Handler):
+    """passes records to `target` handler in a background thread
+
+    records are dropped when more than `max_queue` of them are waiting
+    """
+    FLUSH_INTERVAL_SEC = 0.05
+
+    def __init__(self, target, max_queue=MAX_QUEUE):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.max_queue = max_queue
+        self._queue = deque()
+        self._stopped = threading.Event()
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._start()
+
+    def createLock(self):
+        # deque operations are thread-safe, emit needs no lock
+        self.lock = None
+
+    def setFormatter(self, fmt):
+        # records are formatted by the target in the writer thread
+        self.target.setFormatter(fmt)
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                # forked child, queued records are written by the parent
+                self._queue.clear()
+                self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='log-writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def emit(self, record):
+        if self._stopped.is_set():
+            return
+        if not self._thread.is_alive():
+            # writer thread doesn't survive fork
+            self._start()
+        if len(self._queue) >= self.max_queue:
+            DROPPED.inc()
+            return
+        self._queue.append(record)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._drain()
+            self._stopped.wait(self.FLUSH_INTERVAL_SEC)
+        self._drain()
+
+    def _drain(self):
+        queue = self._queue
+        while queue:
+            try:
+                record = queue.popleft()
+            except IndexError:
+                # drained concurrently by flush
+                return
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.handleError(record)
+
+    def flush(self):
+        self._drain()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.target.close()
+        logging.Handler.close(self)
+
+
+class RequestLog(object):
+    """one structured log line per sampled request, errors are always logged"""
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE, max_items=MAX_ITEMS, max_string=MAX_STRING,
+                 logger=None):
+        self.sample_rate = sample_rate
+        self.max_items = max_items
+        self.max_string = max_string
+        self.logger = logger or logging.getLogger('request')
+
+    def sampled(self, code):
+        return code != OK or self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def log(self, path, request, context, raw_body=None):
+        """context holds request_id, response code and handler fields"""
+        if not self.sampled(context.get('code')):
+            return
+
+        fields = clip(context, self.max_items, self.max_string)
+        fields['path'] = path
+        fields['request'] = clip(request, self.max_items, self.max_string)
+        if request is None and raw_body:
+            # body which couldn't be decoded
+            raw = raw_body[:self.max_string]
+            if isinstance(raw, memoryview):
+                raw = raw.tobytes()
+            fields['body'] = raw.decode('utf-8', 'replace')
+        self.logger.info(LogEntry(fields))
+
+
+def setup_logging(filename=None, json_format=True, async_=True, max_queue=MAX_QUEUE):
+    handler = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    if json_format:
+        handler.setFormatter(JSONFormatter(datefmt=DATE_FORMAT))
+    else:
+        handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT))
+    if async_:
+        handler = AsyncHandler(handler, max_queue)
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(handler)
+    return handler
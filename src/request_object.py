@@ -1,3 +1,5 @@
+import collections
+
 from field import (
     ValidationError,
     Field,
@@ -11,57 +13,183 @@ from field import (
     PhoneField
 )
 
+# field values are kept in slots with this prefix, request objects have no __dict__
+SLOT_PREFIX = '_field_'
+# errors of valid request, shared to not allocate a list per request
+NO_ERRORS = ()
+
+
+def compile_set_fields(fields):
+    """build function validating and assigning fields of request object
+
+    it does the same as assignment through descriptors, but checks of every field
+    are called in a flat sequence without descriptor and super() calls
+    """
+    namespace = {'ValidationError': ValidationError}
+    lines = ['def _set_fields(self, data):']
+    for i, field in enumerate(fields):
+        name = repr(field.name)
+        slot = 'self.' + SLOT_PREFIX + field.name
+        namespace['required_error_%d' % i] = 'field "{}" is required'.format(field.name)
+        namespace['null_error_%d' % i] = field.null_error
+        checks = []
+        for j, check in enumerate(field.checks):
+            namespace['check_%d_%d' % (i, j)] = check
+            checks.append('check_%d_%d(val)' % (i, j))
+        if type(field).to_python.im_func is not Field.to_python.im_func:
+            namespace['to_python_%d' % i] = field.to_python
+            assignment = '%s = to_python_%d(val)' % (slot, i)
+        else:
+            assignment = '%s = val' % slot
+
+        indent = '    '
+        if field.required:
+            lines += [
+                '    if %s not in data:' % name,
+                '        %s = None' % slot,
+                '        self._add_error(required_error_%d)' % i,
+                '    else:',
+            ]
+            indent = '        '
+        lines += [indent + line for line in [
+            'val = data.get(%s)' % name,
+            'if val is None:',
+            '    %s = None' % slot,
+        ] + ([] if field.nullable else [
+            '    self._add_error(null_error_%d)' % i,
+        ]) + [
+            'else:',
+            '    try:',
+        ] + ['        ' + check for check in checks] + [
+            '        ' + assignment,
+            '    except ValidationError as e:',
+            '        %s = None' % slot,
+            '        self._add_error(str(e))',
+        ]]
+
+    lines.append('    pass')
+    exec '\n'.join(lines) in namespace
+    return namespace['_set_fields']
+
 
 class FieldInitializerMetaclass(type):
-    """metaclass for fields names initialization"""
+    """metaclass for fields names initialization, slots of values and fields setter compilation"""
+
+    def __new__(mcs, name, bases, dct):
+        # fields order defines errors order, keep the order of the class dict without slots:
+        # a copy of dct with __doc__ and _fields added. slots keys reorder the dict
+        class_dict = dict(dct)
+        class_dict.setdefault('__doc__', None)
+        class_dict['_fields'] = None
+        field_names = tuple(field_name for field_name, value in class_dict.items() if isinstance(value, Field))
+        dct['__slots__'] = tuple(dct.get('__slots__', ())) + tuple(SLOT_PREFIX + n for n in field_names)
+        cls = type.__new__(mcs, name, bases, dct)
+        cls._field_names = field_names
+        return cls
 
     def __init__(cls, name, bases, dct):
         cls._fields = []
 
-        for field_name, field in cls.__dict__.items():
-            if not isinstance(field, Field):
-                continue
-
+        for field_name in cls._field_names:
+            field = cls.__dict__[field_name]
             field.name = field_name
+            field.slot = cls.__dict__[SLOT_PREFIX + field_name]
             cls._fields.append(field)
 
+        cls._fields_by_name = {field.name: field for field in cls._fields}
+        # bit mask of not None fields -> tuple of their names
+        cls._initialized_names = {}
+
+        if '_set_fields' not in dct:
+            cls._set_fields = compile_set_fields(cls._fields)
+
+
+class FieldsView(collections.Mapping):
+    """read-only mapping of field names to values, reads request object on access"""
+    __slots__ = ('_obj',)
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __getitem__(self, name):
+        return self._obj._fields_by_name[name].__get__(self._obj, None)
+
+    def __iter__(self):
+        return iter(self._obj._field_names)
+
+    def __len__(self):
+        return len(self._obj._field_names)
+
+    def __contains__(self, name):
+        return name in self._obj._fields_by_name
+
+    def keys(self):
+        # used by ** unpacking, the names tuple is shared by requests of the class
+        return self._obj._field_names
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self))
+
 
 class RequestObject(object):
     __metaclass__ = FieldInitializerMetaclass
+    __slots__ = ('_errors',)
 
     def __init__(self, data):
-        self._errors = []
+        self._errors = NO_ERRORS
         if not isinstance(data, dict):
-            self._errors.append('data must be a dict')
+            self._add_error('data must be a dict')
             return
 
+        self._set_fields(data)
+
+        try:
+            self._validate()
+        except ValidationError as e:
+            self._add_error(str(e))
+
+    def _add_error(self, error):
+        if self._errors is NO_ERRORS:
+            self._errors = []
+        self._errors.append(error)
+
+    def _set_fields_with_descriptors(self, data):
+        """reference implementation of compiled _set_fields"""
         for field in self._fields:
             if field.required and field.name not in data:
-                self._errors.append('field "{}" is required'.format(field.name))
+                self._add_error('field "{}" is required'.format(field.name))
                 continue
 
             try:
                 setattr(self, field.name, data.get(field.name))
             except ValidationError as e:
-                self._errors.append(str(e))
-
-        try:
-            self._validate()
-        except ValidationError as e:
-            self._errors.append(str(e))
+                self._add_error(str(e))
 
     def _validate(self):
         """any additional fields validation should be done here"""
 
     def get_validation_errors(self):
+        if self._errors is NO_ERRORS:
+            return []
         return self._errors
 
     def asdict(self):
-        data = {}
-        for field in self._fields:
-            data[field.name] = getattr(self, field.name)
-
-        return data
+        """view of field values, it is not a copy and follows changes of the object"""
+        return FieldsView(self)
+
+    def _get_initialized_names(self):
+        """names of not None fields, the tuple is shared by requests with the same fields set"""
+        mask = 0
+        for bit, field in enumerate(self._fields):
+            if field.__get__(self, None) is not None:
+                mask |= 1 << bit
+        try:
+            return self._initialized_names[mask]
+        except KeyError:
+            names = tuple(field.name for bit, field in enumerate(self._fields) if mask & 1 << bit)
+            # at most 2 ** fields count entries
+            self._initialized_names[mask] = names
+            return names
 
 
 class ClientsInterestsRequest(RequestObject):
@@ -95,7 +223,7 @@ class OnlineScoreRequest(RequestObject):
         if self.get_validation_errors():
             raise RuntimeError('can\'t get nclients from invalid request object')
 
-        return [field.name for field in self._fields if getattr(self, field.name) is not None]
+        return self._get_initialized_names()
 
     def _validate(self):
         for field_a, field_b in self.REQUIRED_PAIRS:
@@ -1,20 +1,32 @@
 import hashlib
-import json
+import itertools
 
+import interests_format
+import serializers
+from cache import SingleFlight
 
-def get_score(store, phone=None, email=None, birthday=None, gender=None, first_name=None, last_name=None):
+# cache for 60 minutes
+SCORE_CACHE_TTL_SEC = 60 * 60
+# clients fetched at once when interests are streamed
+INTERESTS_CHUNK_SIZE = 500
+
+_score_flights = SingleFlight()
+# interests_format.InterestsDictionary to decode compact interests values
+interests_dictionary = None
+
+
+def get_score_key(phone=None, birthday=None, first_name=None, last_name=None, **kwargs):
     key_parts = [
         first_name or "",
         last_name or "",
         phone or "",
         birthday.strftime("%Y%m%d") if birthday is not None else "",
     ]
-    key = "uid:" + hashlib.md5("".join(key_parts).encode('utf-8')).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
-    if score:
-        return score
+    return "uid:" + hashlib.md5("".join(key_parts).encode('utf-8')).hexdigest()
+
+
+def compute_score(phone=None, email=None, birthday=None, gender=None, first_name=None, last_name=None):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -23,11 +35,58 @@ def get_score(store, phone=None, email=None, birthday=None, gender=None, first_n
         score += 1.5
     if first_name and last_name:
         score += 0.5
-    # cache for 60 minutes
-    store.cache_set(key, score, 60 * 60)
     return score
 
 
+def _compute_and_cache_score(store, key, **kwargs):
+    score = compute_score(**kwargs)
+    store.cache_set(key, score, SCORE_CACHE_TTL_SEC)
+    return score
+
+
+def get_score(store, phone=None, email=None, birthday=None, gender=None, first_name=None, last_name=None):
+    kwargs = dict(phone=phone, email=email, birthday=birthday, gender=gender,
+                  first_name=first_name, last_name=last_name)
+    key = get_score_key(**kwargs)
+    # try get from cache,
+    # fallback to heavy calculation in case of cache miss
+    score = store.cache_get(key)
+    if score is not None:
+        return score
+    # concurrent requests for the same key wait for the first one instead of computing score again
+    return _score_flights.do(key, _compute_and_cache_score, store, key, **kwargs)
+
+
+def decode_interests(raw):
+    return interests_format.decode(raw, interests_dictionary)
+
+
 def get_interests(store, cid):
-    r = store.get("i:%s" % cid)
-    return json.loads(r) if r else []
+    return decode_interests(store.get("i:%s" % cid))
+
+
+def get_interests_many(store, cids):
+    values = store.get_many(["i:%s" % cid for cid in cids])
+    return {cid: decode_interests(r) for cid, r in zip(cids, values)}
+
+
+def _iter_interests_chunks(store, cids, chunk_size, timings=None):
+    for i in range(0, len(cids), chunk_size):
+        chunk = cids[i:i + chunk_size]
+        values = store.get_many(["i:%s" % cid for cid in chunk])
+        if timings is not None:
+            timings.mark('storage')
+        yield [(cid, decode_interests(r)) for cid, r in zip(chunk, values)]
+
+
+def stream_interests(store, cids, chunk_size=None, timings=None):
+    """interests of get_interests_many as serializers.StreamedMap fetched chunk by chunk
+
+    the first chunk is fetched right away, so storage errors are raised before
+    anything is sent. clients come in the order of get_interests_many result dict
+    """
+    # dict with the same keys inserted in the same order iterates in the same order
+    cids = list({cid: None for cid in cids})
+    chunks = _iter_interests_chunks(store, cids, chunk_size or INTERESTS_CHUNK_SIZE, timings)
+    first = next(chunks, [])
+    return serializers.StreamedMap(len(cids), itertools.chain([first], chunks))
@@ -0,0 +1,174 @@
+"""request and response body codecs
+
+request codec is chosen by Content-Type, response codec by Accept header.
+json is encoded with ujson when it is installed, msgpack codec is available
+when msgpack is installed. unknown content types are decoded as json.
+large maps can be encoded chunk by chunk with iter_dumps
+"""
+import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+# max number of cached Accept header values
+NEGOTIATION_CACHE_SIZE = 1024
+# marks position of streamed map in the encoded response
+PLACEHOLDER = '__streamed_map__'
+
+
+class JSONCodec(object):
+    content_type = JSON_CONTENT_TYPE
+    binary = False
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def map_header(self, length):
+        return '{'
+
+    def map_item(self, key, value):
+        return self.dumps({key: value})[1:-1]
+
+    @property
+    def map_separator(self):
+        # ", " for json module and "," for ujson
+        return self.dumps([0, 0])[2:-2]
+
+    def map_footer(self):
+        return '}'
+
+
+class UJSONCodec(JSONCodec):
+    def loads(self, data):
+        return ujson.loads(data)
+
+    def dumps(self, obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+
+
+class MsgpackCodec(object):
+    content_type = MSGPACK_CONTENT_TYPE
+    binary = True
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+    def dumps(self, obj):
+        # py2 str is packed as msgpack str, clients get text keys and values
+        return msgpack.packb(obj, use_bin_type=False)
+
+    def map_header(self, length):
+        return msgpack.Packer(use_bin_type=False).pack_map_header(length)
+
+    def map_item(self, key, value):
+        # without one byte header of single item map
+        return self.dumps({key: value})[1:]
+
+    map_separator = ''
+
+    def map_footer(self):
+        return ''
+
+
+JSON = UJSONCodec() if ujson is not None else JSONCodec()
+CODECS = {
+    JSON_CONTENT_TYPE: JSON,
+}
+if msgpack is not None:
+    CODECS[MSGPACK_CONTENT_TYPE] = CODECS['application/x-msgpack'] = MsgpackCodec()
+
+_accepted = {}
+
+
+class StreamedMap(object):
+    """map of `length` items produced by `chunks` iterator of (key, value) pairs lists
+
+    items are consumed once, when the response is encoded
+    """
+
+    def __init__(self, length, chunks):
+        self.length = length
+        self.chunks = chunks
+
+
+def iter_dumps(codec, obj, stream):
+    """encoded `obj` in pieces, PLACEHOLDER value in it is replaced by `stream` items
+
+    joined pieces are equal to codec.dumps of obj with a dict of the same items
+    in place of PLACEHOLDER, if the items come in the order of that dict
+    """
+    prefix, suffix = codec.dumps(obj).split(codec.dumps(PLACEHOLDER), 1)
+    yield prefix + codec.map_header(stream.length)
+
+    separator = codec.map_separator
+    first = True
+    for chunk in stream.chunks:
+        if not chunk:
+            continue
+        piece = separator.join(codec.map_item(key, value) for key, value in chunk)
+        yield piece if first else separator + piece
+        first = False
+    yield codec.map_footer() + suffix
+
+
+def _media_type(value):
+    return value.split(';', 1)[0].strip().lower()
+
+
+def request_codec(content_type):
+    """codec to decode body with, json if content type is not set or unknown"""
+    if not content_type:
+        return JSON
+    return CODECS.get(_media_type(content_type), JSON)
+
+
+def _parse_accept(accept):
+    """media types of Accept header, most preferred first"""
+    types = []
+    for i, item in enumerate(accept.split(',')):
+        parts = item.split(';')
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if quality > 0:
+            # stable sort keeps header order for equal quality
+            types.append((-quality, i, parts[0].strip().lower()))
+    return [media_type for _quality, _position, media_type in sorted(types)]
+
+
+def response_codec(accept, default=JSON):
+    """codec to encode response with, `default` if any type is accepted or none is supported"""
+    if not accept:
+        return default
+    try:
+        media_types = _accepted[accept]
+    except KeyError:
+        media_types = _parse_accept(accept)
+        if len(_accepted) >= NEGOTIATION_CACHE_SIZE:
+            _accepted.clear()
+        _accepted[accept] = media_types
+
+    for media_type in media_types:
+        if media_type in ('*/*', 'application/*'):
+            return default
+        codec = CODECS.get(media_type)
+        if codec is not None:
+            return codec
+    return default
@@ -0,0 +1,195 @@
+import io
+import os
+import time
+import errno
+import ctypes
+import ctypes.util
+import signal
+import socket
+import logging
+import threading
+import multiprocessing
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer
+
+from event_server import EventLoopServer
+
+SINGLE_MODE = 'single'
+THREADED_MODE = 'threaded'
+PREFORK_MODE = 'prefork'
+EVENT_MODE = 'event'
+MODES = [SINGLE_MODE, THREADED_MODE, PREFORK_MODE, EVENT_MODE]
+
+# python2 socket module doesn't export this constant, value is taken from linux headers
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+class SocketReader(io.RawIOBase):
+    """raw socket stream for io.BufferedReader, which can read into given buffers"""
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            try:
+                return self._sock.recv_into(b)
+            except socket.error as e:
+                if e.errno != errno.EINTR:
+                    raise
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """thread-per-connection server"""
+    daemon_threads = True
+
+
+class ReusePortHTTPServer(HTTPServer):
+    """server which can share listening port with other processes"""
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        HTTPServer.server_bind(self)
+
+
+def set_cpu_affinity(cpu):
+    """pin current process to a single cpu"""
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {cpu})
+        return
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    mask = ctypes.c_ulong(1 << cpu)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+class Terminated(Exception):
+    pass
+
+
+def _terminate(signum, frame):
+    raise Terminated()
+
+
+def run_server(server):
+    if isinstance(threading.current_thread(), threading._MainThread):
+        # stop gracefully, so queued log records are written
+        signal.signal(signal.SIGTERM, _terminate)
+    try:
+        server.serve_forever()
+    except Terminated:
+        logging.info("server is terminated")
+    except KeyboardInterrupt:
+        logging.error("server execution was interrupted")
+    except Exception:
+        logging.exception("exception in server")
+
+    logging.info("stopping server")
+    server.server_close()
+
+
+class PreforkSupervisor(object):
+    """starts worker processes listening on the same port and restarts them on death"""
+    # don't restart worker more often than once per this interval,
+    # otherwise broken worker (e.g. port is busy) will spin the supervisor
+    MIN_RESTART_INTERVAL_SEC = 1
+
+    def __init__(self, address, handler_cls, workers, cpu_affinity=False):
+        self.address = address
+        self.handler_cls = handler_cls
+        self.workers = workers
+        self.cpu_affinity = cpu_affinity
+        self._children = {}  # pid -> worker number
+        self._started_at = {}  # worker number -> start timestamp
+        self._stopping = False
+
+    def _spawn(self, worker_n):
+        started_at = self._started_at.get(worker_n)
+        if started_at is not None:
+            delay = self.MIN_RESTART_INTERVAL_SEC - (time.time() - started_at)
+            if delay > 0:
+                time.sleep(delay)
+
+        pid = os.fork()
+        if pid:
+            self._children[pid] = worker_n
+            self._started_at[worker_n] = time.time()
+            logging.info("started worker %s, pid %s", worker_n, pid)
+            return
+
+        # child
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if self.cpu_affinity:
+                set_cpu_affinity(worker_n % multiprocessing.cpu_count())
+            run_server(ReusePortHTTPServer(self.address, self.handler_cls))
+        except Exception:
+            logging.exception("worker %s failed", worker_n)
+            exit_code = 1
+        finally:
+            # os._exit skips atexit handlers, which flush logs
+            logging.shutdown()
+            os._exit(exit_code)
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _kill_children(self):
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+        for pid in self._children:
+            try:
+                os.waitpid(pid, 0)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+        self._children = {}
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        for worker_n in range(self.workers):
+            self._spawn(worker_n)
+
+        try:
+            while not self._stopping:
+                try:
+                    pid, status = os.wait()
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+
+                worker_n = self._children.pop(pid, None)
+                if worker_n is None or self._stopping:
+                    continue
+                logging.error("worker %s (pid %s) died with status %s, restarting", worker_n, pid, status)
+                self._spawn(worker_n)
+        except KeyboardInterrupt:
+            logging.error("server execution was interrupted")
+
+        logging.info("stopping workers")
+        self._kill_children()
+
+
+def serve(address, handler_cls, mode=SINGLE_MODE, workers=None, cpu_affinity=False):
+    if mode == SINGLE_MODE:
+        run_server(HTTPServer(address, handler_cls))
+    elif mode == THREADED_MODE:
+        run_server(ThreadingHTTPServer(address, handler_cls))
+    elif mode == PREFORK_MODE:
+        PreforkSupervisor(address, handler_cls, workers or multiprocessing.cpu_count(), cpu_affinity).run()
+    elif mode == EVENT_MODE:
+        run_server(EventLoopServer(address, handler_cls))
+    else:
+        raise ValueError('unknown server mode "{}", use one of {}'.format(mode, MODES))
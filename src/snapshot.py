@@ -0,0 +1,165 @@
+"""read-only memory-mapped snapshot of storage keys
+
+snapshot is a file with data records followed by an open addressing hash table,
+lookups read the mapped file without network round trips and without loading it
+into the process memory, so prefork workers share its pages
+
+python src/snapshot.py -o interests.snap [--match "i:*"] [--list interests:names] [--redis-port 6379]
+
+lists, like the dictionary of compact interests, are saved as json encoded values
+
+file layout:
+    header: MAGIC, table offset, table slots count, keys count
+    records: key length, value length, key, value
+    table: (key hash, record offset) slots, zero offset marks empty slot
+"""
+import os
+import json
+import mmap
+import struct
+import hashlib
+import logging
+import itertools
+from optparse import OptionParser
+
+import interests_format
+from storage import Storage, parse_nodes
+
+MAGIC = 'KVSNAP01'
+HEADER = struct.Struct('<8sQQQ')
+RECORD = struct.Struct('<HI')
+SLOT = struct.Struct('<QQ')
+# table has at least twice as many slots as keys
+MIN_SLOTS_PER_KEY = 2
+SCAN_COUNT = 1000
+
+
+def key_hash(key):
+    return struct.unpack_from('<Q', hashlib.md5(key).digest())[0]
+
+
+def write_snapshot(path, items):
+    """writes (key, value) items to the snapshot file, returns keys count
+
+    the file is replaced atomically, opened snapshots keep reading the old one
+    """
+    hashes, offsets = [], []
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 0, 0, 0))
+        offset = HEADER.size
+        for key, value in items:
+            f.write(RECORD.pack(len(key), len(value)))
+            f.write(key)
+            f.write(value)
+            hashes.append(key_hash(key))
+            offsets.append(offset)
+            offset += RECORD.size + len(key) + len(value)
+
+        nslots = 1
+        while nslots < MIN_SLOTS_PER_KEY * len(hashes):
+            nslots *= 2
+        table = bytearray(nslots * SLOT.size)
+        mask = nslots - 1
+        for h, record_offset in zip(hashes, offsets):
+            slot = h & mask
+            # linear probing
+            while SLOT.unpack_from(table, slot * SLOT.size)[1]:
+                slot = (slot + 1) & mask
+            SLOT.pack_into(table, slot * SLOT.size, h, record_offset)
+        f.write(table)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, offset, nslots, len(hashes)))
+    os.rename(tmp_path, path)
+    return len(hashes)
+
+
+class SnapshotBackend(object):
+    """read-only backend of the snapshot file, writes are not supported"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._table_offset, self._nslots, self.nkeys = HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            raise ValueError('{} is not a snapshot file'.format(path))
+        self._mask = self._nslots - 1
+
+    def stats(self):
+        return None
+
+    def get(self, key):
+        mm = self._mm
+        h = key_hash(key)
+        slot = h & self._mask
+        while True:
+            slot_hash, offset = SLOT.unpack_from(mm, self._table_offset + slot * SLOT.size)
+            if not offset:
+                return None
+            if slot_hash == h:
+                key_len, value_len = RECORD.unpack_from(mm, offset)
+                start = offset + RECORD.size
+                if mm[start:start + key_len] == key:
+                    return mm[start + key_len:start + key_len + value_len]
+            slot = (slot + 1) & self._mask
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def get_list(self, key, start=0):
+        value = self.get(key)
+        return [item.encode('utf-8') for item in json.loads(value)[start:]] if value is not None else []
+
+    def get_with_ttl(self, key):
+        value = self.get(key)
+        return value, -1 if value is not None else -2
+
+    def close(self):
+        self._mm.close()
+
+
+def iter_storage_items(store, match, count=SCAN_COUNT):
+    cursor = None
+    while cursor != 0:
+        cursor, keys = store.scan(cursor or 0, match=match, count=count)
+        if keys:
+            for key, value in zip(keys, store.get_many(keys)):
+                if value is not None:
+                    yield key, value
+
+
+def iter_storage_lists(store, keys):
+    for key in keys:
+        yield key, json.dumps([item.decode('utf-8') for item in store.get_list(key)])
+
+
+def main():
+    op = OptionParser(usage='%prog -o interests.snap [options]')
+    op.add_option('-o', '--output', action='store', default=None)
+    op.add_option('-m', '--match', action='store', default='i:*', help='pattern of keys to save')
+    op.add_option('-l', '--list', action='append', dest='lists', default=None,
+                  help='list key to save, dictionary of compact interests by default')
+    op.add_option('--redis-nodes', action='store', default=None,
+                  help='comma separated host:port list of redis shards, overrides --redis-host and --redis-port')
+    op.add_option('--redis-host', action='store', default='localhost')
+    op.add_option('--redis-port', action='store', type=int, default=6379)
+    (opts, args) = op.parse_args()
+    try:
+        nodes = parse_nodes(opts.redis_nodes) if opts.redis_nodes else None
+    except ValueError as e:
+        op.error(str(e))
+    if not opts.output:
+        op.error('output file is required')
+
+    logging.basicConfig(format='[%(asctime)s] %(levelname).1s %(message)s', level=logging.INFO,
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    store = Storage(pool_size=1, nodes=nodes, host=opts.redis_host, port=opts.redis_port)
+    lists = opts.lists if opts.lists is not None else [interests_format.DICTIONARY_KEY]
+    items = itertools.chain(iter_storage_lists(store, lists), iter_storage_items(store, opts.match))
+    nkeys = write_snapshot(opts.output, items)
+    logging.info('%s keys saved to %s', nkeys, opts.output)
+
+
+if __name__ == '__main__':
+    main()
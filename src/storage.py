@@ -1,52 +1,452 @@
 import time
 import copy
+import json
+import random
 import functools
 import logging
+import threading
 
-import redis
 from redis.exceptions import ConnectionError
 
+import metrics
+from backends import (  # noqa: F401, deadline is a part of storage api
+    LEAST_OUTSTANDING,
+    RedisBackend,
+    ReplicatedBackend,
+    ShardedBackend,
+    current_deadline,
+    deadline,
+    remaining_time,
+)
+from cache import MISSING
+
+CALL_SECONDS = metrics.Histogram('storage_call_duration_seconds', 'storage call time including retries', ['call'])
+RETRIES = metrics.Counter('storage_retries_total', 'storage call retries', ['call'])
+ERRORS = metrics.Counter('storage_errors_total', 'storage calls failed after all retries', ['call'])
+DEADLINE_EXCEEDED = metrics.Counter('storage_deadline_exceeded_total', 'calls not made because request deadline passed',
+                                    ['call'])
+FALLBACK_READS = metrics.Counter('storage_fallback_reads_total', 'reads served by local backend after failure',
+                                 ['call'])
+REJECTED = metrics.Counter('storage_rejected_total', 'cache calls rejected by open circuit', ['call'])
+CACHE_LOOKUPS = metrics.Counter('cache_lookups_total', 'cache_get calls by result', ['result'])
+CACHE_HIT = ('hit',)
+CACHE_MISS = ('miss',)
+
+
+def _count_lookup(value):
+    CACHE_LOOKUPS.inc(CACHE_HIT if value is not None else CACHE_MISS)
+    return value
+
+
+class DeadlineExceeded(ConnectionError):
+    """storage call was not made, the request deadline had passed"""
+
+
+class CircuitBreaker(object):
+    """tracks storage health
+
+    after `failure_threshold` consecutive failures the circuit opens and calls are
+    rejected. after `reset_timeout` one probe call is let through (half-open state),
+    its result closes or opens the circuit again
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=10):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self._opened_at >= self.reset_timeout:
+                logging.info('circuit is half-open, probing storage')
+                self.state = self.HALF_OPEN
+                return True
+            # open or probe is in flight
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logging.info('circuit is closed')
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logging.warning('circuit is open after %s failures', self._failures)
+                self.state = self.OPEN
+                self._opened_at = time.time()
+
+
+def parse_nodes(value):
+    """(host, port) list of comma separated "host:port" nodes, ValueError if it's malformed"""
+    nodes = []
+    for node in value.split(','):
+        host, _, port = node.strip().rpartition(':')
+        if not host:
+            raise ValueError('node must be host:port, got {!r}'.format(node))
+        nodes.append((host, int(port)))
+    return nodes
+
+
+def encode_cache_value(value):
+    return json.dumps(value)
+
+
+def decode_cache_value(raw):
+    """cache values are stored as json to keep their type"""
+    if raw is None:
+        return None
+    try:
+        return json.loads(raw)
+    except ValueError:
+        # value written bypassing encode_cache_value
+        return raw
+
 
 class Storage(object):
-    RETRY_INTERVAL_SEC = 1
     RETRY_N = 5
+    # delay before n-th retry is random value up to RETRY_INTERVAL_SEC * 2 ** n,
+    # but not more than RETRY_MAX_INTERVAL_SEC
+    RETRY_INTERVAL_SEC = 0.1
+    RETRY_MAX_INTERVAL_SEC = 1
     DEFAULT_REDIS_OPTS = {
         'socket_timeout': 10,
         'socket_connect_timeout': 10,
     }
+    # keys per MGET command, keeps single command reply reasonably small
+    MGET_CHUNK_SIZE = 500
+    DEFAULT_POOL_SIZE = 50
+    # how long to wait for a free connection when the pool is exhausted
+    DEFAULT_POOL_TIMEOUT_SEC = 5
 
-    def __init__(self, **override_redis_kwargs):
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, pool_timeout=DEFAULT_POOL_TIMEOUT_SEC, l1_cache=None,
+                 retries=None, retry_interval=None, retry_max_interval=None, circuit_breaker=None,
+                 backend=None, local=None, local_first=False, nodes=None, replicas=None,
+                 replica_balance=LEAST_OUTSTANDING, **override_redis_kwargs):
         redis_kwargs = copy.deepcopy(self.DEFAULT_REDIS_OPTS)
         redis_kwargs.update(override_redis_kwargs)
+        self.redis_kwargs = redis_kwargs
+        # optional in-process cache in front of cache_get/cache_set
+        self.l1_cache = l1_cache
+        # optional breaker, cache calls fail immediately while it is open
+        self.circuit_breaker = circuit_breaker
+        if retries is not None:
+            self.RETRY_N = retries
+        if retry_interval is not None:
+            self.RETRY_INTERVAL_SEC = retry_interval
+        if retry_max_interval is not None:
+            self.RETRY_MAX_INTERVAL_SEC = retry_max_interval
+
+        # (host, port) of redis shards, host and port of redis_kwargs are used if not set
+        self.nodes = nodes
+        # (host, port) of read replicas of the redis of redis_kwargs
+        self.replicas = replicas
+        if nodes and replicas:
+            raise ValueError('replicas of sharded nodes are not supported')
+        if backend is None and nodes:
+            backend = ShardedBackend(
+                [RedisBackend(pool_size, pool_timeout, **dict(redis_kwargs, host=host, port=port))
+                 for host, port in nodes],
+                ['{}:{}'.format(host, port) for host, port in nodes],
+            )
+        elif backend is None and replicas:
+            backend = ReplicatedBackend(
+                RedisBackend(pool_size, pool_timeout, **redis_kwargs),
+                [RedisBackend(pool_size, pool_timeout, **dict(redis_kwargs, host=host, port=port))
+                 for host, port in replicas],
+                ['{}:{}'.format(host, port) for host, port in replicas],
+                balance=replica_balance,
+            )
+        elif backend is None:
+            backend = RedisBackend(pool_size, pool_timeout, **redis_kwargs)
+        self.backend = backend
+        # optional read-only backend of get/get_many, e.g. snapshot.SnapshotBackend.
+        # it serves reads when the backend fails, or before the backend if local_first is set
+        self.local = local
+        self.local_first = local_first
 
-        self._redis = redis.Redis(**redis_kwargs)
+    def pool_stats(self):
+        """connection pool checkout statistics, useful for pool sizing, None without pool"""
+        return self.backend.stats()
+
+    def _retry_delay(self, attempt):
+        return random.uniform(0, min(self.RETRY_MAX_INTERVAL_SEC, self.RETRY_INTERVAL_SEC * 2 ** attempt))
 
     def _retry(raise_=True):
+        """retry decorator, raise_=False marks cache calls which are allowed to fail"""
         def decorator(f):
+            labels = (f.__name__.lstrip('_'),)
+
             @functools.wraps(f)
             def wrapper(*args, **kwargs):
                 self = args[0]
-                for i in range(self.RETRY_N):
+                remaining = remaining_time()
+                if remaining is not None and remaining <= 0:
+                    # says nothing about storage health, breaker and errors are not updated
+                    logging.warning('deadline exceeded, skip "%s"', f.__name__)
+                    DEADLINE_EXCEEDED.inc(labels)
+                    if raise_:
+                        raise DeadlineExceeded('deadline exceeded before "{}"'.format(f.__name__))
+                    return None
+
+                breaker = self.circuit_breaker
+                if not raise_ and breaker is not None and not breaker.allow():
+                    logging.debug('circuit is open, skip "%s"', f.__name__)
+                    REJECTED.inc(labels)
+                    return None
+
+                started = time.time()
+                attempts = 0
+                while attempts < self.RETRY_N:
+                    remaining = remaining_time()
+                    if attempts and remaining is not None and remaining <= 0:
+                        logging.warning('deadline exceeded, stop retrying "%s"', f.__name__)
+                        break
+
+                    attempts += 1
                     logging.debug('try to %s', f.__name__)
                     try:
-                        return f(*args, **kwargs)
+                        result = f(*args, **kwargs)
                     except Exception as e:
                         logging.warning('catched error "%s", retry "%s"', e, f.__name__)
-                        time.sleep(self.RETRY_INTERVAL_SEC)
+                        if attempts < self.RETRY_N:
+                            RETRIES.inc(labels)
+                            delay = self._retry_delay(attempts - 1)
+                            remaining = remaining_time()
+                            if remaining is not None:
+                                delay = min(delay, max(remaining, 0))
+                            time.sleep(delay)
+                        continue
+
+                    if breaker is not None:
+                        breaker.record_success()
+                    CALL_SECONDS.observe(time.time() - started, labels)
+                    return result
 
+                if breaker is not None:
+                    breaker.record_failure()
+                CALL_SECONDS.observe(time.time() - started, labels)
+                ERRORS.inc(labels)
                 if raise_:
-                    raise ConnectionError('gave up after {} retries'.format(self.RETRY_N))
+                    raise ConnectionError('gave up after {} retries'.format(attempts))
             return wrapper
         return decorator
 
-    @_retry(raise_=False)
+    def l1_stats(self):
+        return self.l1_cache.stats() if self.l1_cache is not None else None
+
+    def collect_metrics(self):
+        """pool and l1 cache state as (name, type, help, value) samples"""
+        samples = []
+        pool = self.pool_stats()
+        if pool is not None:
+            samples.extend([
+                ('redis_pool_checkouts_total', 'counter', 'connections taken from the pool', pool['checkouts']),
+                ('redis_pool_failed_checkouts_total', 'counter', 'failed attempts to take a connection',
+                 pool['failed_checkouts']),
+                ('redis_pool_wait_seconds_total', 'counter', 'time spent waiting for a free connection',
+                 pool['wait_sec_total']),
+                ('redis_pool_wait_seconds_max', 'gauge', 'max time spent waiting for a free connection',
+                 pool['wait_sec_max']),
+                ('redis_pool_in_use', 'gauge', 'connections in use', pool['in_use']),
+                ('redis_pool_max_in_use', 'gauge', 'max connections in use at once', pool['max_in_use']),
+                ('redis_pool_max_connections', 'gauge', 'pool size', pool['max_connections']),
+            ])
+        l1 = self.l1_stats()
+        if l1 is not None:
+            samples.extend([
+                ('l1_cache_hits_total', 'counter', 'l1 cache hits', l1['hits']),
+                ('l1_cache_misses_total', 'counter', 'l1 cache misses', l1['misses']),
+                ('l1_cache_evictions_total', 'counter', 'l1 cache entries evicted by size limits', l1['evictions']),
+                ('l1_cache_expirations_total', 'counter', 'l1 cache entries expired', l1['expirations']),
+                ('l1_cache_entries', 'gauge', 'l1 cache entries', l1['entries']),
+                ('l1_cache_bytes', 'gauge', 'approximate l1 cache size', l1['bytes']),
+            ])
+        return samples
+
     def cache_get(self, key):
-        return self._redis.get(key)
+        if self.l1_cache is None:
+            return _count_lookup(decode_cache_value(self._cache_get(key)))
+
+        value = self.l1_cache.get(key, MISSING)
+        if value is not MISSING:
+            return _count_lookup(value)
+
+        raw, ttl = self._cache_get_with_ttl(key) or (None, None)
+        value = decode_cache_value(raw)
+        if value is not None and ttl > 0:
+            self.l1_cache.set(key, value, ttl)
+        return _count_lookup(value)
+
+    @_retry(raise_=False)
+    def _cache_get(self, key):
+        return self.backend.get(key)
 
     @_retry(raise_=False)
+    def _cache_get_with_ttl(self, key):
+        # remaining ttl is needed to not keep value in l1 longer than in redis
+        return self.backend.get_with_ttl(key)
+
     def cache_set(self, key, value, ttl):
-        self._redis.set(key, value, ex=ttl)
+        if self.l1_cache is not None:
+            self.l1_cache.set(key, value, ttl)
+        self._cache_set(key, value, ttl)
+
+    @_retry(raise_=False)
+    def _cache_set(self, key, value, ttl):
+        self.backend.set(key, encode_cache_value(value), ttl)
+
+    def cache_set_many(self, items):
+        """set (key, value, ttl) items in one pipeline, returns True if they were written"""
+        if self.l1_cache is not None:
+            for key, value, ttl in items:
+                self.l1_cache.set(key, value, ttl)
+        return bool(self._cache_set_many(items))
+
+    @_retry(raise_=False)
+    def _cache_set_many(self, items):
+        self.backend.set_many([(key, encode_cache_value(value), ttl) for key, value, ttl in items])
+        return True
+
+    def get(self, key):
+        if self.local is not None and self.local_first:
+            value = self.local.get(key)
+            if value is not None:
+                return value
+        try:
+            return self._get(key)
+        except ConnectionError:
+            if self.local is None:
+                raise
+            logging.warning('storage failed, reading "%s" from local backend', key)
+            FALLBACK_READS.inc(('get',))
+            return self.local.get(key)
+
+    @_retry(raise_=True)
+    def _get(self, key):
+        return self.backend.get(key)
 
     @_retry(raise_=True)
+    def _mget(self, keys):
+        return self.backend.mget(keys)
+
+    def get_many(self, keys):
+        """values for the keys in the same order, None for missing ones"""
+        if self.local is not None and self.local_first:
+            values = self.local.mget(keys)
+            missing = [i for i, value in enumerate(values) if value is None]
+            if missing:
+                for i, value in zip(missing, self._get_many([keys[i] for i in missing])):
+                    values[i] = value
+            return values
+        return self._get_many(keys)
+
+    def _get_many(self, keys):
+        values = []
+        try:
+            for i in range(0, len(keys), self.MGET_CHUNK_SIZE):
+                values.extend(self._mget(keys[i:i + self.MGET_CHUNK_SIZE]))
+        except ConnectionError:
+            if self.local is None:
+                raise
+            logging.warning('storage failed, reading %s keys from local backend', len(keys))
+            FALLBACK_READS.inc(('get_many',))
+            return self.local.mget(keys)
+        return values
+
+    @_retry(raise_=True)
+    def set_many(self, items):
+        """set (key, value) items without ttl in one pipeline"""
+        self.backend.set_many([(key, value, None) for key, value in items])
+
+    @_retry(raise_=True)
+    def scan(self, cursor=0, match=None, count=None):
+        """one SCAN step, returns next cursor and keys"""
+        return self.backend.scan(cursor, match=match, count=count)
+
+    def get_list(self, key, start=0):
+        try:
+            return self._get_list(key, start)
+        except ConnectionError:
+            if self.local is None:
+                raise
+            logging.warning('storage failed, reading list "%s" from local backend', key)
+            FALLBACK_READS.inc(('get_list',))
+            return self.local.get_list(key, start)
+
+    @_retry(raise_=True)
+    def _get_list(self, key, start=0):
+        return self.backend.get_list(key, start)
+
+    @_retry(raise_=True)
+    def append_list(self, key, values, length):
+        """appends values to the list if it has `length` items, returns False if it doesn't"""
+        return self.backend.append_list(key, values, length)
+
+
+class PrefetchStorage(object):
+    """storage stub which serves values fetched in advance
+
+    keys absent in prefetched values are collected into `missing`, so the caller
+    can fetch them all in one round trip and run the handler again.
+    `cache_missing` holds the ones requested with cache_get.
+    cache writes are buffered into `writes` to be flushed by the caller
+    """
+
+    def __init__(self, l1_cache=None):
+        self.l1_cache = l1_cache
+        self.values = {}
+        self.failed = set()
+        self.missing = set()
+        self.cache_missing = set()
+        self.writes = []
+
+    def reset(self):
+        self.missing = set()
+        self.cache_missing = set()
+        self.writes = []
+
+    def _lookup(self, key):
+        if key not in self.values:
+            self.missing.add(key)
+        return self.values.get(key)
+
+    def cache_get(self, key):
+        if key in self.failed:
+            return _count_lookup(None)
+        if key not in self.values:
+            if self.l1_cache is not None:
+                value = self.l1_cache.get(key, MISSING)
+                if value is not MISSING:
+                    return _count_lookup(value)
+            # not counted as lookup, value is going to be fetched
+            self.cache_missing.add(key)
+            self.missing.add(key)
+            return None
+        return _count_lookup(decode_cache_value(self.values[key]))
+
+    def cache_set(self, key, value, ttl):
+        self.writes.append((key, value, ttl))
+
+    def cache_set_many(self, items):
+        self.writes.extend(items)
+
     def get(self, key):
-        return self._redis.get(key)
+        if key in self.failed:
+            raise ConnectionError('failed to fetch "{}"'.format(key))
+        return self._lookup(key)
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
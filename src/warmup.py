@@ -0,0 +1,158 @@
+"""offline scoring and score cache warm-up
+
+python src/warmup.py users.jsonl ... [-P 4] [-b 1000] [-o scores.jsonl] [--no-cache]
+
+every line is online_score arguments object, like {"phone": "79175002040", "email": "a@b.c"}.
+lines are validated with OnlineScoreRequest and scored by a pool of processes, scores are
+written to the score cache with the keys and ttl of the api, one pipeline per batch
+"""
+import sys
+import json
+import time
+import logging
+import itertools
+import multiprocessing
+from collections import deque
+from optparse import OptionParser
+
+import scoring
+from request_object import OnlineScoreRequest
+from storage import Storage, parse_nodes
+
+BATCH_SIZE = 1000
+# batches queued to the pool, keeps memory bounded on large files
+MAX_PENDING_PER_PROCESS = 4
+REPORT_INTERVAL_SEC = 10
+
+# storage of the worker process
+_store = None
+
+
+def _init_worker(redis_kwargs):
+    global _store
+    _store = Storage(pool_size=1, **redis_kwargs) if redis_kwargs is not None else None
+
+
+def score_line(line):
+    """(key, score) of online_score arguments json, None if they are invalid"""
+    try:
+        arguments = json.loads(line)
+    except ValueError:
+        return None
+    request = OnlineScoreRequest(arguments)
+    if request.get_validation_errors():
+        return None
+    kwargs = request.asdict()
+    return scoring.get_score_key(**kwargs), scoring.compute_score(**kwargs)
+
+
+def score_batch(lines, return_scores=False):
+    """scores batch of lines and writes them to the cache of the process
+
+    returns counts of lines, invalid lines, cached scores and scores if they are requested
+    """
+    scores = [score for score in (score_line(line) for line in lines) if score is not None]
+    cached = 0
+    if _store is not None and scores:
+        items = [(key, score, scoring.SCORE_CACHE_TTL_SEC) for key, score in scores]
+        if _store.cache_set_many(items):
+            cached = len(items)
+    return len(lines), len(lines) - len(scores), cached, scores if return_scores else None
+
+
+def iter_batches(paths, batch_size):
+    for path in paths:
+        with open(path) as f:
+            lines = (line for line in f if line.strip())
+            while True:
+                batch = list(itertools.islice(lines, batch_size))
+                if not batch:
+                    break
+                yield batch
+
+
+class Progress(object):
+    def __init__(self):
+        self.started = self._reported = time.time()
+        self.lines = self.invalid = self.cached = 0
+
+    def update(self, lines, invalid, cached):
+        self.lines += lines
+        self.invalid += invalid
+        self.cached += cached
+        if time.time() - self._reported >= REPORT_INTERVAL_SEC:
+            self.report()
+
+    def report(self):
+        self._reported = time.time()
+        elapsed = self._reported - self.started
+        logging.info('%s lines, %s invalid, %s scores cached in %.1f s, %.0f lines/s', self.lines, self.invalid,
+                     self.cached, elapsed, self.lines / elapsed if elapsed else 0)
+
+
+def run(paths, processes=None, batch_size=BATCH_SIZE, redis_kwargs=None, output=None):
+    """scores lines of the files, scores are cached if redis_kwargs are set and written to output file object"""
+    processes = processes or multiprocessing.cpu_count()
+    progress = Progress()
+    pool = multiprocessing.Pool(processes, _init_worker, (redis_kwargs,))
+    pending = deque()
+
+    def collect(result):
+        lines, invalid, cached, scores = result.get()
+        if output is not None:
+            for key, score in scores:
+                output.write(json.dumps({'key': key, 'score': score}) + '\n')
+        progress.update(lines, invalid, cached)
+
+    try:
+        for batch in iter_batches(paths, batch_size):
+            pending.append(pool.apply_async(score_batch, (batch, output is not None)))
+            if len(pending) >= processes * MAX_PENDING_PER_PROCESS:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    progress.report()
+    return progress
+
+
+def main():
+    op = OptionParser(usage='%prog [options] users.jsonl ...')
+    op.add_option('-P', '--processes', action='store', type=int, default=None,
+                  help='scoring processes, cpu count by default')
+    op.add_option('-b', '--batch-size', action='store', type=int, default=BATCH_SIZE,
+                  help='lines scored and written to the cache at once')
+    op.add_option('-o', '--output', action='store', default=None, help='write scores to jsonl file')
+    op.add_option('--no-cache', action='store_false', dest='cache', default=True,
+                  help='don\'t write scores to the cache')
+    op.add_option('--redis-nodes', action='store', default=None,
+                  help='comma separated host:port list of redis shards, overrides --redis-host and --redis-port')
+    op.add_option('--redis-host', action='store', default='localhost')
+    op.add_option('--redis-port', action='store', type=int, default=6379)
+    (opts, args) = op.parse_args()
+    try:
+        nodes = parse_nodes(opts.redis_nodes) if opts.redis_nodes else None
+    except ValueError as e:
+        op.error(str(e))
+    if not args:
+        op.error('at least one file is required')
+
+    logging.basicConfig(format='[%(asctime)s] %(levelname).1s %(message)s', level=logging.INFO,
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    redis_kwargs = {'nodes': nodes, 'host': opts.redis_host, 'port': opts.redis_port} if opts.cache else None
+    output = open(opts.output, 'w') if opts.output else None
+    try:
+        progress = run(args, opts.processes, opts.batch_size, redis_kwargs, output)
+    finally:
+        if output is not None:
+            output.close()
+    if opts.cache and progress.cached < progress.lines - progress.invalid:
+        logging.error('%s scores were not cached', progress.lines - progress.invalid - progress.cached)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,9 @@ import unittest
 import mock
 from redis.exceptions import ConnectionError
 
-from storage import Storage
-from utils import patch_redis, start_redis, stop_redis
+from cache import LRUCache
+from storage import CircuitBreaker, DeadlineExceeded, Storage, deadline
+from utils import cases, patch_redis, start_redis, stop_redis
 
 
 class TestStorageOffline(unittest.TestCase):
@@ -36,6 +37,125 @@ class TestStorageOffline(unittest.TestCase):
 
         self.assertEqual(mock_r.get.call_count, 5)
 
+    def test_deadline_limits_retry_delay(self):
+        mock_r = mock.Mock()
+        mock_r.get.side_effect = ConnectionError()
+        with patch_redis(mock_r), \
+                mock.patch('time.sleep') as mock_sleep, \
+                self.assertRaisesRegexp(ConnectionError, "gave up"):
+            storage = Storage(retries=2, retry_interval=10, retry_max_interval=10)
+            with deadline(0.5):
+                storage.get('key')
+
+        self.assertEqual(mock_r.get.call_count, 2)
+        self.assertTrue(mock_sleep.call_args[0][0] <= 0.5)
+
+    def test_deadline_exceeded(self):
+        mock_r = mock.Mock()
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+        with patch_redis(mock_r):
+            storage = Storage(circuit_breaker=breaker)
+            with deadline(0):
+                for _ in range(5):
+                    self.assertEqual(storage.cache_get('key'), None)
+                    with self.assertRaisesRegexp(DeadlineExceeded, "deadline exceeded"):
+                        storage.get('key')
+
+        self.assertFalse(mock_r.get.called)
+        # calls were not made, it says nothing about redis
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_circuit_breaker(self):
+        mock_r = mock.Mock()
+        mock_r.get.side_effect = ConnectionError()
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+        with patch_redis(mock_r):
+            storage = Storage(retries=1, circuit_breaker=breaker)
+            with mock.patch('time.time', return_value=100):
+                storage.cache_get('key')
+                storage.cache_get('key')
+                self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+                # cache calls fail fast while circuit is open
+                self.assertEqual(storage.cache_get('key'), None)
+                self.assertEqual(mock_r.get.call_count, 2)
+
+            mock_r.get.side_effect = None
+            mock_r.get.return_value = '1'
+            with mock.patch('time.time', return_value=110):
+                self.assertEqual(storage.cache_get('key'), 1)
+            self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_circuit_breaker_failed_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+        with mock.patch('time.time', return_value=100):
+            breaker.record_failure()
+            self.assertFalse(breaker.allow())
+        with mock.patch('time.time', return_value=110):
+            self.assertTrue(breaker.allow())
+            # only one probe at a time
+            self.assertFalse(breaker.allow())
+            breaker.record_failure()
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+            self.assertFalse(breaker.allow())
+
+    def test_get_many_chunks(self):
+        mock_r = mock.Mock()
+        mock_r.mget.side_effect = lambda keys: [k.upper() for k in keys]
+        with patch_redis(mock_r):
+            storage = Storage()
+            storage.MGET_CHUNK_SIZE = 2
+            values = storage.get_many(['a', 'b', 'c', 'd', 'e'])
+
+        self.assertEqual(values, ['A', 'B', 'C', 'D', 'E'])
+        self.assertEqual(mock_r.mget.call_count, 3)
+
+    def test_get_many_timeout_retries(self):
+        mock_r = mock.Mock()
+        mock_r.mget.side_effect = ConnectionError()
+        with patch_redis(mock_r), \
+                self.assertRaisesRegexp(ConnectionError, "gave up"):
+            storage = Storage()
+            storage.RETRY_INTERVAL_SEC = 0
+            storage.get_many(['a', 'b'])
+
+        self.assertEqual(mock_r.mget.call_count, 5)
+
+    @cases([0, 1.5, 'val', None])
+    def test_cache_value_type(self, value):
+        mock_r = mock.Mock()
+        with patch_redis(mock_r):
+            storage = Storage()
+            storage.cache_set('key', value, 60)
+            mock_r.get.return_value = mock_r.set.call_args[0][1]
+            self.assertEqual(storage.cache_get('key'), value)
+
+    def test_l1_cache(self):
+        mock_r = mock.Mock()
+        mock_r.pipeline.return_value.execute.return_value = ['val2', 30]
+        with patch_redis(mock_r):
+            storage = Storage(l1_cache=LRUCache())
+            storage.cache_set('key1', 'val1', 60)
+            self.assertEqual(storage.cache_get('key1'), 'val1')
+            # miss in l1 is filled from redis with remaining ttl
+            self.assertEqual(storage.cache_get('key2'), 'val2')
+            self.assertEqual(storage.cache_get('key2'), 'val2')
+
+        self.assertEqual(mock_r.set.call_count, 1)
+        self.assertEqual(mock_r.pipeline.return_value.execute.call_count, 1)
+        self.assertEqual(storage.l1_stats()['hits'], 2)
+
+    def test_pool_stats(self):
+        # nothing listens on port 1
+        storage = Storage(port=1, pool_size=3)
+        storage.RETRY_INTERVAL_SEC = 0
+        storage.cache_get('key')
+
+        stats = storage.pool_stats()
+        self.assertEqual(stats['failed_checkouts'], 5)
+        self.assertEqual(stats['checkouts'], 0)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['max_connections'], 3)
+
 
 class TestStorageOnline(unittest.TestCase):
     REDIS_PORT = 15000
@@ -54,3 +174,23 @@ class TestStorageOnline(unittest.TestCase):
         self.assertEqual(storage.cache_get('key1'), 'val1')
         self.assertEqual(storage.cache_get('key2'), 'val2')
         self.assertEqual(storage.cache_get('not-set'), None)
+
+        stats = storage.pool_stats()
+        self.assertEqual(stats['checkouts'], 5)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['max_in_use'], 1)
+
+    def test_get_many(self):
+        storage = Storage(port=self.REDIS_PORT)
+        storage.cache_set('key1', 'val1', 60)
+        storage.cache_set('key2', 'val2', 60)
+
+        self.assertEqual(storage.get_many(['key1', 'not-set', 'key2']), ['val1', None, 'val2'])
+        self.assertEqual(storage.get_many([]), [])
+
+    def test_append_list(self):
+        storage = Storage(port=self.REDIS_PORT)
+        self.assertTrue(storage.append_list('names', ['a', 'b'], 0))
+        self.assertFalse(storage.append_list('names', ['c'], 0))
+        self.assertTrue(storage.append_list('names', ['c'], 2))
+        self.assertEqual(storage.get_list('names', 1), ['b', 'c'])
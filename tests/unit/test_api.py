@@ -5,6 +5,7 @@ import unittest
 import mock
 
 import api
+from storage import Storage
 from utils import cases, patch_redis
 
 
@@ -12,10 +13,10 @@ class TestSuite(unittest.TestCase):
     def setUp(self):
         self.context = {}
         self.headers = {}
-        self.settings = {}
+        self.store = None
 
     def get_response(self, request):
-        return api.method_handler({"body": request, "headers": self.headers}, self.context, self.settings)
+        return api.method_handler({"body": request, "headers": self.headers}, self.context, self.store)
 
     def set_valid_auth(self, request):
         if request.get("login") == api.ADMIN_LOGIN:
@@ -87,6 +88,7 @@ class TestSuite(unittest.TestCase):
         mock_r.get.return_value = None
         mock_r.set.return_value = None
         with patch_redis(mock_r):
+            self.store = Storage()
             response, code = self.get_response(request)
 
         self.assertEqual(api.OK, code, arguments)
@@ -94,6 +96,22 @@ class TestSuite(unittest.TestCase):
         self.assertTrue(isinstance(score, (int, float)) and score >= 0, arguments)
         self.assertEqual(sorted(self.context["has"]), sorted(arguments.keys()))
 
+    @cases(['0', '3.5'])
+    def test_cached_score_request(self, cached):
+        arguments = {"first_name": "a", "last_name": "b"}
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": arguments}
+        self.set_valid_auth(request)
+        mock_r = mock.Mock()
+        mock_r.get.return_value = cached
+        with patch_redis(mock_r):
+            self.store = Storage()
+            response, code = self.get_response(request)
+
+        self.assertEqual(api.OK, code)
+        # any cached value is a hit, including zero score
+        self.assertEqual(response["score"], float(cached))
+        self.assertFalse(mock_r.set.called)
+
     def test_ok_score_admin_request(self):
         arguments = {"phone": "79175002040", "email": "stupnikov@otus.ru"}
         request = {"account": "horns&hoofs", "login": "admin", "method": "online_score", "arguments": arguments}
@@ -127,8 +145,9 @@ class TestSuite(unittest.TestCase):
         request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests", "arguments": arguments}
         self.set_valid_auth(request)
         mock_r = mock.Mock()
-        mock_r.get.return_value = '["cats", "dogs"]'
-        with patch_redis(mock_r):
+        mock_r.mget.side_effect = lambda keys: ['["cats", "dogs"]'] * len(keys)
+        with patch_redis(mock_r) as mock_redis_cls:
+            self.store = Storage()
             response, code = self.get_response(request)
 
         self.assertEqual(api.OK, code, arguments)
@@ -136,3 +155,160 @@ class TestSuite(unittest.TestCase):
         self.assertTrue(all(v and isinstance(v, list) and all(isinstance(i, basestring) for i in v)
                         for v in response.values()))
         self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
+        # all lookups go through one shared connection pool in one round trip
+        self.assertEqual(mock_redis_cls.call_count, 1)
+        self.assertEqual(mock_r.mget.call_count, 1)
+
+    @cases([
+        ({}, None),
+        ({api.DEADLINE_HEADER: "1500"}, 1.5),
+        ({api.DEADLINE_HEADER: "-1"}, 0),
+        ({api.DEADLINE_HEADER: "xxx"}, None),
+    ])
+    def test_request_timeout(self, headers, timeout):
+        self.assertEqual(api.MainHTTPHandler.get_request_timeout(headers), timeout)
+
+    def test_batch_request(self):
+        score_request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                         "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        interests_request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                             "arguments": {"client_ids": [1, 2]}}
+        invalid_request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": {}}
+        for request in (score_request, interests_request, invalid_request):
+            self.set_valid_auth(request)
+        forbidden_request = dict(score_request, token="bad")
+
+        mock_r = mock.Mock()
+        mock_r.mget.side_effect = lambda keys: [None if k.startswith("uid:") else '["cats"]' for k in keys]
+        with patch_redis(mock_r):
+            self.store = Storage()
+            response, code = api.batch_handler(
+                {"body": [score_request, interests_request, invalid_request, forbidden_request],
+                 "headers": self.headers},
+                self.context, self.store)
+
+        self.assertEqual(api.OK, code)
+        self.assertEqual([item["code"] for item in response],
+                         [api.OK, api.OK, api.INVALID_REQUEST, api.FORBIDDEN])
+        self.assertEqual(response[0]["response"], {"score": 3.0})
+        self.assertEqual(response[1]["response"], {1: ["cats"], 2: ["cats"]})
+        self.assertTrue(response[2]["error"])
+        # keys of all items are fetched in one round trip, score is cached with pipeline
+        self.assertEqual(mock_r.mget.call_count, 1)
+        self.assertEqual(mock_r.pipeline.return_value.set.call_count, 1)
+        self.assertEqual(self.context["nitems"], 4)
+
+    @cases([{}, [{}] * (api.MAX_BATCH_SIZE + 1)])
+    def test_invalid_batch_request(self, body):
+        response, code = api.batch_handler({"body": body, "headers": self.headers}, self.context, self.store)
+        self.assertEqual(api.INVALID_REQUEST, code)
+        self.assertTrue(len(response))
+
+    def test_auth_cache(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": {}}
+        self.set_valid_auth(request)
+        req_obj = api.request_object.MethodRequest(request)
+        with mock.patch.object(api, "verified_credentials", set()), \
+                mock.patch.object(api, "AUTH_CACHE_SIZE", 1):
+            self.assertTrue(api.check_auth(req_obj))
+            with mock.patch("hashlib.sha512") as mock_sha:
+                self.assertTrue(api.check_auth(req_obj))
+            self.assertFalse(mock_sha.called)
+
+            # wrong tokens are not cached
+            req_obj.token = "bad"
+            self.assertFalse(api.check_auth(req_obj))
+            req_obj.login = "admin"
+            self.assertFalse(api.check_auth(req_obj))
+            self.assertEqual(len(api.verified_credentials), 1)
+
+    def test_auth_cache_eviction(self):
+        req_objs = []
+        for i in range(5):
+            request = {"account": "horns&hoofs", "login": "h&f%s" % i, "method": "online_score", "arguments": {}}
+            self.set_valid_auth(request)
+            req_objs.append(api.request_object.MethodRequest(request))
+        with mock.patch.object(api, "verified_credentials", set()), \
+                mock.patch.object(api, "AUTH_CACHE_SIZE", 3):
+            for req_obj in req_objs:
+                self.assertTrue(api.check_auth(req_obj))
+                self.assertTrue(len(api.verified_credentials) <= 3)
+            self.assertEqual(len(api.verified_credentials), 3)
+
+            # evicted credentials are verified again and still pass
+            for req_obj in req_objs:
+                cached = (req_obj.account, req_obj.login, req_obj.token) in api.verified_credentials
+                with mock.patch("hashlib.sha512", wraps=hashlib.sha512) as mock_sha:
+                    self.assertTrue(api.check_auth(req_obj))
+                self.assertEqual(mock_sha.called, not cached)
+                self.assertEqual(len(api.verified_credentials), 3)
+
+    def test_admin_digest_hourly(self):
+        digest = api.AdminDigest()
+        first_hour = datetime.datetime(2020, 1, 1, 10, 30)
+        next_hour = datetime.datetime(2020, 1, 1, 11, 30)
+        with mock.patch("time.time", return_value=0), \
+                mock.patch("datetime.datetime") as mock_dt:
+            mock_dt.now.return_value = first_hour
+            first = digest()
+            mock_dt.now.return_value = next_hour
+            self.assertEqual(digest(), first)
+
+        expected = hashlib.sha512("2020010111" + api.ADMIN_SALT).hexdigest()
+        with mock.patch("time.time", return_value=10 ** 10), \
+                mock.patch("datetime.datetime") as mock_dt:
+            mock_dt.now.return_value = next_hour
+            self.assertEqual(digest(), expected)
+
+    def test_stage_timings(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        self.set_valid_auth(request)
+        mock_r = mock.Mock()
+        mock_r.get.return_value = None
+        with patch_redis(mock_r):
+            self.store = Storage()
+            _, code = self.get_response(request)
+
+        self.assertEqual(api.OK, code)
+        self.assertEqual(sorted(self.context["timings"]), ["auth", "storage", "validate"])
+
+    def test_record_request(self):
+        timings = {"read": 0.001, "handler": 0.002}
+        with mock.patch.object(api, "REQUESTS") as mock_requests, \
+                mock.patch.object(api, "STAGE_SECONDS") as mock_stages:
+            api.MainHTTPHandler.record_request("/method/", {"method": "online_score"}, api.OK, timings)
+            api.MainHTTPHandler.record_request("/method/", {"method": "x" * 100}, api.OK, timings)
+            api.MainHTTPHandler.record_request("/unknown/", None, api.NOT_FOUND, timings)
+
+        # label values are limited to known ones
+        self.assertEqual(mock_requests.inc.call_args_list, [
+            mock.call(("method", "online_score", api.OK)),
+            mock.call(("method", "other", api.OK)),
+            mock.call(("other", "", api.NOT_FOUND)),
+        ])
+        self.assertEqual(mock_stages.observe.call_count, 6)
+
+    @cases([
+        ("/metrics", api.OK),
+        ("/unknown", api.NOT_FOUND),
+        ("/debug/profile?seconds=1", api.BAD_REQUEST),
+    ])
+    def test_handle_get(self, path, expected_code):
+        code, _, data = api.MainHTTPHandler.handle_get(path)
+        self.assertEqual(code, expected_code)
+        self.assertTrue(data)
+
+    @cases([
+        ({}, api.OK),
+        ({"seconds": ["5"]}, api.OK),
+        ({"seconds": ["x"]}, api.BAD_REQUEST),
+        ({"seconds": ["0"]}, api.BAD_REQUEST),
+        ({"seconds": ["100000"]}, api.BAD_REQUEST),
+    ])
+    def test_start_profile(self, query, expected_code):
+        mock_profiler = mock.Mock(directory="/tmp")
+        with mock.patch.object(api.MainHTTPHandler, "profiler", mock_profiler):
+            _, code = api.MainHTTPHandler.start_profile(query)
+        self.assertEqual(code, expected_code)
+        self.assertEqual(mock_profiler.start_window.called, code == api.OK)
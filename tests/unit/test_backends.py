@@ -0,0 +1,276 @@
+import time
+import threading
+import unittest
+
+import mock
+from redis.exceptions import ConnectionError
+
+from backends import (
+    ROUND_ROBIN,
+    HashRing,
+    MemoryBackend,
+    ReplicatedBackend,
+    ShardedBackend,
+    StatsConnectionPool,
+    remaining_time,
+)
+from storage import Storage, deadline, parse_nodes
+
+
+class TestMemoryBackend(unittest.TestCase):
+    def test_get_set(self):
+        backend = MemoryBackend({'a': '1'})
+        backend.set('b', '2', ttl=10)
+        backend.set_many([('c', '3', None), ('d', '4', 5)])
+        self.assertEqual(backend.mget(['a', 'b', 'c', 'd', 'e']), ['1', '2', '3', '4', None])
+        self.assertEqual(backend.get_with_ttl('a'), ('1', -1))
+        self.assertEqual(backend.get_with_ttl('b'), ('2', 10))
+        self.assertEqual(backend.get_with_ttl('e'), (None, -2))
+
+        with mock.patch('time.time', return_value=backend._data['d'][1]):
+            self.assertIsNone(backend.get('d'))
+        self.assertNotIn('d', backend._data)
+
+    def test_scan(self):
+        backend = MemoryBackend({'i:%s' % i: str(i) for i in range(5)})
+        backend.set('uid:1', '1')
+        keys, cursor = [], 0
+        while True:
+            cursor, batch = backend.scan(cursor, match='i:*', count=2)
+            keys.extend(batch)
+            if not cursor:
+                break
+        self.assertEqual(sorted(keys), ['i:%s' % i for i in range(5)])
+
+    def test_list(self):
+        backend = MemoryBackend()
+        self.assertTrue(backend.append_list('names', ['a', 'b'], 0))
+        self.assertFalse(backend.append_list('names', ['c'], 1))
+        self.assertTrue(backend.append_list('names', ['c'], 2))
+        self.assertEqual(backend.get_list('names', 1), ['b', 'c'])
+
+    def test_storage(self):
+        storage = Storage(backend=MemoryBackend({'i:1': '["cars"]'}))
+        storage.cache_set('uid:1', 1.5, 60)
+        self.assertEqual(storage.cache_get('uid:1'), 1.5)
+        self.assertEqual(storage.get_many(['i:1', 'i:2']), ['["cars"]', None])
+        self.assertIsNone(storage.pool_stats())
+        self.assertEqual(storage.collect_metrics(), [])
+
+
+class TestStatsConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.connection = mock.Mock(socket_timeout=10)
+        self.connection.can_read.return_value = False
+        self.pool = StatsConnectionPool(max_connections=1, socket_timeout=10)
+        self.pool.make_connection = mock.Mock(return_value=self.connection)
+        self.connection.pid = self.pool.pid
+
+    def test_deadline_timeout(self):
+        with deadline(0.5):
+            connection = self.pool.get_connection('GET')
+        self.assertTrue(connection._sock.settimeout.call_args[0][0] <= 0.5)
+        self.pool.release(connection)
+        connection._sock.settimeout.assert_called_with(10)
+
+        connection._sock.settimeout.reset_mock()
+        connection = self.pool.get_connection('GET')
+        self.pool.release(connection)
+        self.assertFalse(connection._sock.settimeout.called)
+
+        with deadline(20):
+            connection = self.pool.get_connection('GET')
+        self.assertFalse(connection._sock.settimeout.called)
+
+
+class TestLocalBackend(unittest.TestCase):
+    def setUp(self):
+        self.backend = mock.Mock()
+        self.local = MemoryBackend({'i:1': 'local1', 'i:2': 'local2'})
+
+    def test_fallback(self):
+        self.backend.get.return_value = 'remote'
+        self.backend.mget.side_effect = lambda keys: ['remote'] * len(keys)
+        storage = Storage(backend=self.backend, local=self.local)
+        self.assertEqual(storage.get('i:1'), 'remote')
+        self.assertEqual(storage.get_many(['i:1', 'i:3']), ['remote', 'remote'])
+
+        self.backend.get.side_effect = self.backend.mget.side_effect = ConnectionError()
+        storage.RETRY_INTERVAL_SEC = 0
+        self.assertEqual(storage.get('i:1'), 'local1')
+        self.assertEqual(storage.get_many(['i:1', 'i:3']), ['local1', None])
+        self.assertEqual(self.backend.mget.call_count, 1 + storage.RETRY_N)
+
+        with self.assertRaises(ConnectionError):
+            Storage(backend=self.backend, retries=1).get('i:1')
+
+    def test_local_first(self):
+        self.backend.get.return_value = 'remote'
+        self.backend.mget.side_effect = lambda keys: ['remote-' + key for key in keys]
+        storage = Storage(backend=self.backend, local=self.local, local_first=True)
+        self.assertEqual(storage.get('i:2'), 'local2')
+        self.assertEqual(storage.get('i:3'), 'remote')
+        self.assertEqual(storage.get_many(['i:3', 'i:1', 'i:4']), ['remote-i:3', 'local1', 'remote-i:4'])
+        self.backend.mget.assert_called_once_with(['i:3', 'i:4'])
+
+
+class TestHashRing(unittest.TestCase):
+    KEYS = ['i:%s' % i for i in range(10000)]
+
+    def test_balance(self):
+        ring = HashRing(['redis%s:6379' % i for i in range(4)])
+        counts = [0] * 4
+        for key in self.KEYS:
+            counts[ring.get_node(key)] += 1
+        self.assertTrue(all(1500 < count < 3500 for count in counts), counts)
+        self.assertEqual(sorted(i for positions in ring.group(self.KEYS).values() for i in positions),
+                         range(len(self.KEYS)))
+
+    def test_add_node(self):
+        nodes = ['redis%s:6379' % i for i in range(4)]
+        before = HashRing(nodes)
+        after = HashRing(nodes + ['redis4:6379'])
+        moved = [key for key in self.KEYS if before.get_node(key) != after.get_node(key)]
+        # keys move only to the new node, about a fifth of them
+        self.assertTrue(all(after.get_node(key) == 4 for key in moved))
+        self.assertTrue(1000 < len(moved) < 3000, len(moved))
+
+
+class TestShardedBackend(unittest.TestCase):
+    def setUp(self):
+        self.shards = [MemoryBackend() for _ in range(3)]
+        self.backend = ShardedBackend(self.shards, ['a', 'b', 'c'])
+
+    def test_routing(self):
+        items = [('i:%s' % i, str(i), None) for i in range(100)]
+        self.backend.set_many(items)
+        self.backend.set('uid:1', '1.5', 60)
+        self.assertTrue(all(shard._data for shard in self.shards))
+        self.assertEqual(sum(len(shard._data) for shard in self.shards), 101)
+
+        keys = [key for key, _, _ in items] + ['i:100', 'uid:1']
+        self.assertEqual(self.backend.mget(keys), [value for _, value, _ in items] + [None, '1.5'])
+        self.assertEqual(self.backend.get_with_ttl('uid:1'), ('1.5', 60))
+        self.assertEqual(self.backend.get('i:7'), '7')
+
+    def test_concurrent_fanout(self):
+        threads = set()
+        arrived = threading.Condition()
+
+        def mget(keys):
+            # every shard call waits for the others, runs only if they are concurrent
+            with arrived:
+                threads.add(threading.current_thread().name)
+                arrived.notify_all()
+                while len(threads) < 3:
+                    arrived.wait(1)
+                    if len(threads) < 3:
+                        raise AssertionError('shards are queried one by one')
+            return [None] * len(keys)
+        for shard in self.shards:
+            shard.mget = mget
+        self.backend.mget(['i:%s' % i for i in range(100)])
+        self.assertEqual(len(threads), 3)
+        self.assertIn(threading.current_thread().name, threads)
+
+    def test_fanout_deadline(self):
+        remaining = []
+
+        def mget(keys):
+            remaining.append(remaining_time())
+            return [None] * len(keys)
+        for shard in self.shards:
+            shard.mget = mget
+        with deadline(10):
+            self.backend.mget(['i:%s' % i for i in range(100)])
+        self.assertEqual(len(remaining), 3)
+        self.assertTrue(all(0 < r <= 10 for r in remaining))
+
+    def test_shard_failure(self):
+        self.shards[1].mget = mock.Mock(side_effect=ConnectionError())
+        with self.assertRaises(ConnectionError):
+            self.backend.mget(['i:%s' % i for i in range(100)])
+
+    def test_scan(self):
+        self.backend.set_many([('i:%s' % i, str(i), None) for i in range(50)])
+        keys, cursor = [], 0
+        while True:
+            cursor, batch = self.backend.scan(cursor, match='i:*', count=7)
+            keys.extend(batch)
+            if not cursor:
+                break
+        self.assertEqual(sorted(keys), sorted('i:%s' % i for i in range(50)))
+
+    def test_storage_nodes(self):
+        with mock.patch('storage.RedisBackend') as backend_cls:
+            storage = Storage(nodes=[('redis1', 6379), ('redis2', 6380)], socket_timeout=1)
+        self.assertIsInstance(storage.backend, ShardedBackend)
+        self.assertEqual([kwargs['port'] for _, _, kwargs in backend_cls.mock_calls], [6379, 6380])
+        self.assertTrue(all(kwargs['socket_timeout'] == 1 for _, _, kwargs in backend_cls.mock_calls))
+
+    def test_parse_nodes(self):
+        self.assertEqual(parse_nodes('redis1:6379, 10.0.0.2:6380'), [('redis1', 6379), ('10.0.0.2', 6380)])
+        for value in ('redis1', 'redis1:port', ':6379'):
+            with self.assertRaises(ValueError):
+                parse_nodes(value)
+
+
+class TestReplicatedBackend(unittest.TestCase):
+    def setUp(self):
+        self.primary = MemoryBackend({'i:1': 'primary'})
+        self.replicas = [MemoryBackend({'i:1': 'replica0'}), MemoryBackend({'i:1': 'replica1'})]
+        # health checks are run by the tests
+        self.backend = ReplicatedBackend(self.primary, self.replicas, check_interval=0)
+
+    def test_writes(self):
+        self.backend.set('uid:1', '1.5', 60)
+        self.backend.set_many([('uid:2', '2.5', 60)])
+        self.assertTrue(self.backend.append_list('names', ['cars'], 0))
+        self.assertEqual(self.primary.mget(['uid:1', 'uid:2']), ['1.5', '2.5'])
+        self.assertEqual(self.backend.get_list('names'), ['cars'])
+        self.assertEqual(self.replicas[0].get('uid:1'), None)
+
+    def test_round_robin(self):
+        self.backend.balance = ROUND_ROBIN
+        self.assertEqual(sorted(self.backend.get('i:1') for _ in range(4)), ['replica0'] * 2 + ['replica1'] * 2)
+
+    def test_least_outstanding(self):
+        busy = self.backend.acquire()
+        self.assertEqual(set(self.backend.get('i:1') for _ in range(4)), {'replica%s' % (1 - busy)})
+        self.backend.release(busy)
+        self.assertEqual(len(set(self.backend.mget(['i:1'])[0] for _ in range(4))), 2)
+
+    def test_failed_replica(self):
+        self.replicas[0].get = mock.Mock(side_effect=ConnectionError())
+        self.assertEqual(set(self.backend.get('i:1') for _ in range(4)), {'replica1', 'primary'})
+        self.assertEqual(self.backend.healthy_replicas(), [1])
+        self.assertEqual(self.replicas[0].get.call_count, 1)
+
+        self.replicas[1].mget = mock.Mock(side_effect=ConnectionError())
+        self.assertEqual(self.backend.mget(['i:1']), ['primary'])
+        self.assertEqual(self.backend.healthy_replicas(), [])
+        self.assertEqual(self.backend.get('i:1'), 'primary')
+
+    def test_health_check(self):
+        self.replicas[0].healthy = mock.Mock(return_value=False)
+        self.replicas[1].healthy = mock.Mock(side_effect=ConnectionError())
+        self.backend.check()
+        self.assertEqual(self.backend.healthy_replicas(), [])
+
+        self.replicas[0].healthy.return_value = True
+        self.backend.check()
+        # ejected for eject_sec
+        self.assertEqual(self.backend.healthy_replicas(), [])
+        with mock.patch('time.time', return_value=time.time() + self.backend.eject_sec):
+            self.backend.check()
+        self.assertEqual(self.backend.healthy_replicas(), [0])
+        self.assertEqual(self.backend.get('i:1'), 'replica0')
+
+    def test_storage_replicas(self):
+        with mock.patch('storage.RedisBackend') as backend_cls:
+            storage = Storage(replicas=[('replica1', 6380)], host='primary', port=6379)
+        self.assertIsInstance(storage.backend, ReplicatedBackend)
+        self.assertEqual([(kwargs['host'], kwargs['port']) for _, _, kwargs in backend_cls.mock_calls],
+                         [('primary', 6379), ('replica1', 6380)])
+        with self.assertRaises(ValueError):
+            Storage(nodes=[('redis1', 6379)], replicas=[('replica1', 6380)])
@@ -0,0 +1,115 @@
+import time
+import unittest
+import threading
+
+import mock
+
+from cache import LRUCache, SingleFlight
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_set(self):
+        cache = LRUCache()
+        cache.set('a', 1, 60)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('b', 'default'), 'default')
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_ttl(self):
+        cache = LRUCache()
+        with mock.patch('time.time', return_value=100):
+            cache.set('a', 1, 10)
+        with mock.patch('time.time', return_value=109):
+            self.assertEqual(cache.get('a'), 1)
+        with mock.patch('time.time', return_value=110):
+            self.assertEqual(cache.get('a'), None)
+
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_evict_by_entries(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 60)
+        cache.get('a')
+        cache.set('c', 3, 60)
+
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_evict_by_bytes(self):
+        value = 'x' * 1000
+        cache = LRUCache(max_bytes=2500)
+        for key in ('a', 'b', 'c'):
+            cache.set(key, value, 60)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), None)
+        self.assertTrue(cache.stats()['bytes'] <= 2500)
+
+    def test_threads(self):
+        cache = LRUCache(max_entries=100)
+
+        def worker(n):
+            for i in range(1000):
+                cache.set((n, i % 150), i, 60)
+                cache.get((n, i % 50))
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        stats = cache.stats()
+        self.assertEqual(stats['entries'], 100)
+        self.assertEqual(stats['hits'] + stats['misses'], 4000)
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_calls(self):
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 42
+
+        def worker():
+            results.append(flights.do('key', compute))
+
+        threads = [threading.Thread(target=worker) for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        # let followers reach the wait
+        time.sleep(0.1)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [42] * 5)
+        # key is released after the call
+        self.assertEqual(flights.do('key', lambda: 0), 0)
+
+    def test_error(self):
+        flights = SingleFlight()
+
+        def fail():
+            raise ValueError('failed')
+
+        with self.assertRaisesRegexp(ValueError, 'failed'):
+            flights.do('key', fail)
+        self.assertEqual(flights.do('key', lambda: 1), 1)
@@ -0,0 +1,243 @@
+import json
+import socket
+import hashlib
+import httplib
+import unittest
+import threading
+
+import mock
+from redis.exceptions import ConnectionError, ResponseError
+
+import api
+from event_server import (
+    MAX_BODY_SIZE,
+    AsyncRedis,
+    EventLoopServer,
+    HTTPError,
+    RespParser,
+    encode_command,
+    parse_request,
+)
+from utils import cases
+
+
+class TestParseRequest(unittest.TestCase):
+    def test_parse(self):
+        buf = 'POST /method/ HTTP/1.1\r\ncontent-length: 2\r\nX-Request-Id: abc\r\n\r\n{}tail'
+        request, consumed = parse_request(buf)
+        self.assertEqual(request.method, 'POST')
+        self.assertEqual(request.path, '/method/')
+        self.assertEqual(request.body, '{}')
+        self.assertEqual(request.headers['Content-Length'], '2')
+        self.assertEqual(request.headers.get('x-request-id'), 'abc')
+        self.assertEqual(buf[consumed:], 'tail')
+
+    @cases([
+        'POST /method/ HTTP/1.1\r\nContent-Length: 2\r\n',
+        'POST /method/ HTTP/1.1\r\nContent-Length: 2\r\n\r\n{',
+    ])
+    def test_incomplete(self, buf):
+        self.assertEqual(parse_request(buf), (None, 0))
+
+    @cases([
+        'POST\r\n\r\n',
+        'POST / HTTP/1.1\r\nbad header\r\n\r\n',
+        'POST / HTTP/1.1\r\nContent-Length: x\r\n\r\n',
+        'POST / HTTP/1.1\r\nContent-Length: -1\r\n\r\n{}',
+        'POST / HTTP/1.1\r\nContent-Length: {}\r\n\r\n{{}}'.format(MAX_BODY_SIZE + 1),
+    ])
+    def test_malformed(self, buf):
+        with self.assertRaises(HTTPError):
+            parse_request(buf)
+
+    @cases([
+        ('HTTP/1.1', '', True),
+        ('HTTP/1.1', 'close', False),
+        ('HTTP/1.0', '', False),
+        ('HTTP/1.0', 'Keep-Alive', True),
+    ])
+    def test_keep_alive(self, version, connection, expected):
+        request, _ = parse_request('POST / {}\r\nConnection: {}\r\n\r\n'.format(version, connection))
+        self.assertEqual(request.keep_alive, expected)
+
+
+class TestResp(unittest.TestCase):
+    def test_encode_command(self):
+        self.assertEqual(encode_command(['SET', u'k', 1.5, 'EX', 60]),
+                         '*5\r\n$3\r\nSET\r\n$1\r\nk\r\n$3\r\n1.5\r\n$2\r\nEX\r\n$2\r\n60\r\n')
+
+    def test_parse_replies(self):
+        parser = RespParser()
+        data = '+OK\r\n:42\r\n$-1\r\n*3\r\n$3\r\nabc\r\n$-1\r\n$0\r\n\r\n-ERR wrong\r\n'
+        # feed byte by byte to check incomplete replies handling
+        replies = []
+        for char in data:
+            parser.feed(char)
+            reply = parser.gets()
+            if reply is not RespParser.INCOMPLETE:
+                replies.append(reply)
+
+        self.assertEqual(replies[:4], ['OK', 42, None, ['abc', None, '']])
+        self.assertIsInstance(replies[4], ResponseError)
+
+
+def encode_reply(reply):
+    if reply is None:
+        return '$-1\r\n'
+    if isinstance(reply, int):
+        return ':%d\r\n' % reply
+    if isinstance(reply, list):
+        return '*%d\r\n' % len(reply) + ''.join(encode_reply(item) for item in reply)
+    return '$%d\r\n%s\r\n' % (len(reply), reply)
+
+
+class TestAsyncRedis(unittest.TestCase):
+    def test_idle_connection_timeout(self):
+        redis = AsyncRedis(mock.Mock(), socket_timeout=10)
+        redis._sock = mock.Mock()
+        redis._sock.send.side_effect = len
+        redis._connected = True
+        # connection was idle for a long time before the command
+        redis._last_activity = 0
+        callback = mock.Mock()
+        with mock.patch('time.time', return_value=1000):
+            redis.execute(callback, 'GET', 'key')
+        redis.check_timeout(1005)
+        self.assertFalse(callback.called)
+
+        redis.check_timeout(1011)
+        self.assertIsInstance(callback.call_args[0][0], ConnectionError)
+
+
+class FakeRedis(object):
+    """redis serving GET, MGET, SET and TTL of dict values over a real socket"""
+
+    def __init__(self, data):
+        self.data = dict(data)
+        self.commands = []
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(5)
+        self.address = self.socket.getsockname()
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self.socket.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._serve, args=(sock,))
+            thread.daemon = True
+            thread.start()
+
+    def _execute(self, args):
+        self.commands.append(args)
+        name = args[0].upper()
+        if name == 'GET':
+            return encode_reply(self.data.get(args[1]))
+        if name == 'MGET':
+            return encode_reply([self.data.get(key) for key in args[1:]])
+        if name == 'SET':
+            self.data[args[1]] = args[2]
+            return '+OK\r\n'
+        if name == 'TTL':
+            return encode_reply(-1 if args[1] in self.data else -2)
+        return '-ERR unknown command\r\n'
+
+    def _serve(self, sock):
+        parser = RespParser()
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                sock.close()
+                return
+            parser.feed(data)
+            while True:
+                args = parser.gets()
+                if args is RespParser.INCOMPLETE:
+                    break
+                sock.sendall(self._execute(args))
+
+    def close(self):
+        self.socket.close()
+
+
+class TestEventLoopServer(unittest.TestCase):
+    def setUp(self):
+        self.redis = FakeRedis({'i:1': '["cars", "pets"]', 'i:2': '["tv"]'})
+        store = mock.Mock(redis_kwargs={'host': self.redis.address[0], 'port': self.redis.address[1]},
+                          l1_cache=None, local=None, nodes=None, replicas=None)
+        patcher = mock.patch.object(api.MainHTTPHandler, 'store', store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = EventLoopServer(('localhost', 0), api.MainHTTPHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.loop.running = False
+        self.thread.join(5)
+        self.server.server_close()
+        self.redis.close()
+
+    def post(self, method, arguments):
+        body = {'account': 'horns&hoofs', 'login': 'h&f', 'method': method, 'arguments': arguments,
+                'token': hashlib.sha512('horns&hoofsh&f' + api.SALT).hexdigest()}
+        conn = httplib.HTTPConnection(*self.server.server_address, timeout=5)
+        try:
+            conn.request('POST', '/method/', json.dumps(body), {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            conn.close()
+
+    def test_clients_interests(self):
+        code, data = self.post('clients_interests', {'client_ids': [1, 2, 3]})
+        self.assertEqual(code, api.OK)
+        self.assertEqual(data['response'], {'1': ['cars', 'pets'], '2': ['tv'], '3': []})
+        self.assertEqual([args[0] for args in self.redis.commands], ['MGET'])
+
+    def test_online_score(self):
+        arguments = {'phone': '79175002040', 'email': 'stupnikov@otus.ru'}
+        for _ in range(2):
+            code, data = self.post('online_score', arguments)
+            self.assertEqual(code, api.OK)
+            self.assertEqual(data['response'], {'score': 3.0})
+        # the second score is read from the cache written by the first request
+        self.assertEqual([args[0] for args in self.redis.commands], ['MGET', 'SET', 'MGET'])
+
+    def test_pipelined_bad_content_length(self):
+        sock = socket.create_connection(self.server.server_address)
+        try:
+            sock.sendall('POST /method/ HTTP/1.1\r\nContent-Length: -1\r\n\r\n{}'
+                         'POST /method/ HTTP/1.1\r\nContent-Length: 2\r\n\r\n{}')
+            sock.settimeout(5)
+            data = ''
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        finally:
+            sock.close()
+        # the connection is closed after the bad request, the rest isn't misparsed
+        self.assertTrue(data.startswith('HTTP/1.1 400 '))
+        self.assertEqual(data.count('HTTP/1.1 '), 1)
+
+    def test_callback_error(self):
+        failed = threading.Event()
+
+        def fail():
+            failed.set()
+            raise RuntimeError('callback failed')
+        with mock.patch('logging.exception') as log_exception:
+            self.server.loop.call_soon(fail)
+            self.assertTrue(failed.wait(5))
+            code, data = self.post('clients_interests', {'client_ids': [2]})
+        self.assertEqual(code, api.OK)
+        self.assertEqual(data['response'], {'2': ['tv']})
+        self.assertTrue(log_exception.called)
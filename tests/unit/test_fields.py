@@ -1,8 +1,14 @@
 #! encoding: utf-8
 import unittest
 import datetime
+import itertools
+
+import mock
 
 from field import (
+    DATE_FMT,
+    parse_date,
+    today,
     Field,
     ValidationError,
     ArgumentsField,
@@ -98,7 +104,8 @@ class TestFields(unittest.TestCase):
 
     @cases([
         '71234567891',
-        71234567891
+        71234567891,
+        long(71234567891),
     ])
     def test_phone_allowed(self, value):
         PhoneField()._validate(value)
@@ -119,6 +126,7 @@ class TestFields(unittest.TestCase):
     @cases([
         [0, 1],
         [3],
+        [2 ** 40, long(5)],
     ])
     def test_clientids_allowed(self, value):
         ClientIDsField()._validate(value)
@@ -134,3 +142,53 @@ class TestFields(unittest.TestCase):
     def test_clientids_forbidden(self, value):
         with self.assertRaisesRegexp(ValidationError, "must be a list of non-negative"):
             ClientIDsField()._validate(value)
+
+    @cases([
+        '10.10.2020', '5.5.2020', ' 5.05.2020', '31.12.1999', '29.02.2020', '29.02.2019', '31.04.2020',
+        '00.10.2020', '10.00.2020', '01.01.0000', '01.01.20201', '01.01.202', '1.1.2020\n', '+1.01.2020',
+        '', 'abc', u'10.10.2020', u'\u0661.01.2020',
+    ])
+    def test_parse_date_as_strptime(self, value):
+        self.assert_parse_date_as_strptime(value)
+
+    def test_parse_date_combinations(self):
+        parts = ['', '0', '1', '9', '00', '01', '12', '13', '29', '31', '32', ' 1', '001', '2020', '0001']
+        for day, month, year in itertools.product(parts, parts, parts):
+            self.assert_parse_date_as_strptime('{}.{}.{}'.format(day, month, year))
+
+    def assert_parse_date_as_strptime(self, value):
+        try:
+            expected = datetime.datetime.strptime(value, DATE_FMT)
+        except ValueError:
+            with self.assertRaises(ValueError, msg=repr(value)):
+                parse_date(value)
+        else:
+            self.assertEqual(parse_date(value), expected, repr(value))
+
+    def test_today_cached_until_midnight(self):
+        today_ = type(today)()
+        with mock.patch('time.time', return_value=0), \
+                patch_today(datetime.date(2000, 1, 1)):
+            self.assertEqual(today_(), datetime.date(2000, 1, 1))
+        with mock.patch('time.time', return_value=1), \
+                patch_today(datetime.date(2000, 1, 2)):
+            self.assertEqual(today_(), datetime.date(2000, 1, 1))
+        with mock.patch('time.time', return_value=10 ** 10), \
+                patch_today(datetime.date(2000, 1, 2)):
+            self.assertEqual(today_(), datetime.date(2000, 1, 2))
+
+    def test_today_published_after_date(self):
+        dates = []
+
+        class Today(type(today)):
+            def __setattr__(self, name, value):
+                if name == '_expires_at':
+                    # what another thread would read once it sees the new expiration time
+                    dates.append(self._date)
+                super(Today, self).__setattr__(name, value)
+
+        today_ = Today()
+        with mock.patch('time.time', return_value=0), \
+                patch_today(datetime.date(2000, 1, 1)):
+            today_()
+        self.assertEqual(dates, [None, datetime.date(2000, 1, 1)])
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import interests_format
+from interests_format import InterestsDictionary, decode, encode
+from utils import cases
+
+
+class FakeStore(object):
+    """Storage methods used by the interests tools"""
+
+    def __init__(self):
+        self.data = {}
+        self.lists = {}
+        self.pipelines = 0
+
+    def get_many(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set_many(self, items):
+        self.pipelines += 1
+        self.data.update(items)
+
+    def scan(self, cursor=0, match=None, count=None):
+        keys = sorted(key for key in self.data if key.startswith(match.rstrip('*')))
+        end = cursor + count
+        return (end if end < len(keys) else 0), keys[cursor:end]
+
+    def get_list(self, key, start=0):
+        return self.lists.get(key, [])[start:]
+
+    def append_list(self, key, values, length):
+        items = self.lists.setdefault(key, [])
+        if len(items) != length:
+            return False
+        items.extend(values)
+        return True
+
+
+class TestInterestsFormat(unittest.TestCase):
+    def setUp(self):
+        self.store = FakeStore()
+        self.dictionary = InterestsDictionary(self.store)
+
+    @cases([
+        [],
+        [u'cars', u'pets', u'cars'],
+        [u'книги', 'travel'],
+    ])
+    def test_encode(self, interests):
+        expected = [i if isinstance(i, unicode) else i.decode('utf-8') for i in interests]
+        for format in interests_format.FORMATS:
+            raw = encode(interests, format, self.dictionary)
+            self.assertTrue(interests_format.is_encoded(raw, format))
+            self.assertEqual(decode(raw, self.dictionary), expected)
+
+    def test_shared_names(self):
+        first = decode(encode([u'cars', u'pets'], interests_format.COMPACT_FORMAT, self.dictionary), self.dictionary)
+        second = decode(encode([u'pets'], interests_format.COMPACT_FORMAT, self.dictionary), self.dictionary)
+        self.assertIs(first[1], second[0])
+        self.assertEqual(len(encode([u'cars', u'pets'], interests_format.COMPACT_FORMAT, self.dictionary)), 5)
+
+    def test_names_added_by_another_process(self):
+        writer = InterestsDictionary(self.store)
+        writer.get_ids([u'cars'])
+        self.assertEqual(self.dictionary.get_ids([u'pets', u'cars']), [1, 0])
+
+        raw = encode([u'pets', u'tv'], interests_format.COMPACT_FORMAT, self.dictionary)
+        self.assertEqual(decode(raw, writer), [u'pets', u'tv'])
+        with self.assertRaisesRegexp(ValueError, 'unknown interest id'):
+            decode(interests_format.COMPACT_MARKER + '\x05\x00', writer)
+
+    def test_background_load(self):
+        writer = InterestsDictionary(self.store)
+        raw = encode([u'cars', u'pets'], interests_format.COMPACT_FORMAT, writer)
+        reader = InterestsDictionary(self.store, background_load=True)
+        with self.assertRaisesRegexp(ValueError, 'dictionary is being loaded'):
+            decode(raw, reader)
+        reader._loader.join()
+        self.assertEqual(decode(raw, reader), [u'cars', u'pets'])
+
+    def test_decode_missing(self):
+        self.assertEqual(decode(None), [])
+        self.assertEqual(decode('["cars"]'), [u'cars'])
+        with self.assertRaises(ValueError):
+            decode(interests_format.COMPACT_MARKER)
+
+    def test_import_and_migrate(self):
+        records = [(cid, [u'cars'] * (cid % 3)) for cid in range(10)]
+        written = interests_format.import_records(self.store, records, batch_size=4)
+        self.assertEqual(written, 10)
+        self.assertEqual(self.store.pipelines, 3)
+        self.assertEqual(self.store.data['i:5'], '["cars", "cars"]')
+
+        self.store.data['i:5'] = encode([u'pets'], interests_format.COMPACT_FORMAT, self.dictionary)
+        migrated = interests_format.migrate(self.store, interests_format.COMPACT_FORMAT, self.dictionary, 3)
+        self.assertEqual(migrated, 9)
+        for cid, interests in records:
+            raw = self.store.data['i:%s' % cid]
+            self.assertTrue(interests_format.is_encoded(raw, interests_format.COMPACT_FORMAT))
+            self.assertEqual(decode(raw, self.dictionary), interests if cid != 5 else [u'pets'])
@@ -0,0 +1,67 @@
+import unittest
+import threading
+
+import mock
+
+from metrics import Registry, Counter, Histogram, StageTimer
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_render(self):
+        counter = Counter('requests_total', 'requests', ['path', 'code'], registry=self.registry)
+        histogram = Histogram('latency_seconds', 'latency', ['path'], registry=self.registry, buckets=[0.1, 1])
+        counter.inc(('method', 200))
+        counter.inc(('method', 200), 2)
+        counter.inc(('batch', 'x"y'))
+        for value in (0.1, 0.5, 5):
+            histogram.observe(value, ('method',))
+        self.registry.add_collector(lambda: [('pool_in_use', 'gauge', 'connections in use', 3)])
+
+        self.assertEqual(self.registry.render().splitlines(), [
+            '# HELP requests_total requests',
+            '# TYPE requests_total counter',
+            'requests_total{path="batch",code="x\\"y"} 1.0',
+            'requests_total{path="method",code="200"} 3.0',
+            '# HELP latency_seconds latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{path="method",le="0.1"} 1.0',
+            'latency_seconds_bucket{path="method",le="1.0"} 2.0',
+            'latency_seconds_bucket{path="method",le="+Inf"} 3.0',
+            'latency_seconds_sum{path="method"} 5.6',
+            'latency_seconds_count{path="method"} 3.0',
+            '# HELP pool_in_use connections in use',
+            '# TYPE pool_in_use gauge',
+            'pool_in_use 3.0',
+        ])
+
+    def test_thread_shards(self):
+        counter = Counter('requests_total', 'requests', registry=self.registry)
+
+        def work():
+            for _ in range(1000):
+                counter.inc()
+
+        with mock.patch('metrics.COMPACT_SHARDS', 4):
+            self.registry._compact_at = 4
+            for _ in range(3):
+                threads = [threading.Thread(target=work) for _ in range(4)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+
+            # shards of finished threads are folded into the base one
+            self.assertLess(len(self.registry._shards), 4)
+            self.assertEqual(self.registry.snapshot().counters[('requests_total', ())], 12000)
+            self.assertEqual(self.registry._shards, [])
+
+    def test_stage_timer(self):
+        with mock.patch('time.time', side_effect=[10, 11, 13, 16]):
+            timings = StageTimer()
+            timings.mark('read')
+            timings.mark('validate')
+            timings.mark('read')
+        self.assertEqual(timings, {'read': 4, 'validate': 2})
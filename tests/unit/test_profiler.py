@@ -0,0 +1,70 @@
+import os
+import glob
+import shutil
+import pstats
+import tempfile
+import unittest
+
+import mock
+
+from profiler import Profiler
+
+
+def work(n):
+    return sum(range(n))
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def dumps(self, kind):
+        return sorted(glob.glob(os.path.join(self.directory, '*-{}.pstats'.format(kind))))
+
+    def test_sampling(self):
+        profiler = Profiler(self.directory, every=2, samples_per_dump=2)
+        with mock.patch('cProfile.Profile', wraps=__import__('cProfile').Profile) as mock_profile:
+            results = [profiler.call(work, 10) for _ in range(5)]
+
+        self.assertEqual(results, [45] * 5)
+        self.assertEqual(mock_profile.call_count, 2)
+        # two sampled calls are merged into one dump with summary
+        dumps = self.dumps('sampled')
+        self.assertEqual(len(dumps), 1)
+        self.assertTrue(os.path.exists(dumps[0][:-len('.pstats')] + '.txt'))
+        self.assertIn('work', [func for _, _, func in pstats.Stats(dumps[0]).stats])
+
+        # nothing to flush, then the 6th call is sampled
+        profiler.flush()
+        self.assertEqual(len(self.dumps('sampled')), 1)
+        profiler.call(work, 10)
+        profiler.flush()
+        self.assertEqual(len(self.dumps('sampled')), 2)
+
+    def test_disabled(self):
+        profiler = Profiler(self.directory)
+        with mock.patch('cProfile.Profile') as mock_profile:
+            self.assertEqual(profiler.call(work, 10), 45)
+        self.assertFalse(mock_profile.called)
+
+    def test_window(self):
+        profiler = Profiler(self.directory)
+        with mock.patch('threading.Timer'):
+            self.assertTrue(profiler.start_window(60))
+            self.assertFalse(profiler.start_window(60))
+            for _ in range(3):
+                profiler.call(work, 10)
+            profiler.finish_window()
+
+        dumps = self.dumps('window')
+        self.assertEqual(len(dumps), 1)
+        with open(dumps[0][:-len('.pstats')] + '.txt') as f:
+            self.assertTrue(f.readline().startswith('3 profiled calls'))
+
+        # window is closed
+        with mock.patch('cProfile.Profile') as mock_profile:
+            profiler.call(work, 10)
+        self.assertFalse(mock_profile.called)
@@ -0,0 +1,84 @@
+import json
+import logging
+import unittest
+
+import mock
+
+from request_log import AsyncHandler, JSONFormatter, LogEntry, RequestLog, clip
+from utils import cases
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+class TestRequestLog(unittest.TestCase):
+    @cases([
+        ('abc', 'abc'),
+        ('abcdef', 'abcd...'),
+        (range(6), [0, 1, 2, 3, '... 2 more']),
+        ({'a': {'b': {'c': 1}}}, {'a': {'b': '...'}}),
+        ([None, 1.5, True], [None, 1.5, True]),
+    ])
+    def test_clip(self, value, expected):
+        self.assertEqual(clip(value, max_items=4, max_string=4, depth=2), expected)
+
+    def test_clip_dict(self):
+        clipped = clip({i: i for i in range(10)}, max_items=4)
+        self.assertEqual(len(clipped), 5)
+        self.assertEqual(clipped['...'], '6 more')
+
+    def test_sampling(self):
+        logger = mock.Mock()
+        request_log = RequestLog(sample_rate=0.1, logger=logger)
+        with mock.patch('random.random', return_value=0.5):
+            request_log.log('/method/', {}, {'code': 200})
+            # errors are logged regardless of sampling
+            request_log.log('/method/', None, {'code': 400}, '{bad')
+        self.assertEqual(logger.info.call_count, 1)
+        entry = logger.info.call_args[0][0]
+        self.assertEqual(entry.fields, {'code': 400, 'path': '/method/', 'request': None, 'body': u'{bad'})
+
+    def test_json_formatter(self):
+        handler = ListHandler()
+        handler.setFormatter(JSONFormatter())
+        logger = logging.getLogger('test_json_formatter')
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(handler)
+        logger.info(LogEntry({'code': 200, 'response': {1: ['a\nb']}}))
+        logger.warning('plain %s', 'message')
+
+        self.assertEqual(len(handler.lines), 2)
+        self.assertTrue(all('\n' not in line for line in handler.lines))
+        first, second = [json.loads(line) for line in handler.lines]
+        self.assertEqual(first['response'], {'1': ['a\nb']})
+        self.assertEqual(first['level'], 'INFO')
+        self.assertEqual(second['message'], 'plain message')
+
+
+class TestAsyncHandler(unittest.TestCase):
+    def make_record(self, msg):
+        return logging.LogRecord('test', logging.INFO, __file__, 1, msg, None, None)
+
+    def test_write_in_background(self):
+        target = ListHandler()
+        handler = AsyncHandler(target)
+        for i in range(10):
+            handler.handle(self.make_record(str(i)))
+        handler.close()
+        self.assertEqual(target.lines, [str(i) for i in range(10)])
+
+    def test_drop_when_full(self):
+        target = ListHandler()
+        with mock.patch('threading.Thread.start'), mock.patch('threading.Thread.is_alive', return_value=True):
+            handler = AsyncHandler(target, max_queue=3)
+            for i in range(5):
+                handler.handle(self.make_record(str(i)))
+        handler.flush()
+        self.assertEqual(target.lines, ['0', '1', '2'])
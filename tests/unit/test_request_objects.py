@@ -1,6 +1,9 @@
 import unittest
 
+import mock
+
 from request_object import (
+    RequestObject,
     MethodRequest,
     OnlineScoreRequest,
     ClientsInterestsRequest
@@ -27,7 +30,15 @@ class TestMethodRequest(unittest.TestCase):
     ])
     def test_validation_pass(self, data):
         mr = MethodRequest(data)
-        self.assertFalse(mr.get_validation_errors())
+        self.assertEqual(mr.get_validation_errors(), [])
+
+    def test_errors_order(self):
+        self.assertEqual(MethodRequest({}).get_validation_errors(), [
+            'field "method" is required',
+            'field "token" is required',
+            'field "login" is required',
+            'field "arguments" is required',
+        ])
 
 
 class TestOnlineScoreRequest(unittest.TestCase):
@@ -82,3 +93,59 @@ class TestClientsInterestsRequest(unittest.TestCase):
     def test_validation_pass(self, data):
         cir = ClientsInterestsRequest(data)
         self.assertFalse(cir.get_validation_errors())
+
+
+class TestCompiledSetFields(unittest.TestCase):
+    @cases([MethodRequest, OnlineScoreRequest, ClientsInterestsRequest])
+    @cases([
+        {},
+        {'account': 1, 'login': None, 'token': [], 'arguments': 'x', 'method': None},
+        {'account': 'abc', 'login': 'abc', 'token': 'token', 'arguments': {'arg1': 'val1'}, 'method': 'abc'},
+        {'phone': 71234567891, 'email': 'x@otus.ru', 'first_name': 'x', 'last_name': 'y',
+         'birthday': '10.10.2010', 'gender': 1},
+        {'phone': '7123', 'email': 'x', 'first_name': 1, 'last_name': None, 'birthday': '10.10.1910', 'gender': 5},
+        {'birthday': 'XXX', 'gender': None, 'phone': None},
+        {'client_ids': [1, 2], 'date': '20.12.2012'},
+        {'client_ids': [-1], 'date': ''},
+        {'client_ids': None, 'date': None},
+    ])
+    def test_same_as_descriptors(self, cls, data):
+        compiled = cls(data)
+        with mock.patch.object(cls, '_set_fields', RequestObject.__dict__['_set_fields_with_descriptors']):
+            reference = cls(data)
+
+        self.assertEqual(compiled.get_validation_errors(), reference.get_validation_errors())
+        self.assertEqual(dict(compiled.asdict()), dict(reference.asdict()))
+
+
+class TestRepresentation(unittest.TestCase):
+    DATA = {'phone': '79175002040', 'email': 'x@otus.ru', 'gender': 1}
+
+    def test_slots(self):
+        osr = OnlineScoreRequest(self.DATA)
+        self.assertFalse(hasattr(osr, '__dict__'))
+        # valid request keeps no errors list
+        self.assertIs(osr._errors, OnlineScoreRequest(self.DATA)._errors)
+        self.assertEqual(osr.get_validation_errors(), [])
+        with self.assertRaises(AttributeError):
+            osr.other_field = 1
+
+    def test_asdict_view(self):
+        osr = OnlineScoreRequest(self.DATA)
+        view = osr.asdict()
+        self.assertEqual(dict(view), dict(self.DATA, first_name=None, last_name=None, birthday=None))
+        self.assertEqual(sorted(view), sorted(OnlineScoreRequest._field_names))
+        self.assertIn('phone', view)
+        self.assertNotIn('other_field', view)
+        with self.assertRaises(KeyError):
+            view['other_field']
+
+        osr.first_name = 'x'
+        self.assertEqual(view['first_name'], 'x')
+        self.assertEqual((lambda **kwargs: kwargs)(**view), dict(view))
+
+    def test_initialized_fields(self):
+        osr = OnlineScoreRequest(self.DATA)
+        self.assertEqual(sorted(osr.initialized_fields), sorted(self.DATA))
+        # shared by requests with the same fields set
+        self.assertIs(osr.initialized_fields, OnlineScoreRequest(dict(self.DATA, phone=79175002041)).initialized_fields)
@@ -0,0 +1,71 @@
+import json
+import unittest
+
+import mock
+
+import serializers
+from utils import cases
+
+
+class TestSerializers(unittest.TestCase):
+    @cases([
+        None,
+        '',
+        'application/json',
+        'application/json; charset=utf-8',
+        'application/x-www-form-urlencoded',
+    ])
+    def test_request_codec_json(self, content_type):
+        codec = serializers.request_codec(content_type)
+        self.assertEqual(codec.content_type, serializers.JSON_CONTENT_TYPE)
+        self.assertEqual(codec.loads('{"a": [1, "b"]}'), {u'a': [1, u'b']})
+
+    @cases([
+        (None, serializers.JSON_CONTENT_TYPE),
+        ('*/*', serializers.JSON_CONTENT_TYPE),
+        ('text/html, application/json;q=0.9', serializers.JSON_CONTENT_TYPE),
+        ('text/html', serializers.JSON_CONTENT_TYPE),
+        ('application/msgpack;q=0, application/json;q=0.5', serializers.JSON_CONTENT_TYPE),
+    ])
+    def test_response_codec(self, accept, expected):
+        self.assertEqual(serializers.response_codec(accept).content_type, expected)
+
+    def test_msgpack_negotiation(self):
+        codecs = dict(serializers.CODECS, **{serializers.MSGPACK_CONTENT_TYPE: serializers.MsgpackCodec()})
+        with mock.patch.object(serializers, 'CODECS', codecs), \
+                mock.patch.object(serializers, '_accepted', {}):
+            msgpack_codec = serializers.request_codec('application/msgpack')
+            self.assertTrue(msgpack_codec.binary)
+            # response is encoded the same way as request by default
+            self.assertIs(serializers.response_codec('*/*', msgpack_codec), msgpack_codec)
+            self.assertIs(serializers.response_codec('application/json;q=0.5, application/msgpack'),
+                          msgpack_codec)
+
+    def test_json_envelope(self):
+        response = {'response': {1: [u'cars', u'a/b'], 2: []}, 'code': 200}
+        self.assertEqual(json.loads(serializers.JSON.dumps(response)), json.loads(json.dumps(response)))
+
+    @unittest.skipIf(serializers.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_envelope(self):
+        codec = serializers.MsgpackCodec()
+        response = {'response': {1: [u'cars'], 2: []}, 'code': 200}
+        self.assertEqual(codec.loads(codec.dumps(response)), response)
+
+    @cases([
+        [],
+        [7],
+        [3, 1, 3, 1000000, 2 ** 40, 17, 9] + range(100, 3000, 37),
+    ])
+    def test_iter_dumps(self, cids):
+        codecs = [serializers.JSONCodec(), serializers.JSON]
+        if serializers.msgpack is not None:
+            codecs.append(serializers.MsgpackCodec())
+        interests = {cid: [u'cars', u'a/b'] if cid % 2 else [] for cid in cids}
+        for codec in codecs:
+            # items in the order of the dict, split into chunks of different size
+            items = list(interests.iteritems())
+            chunks = [items[:1], [], items[1:4], items[4:]]
+            stream = serializers.StreamedMap(len(items), iter(chunks))
+            frame = {'response': serializers.PLACEHOLDER, 'code': 200}
+            self.assertEqual(''.join(serializers.iter_dumps(codec, frame, stream)),
+                             codec.dumps({'response': interests, 'code': 200}))
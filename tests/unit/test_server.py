@@ -0,0 +1,142 @@
+import json
+import hashlib
+import httplib
+import unittest
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+import mock
+
+import api
+import server
+from storage import current_deadline
+
+
+class TestServer(unittest.TestCase):
+    def test_reuse_port(self):
+        first = server.ReusePortHTTPServer(('localhost', 0), BaseHTTPRequestHandler)
+        try:
+            second = server.ReusePortHTTPServer(first.server_address, BaseHTTPRequestHandler)
+            second.server_close()
+        finally:
+            first.server_close()
+
+    def test_unknown_mode(self):
+        with self.assertRaisesRegexp(ValueError, "unknown server mode"):
+            server.serve(('localhost', 0), BaseHTTPRequestHandler, mode='xxx')
+
+
+class TestKeepAlive(unittest.TestCase):
+    def setUp(self):
+        self.server = server.ThreadingHTTPServer(('localhost', 0), api.MainHTTPHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.conn = httplib.HTTPConnection(*self.server.server_address)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, body):
+        self.conn.request('POST', '/method/', body, {'Content-Type': 'application/json'})
+        response = self.conn.getresponse()
+        raw = response.read()
+        self.assertEqual(int(response.getheader('Content-Length')), len(raw))
+        return response, json.loads(raw)
+
+    def test_persistent_connection(self):
+        bodies = ['{"login": "x"}', '[]' * 200, '{"a"', '{"login": "x"}']
+        with mock.patch.object(api.MainHTTPHandler, 'max_keep_alive_requests', 3):
+            results = [self.post(body) for body in bodies]
+
+        self.assertEqual([data['code'] for _, data in results],
+                         [api.INVALID_REQUEST, api.BAD_REQUEST, api.BAD_REQUEST, api.INVALID_REQUEST])
+        # the connection is closed after max requests and the next one is kept open again
+        self.assertEqual([response.will_close for response, _ in results], [False, False, True, False])
+
+    def test_stream_deadline(self):
+        body = json.dumps({'account': 'horns&hoofs', 'login': 'h&f', 'method': 'clients_interests',
+                           'arguments': {'client_ids': range(1, 20)},
+                           'token': hashlib.sha512('horns&hoofsh&f' + api.SALT).hexdigest()})
+        deadlines = []
+
+        def get_many(keys):
+            deadlines.append(current_deadline())
+            return [None] * len(keys)
+        store = mock.Mock()
+        store.get_many.side_effect = get_many
+        route = api.MainHTTPHandler.route
+
+        def record_route(*args):
+            deadlines.append(current_deadline())
+            return route(*args)
+        with mock.patch.object(api.MainHTTPHandler, 'store', store), \
+                mock.patch.object(api.MainHTTPHandler, 'route', side_effect=record_route), \
+                mock.patch.object(api.MainHTTPHandler, 'stream_min_clients', 5), \
+                mock.patch('scoring.INTERESTS_CHUNK_SIZE', 4):
+            self.conn.request('POST', '/method/', body, {api.DEADLINE_HEADER: '1000'})
+            response = self.conn.getresponse()
+            response.read()
+
+        self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+        # streamed fetches get the rest of the handler budget, not a new one
+        self.assertTrue(len(deadlines) > 2)
+        self.assertIsNotNone(deadlines[0])
+        self.assertEqual(set(deadlines), {deadlines[0]})
+
+    def test_no_stderr_lines(self):
+        with mock.patch('sys.stderr') as stderr, \
+                mock.patch('logging.info') as log_info:
+            self.post('{"login": "x"}')
+            self.conn.request('PUT', '/method/')
+            self.conn.getresponse().read()
+
+        self.assertFalse(stderr.write.called)
+        self.assertIn('501', log_info.call_args[0][2])
+
+    def test_streamed_interests(self):
+        cids = range(1, 50, 3) * 2
+        body = json.dumps({'account': 'horns&hoofs', 'login': 'h&f', 'method': 'clients_interests',
+                           'arguments': {'client_ids': cids},
+                           'token': hashlib.sha512('horns&hoofsh&f' + api.SALT).hexdigest()})
+        store = mock.Mock()
+        store.get_many.side_effect = lambda keys: ['["cars", "tv"]' if int(key[2:]) % 2 else None for key in keys]
+
+        raw = {}
+        for min_clients in (0, 5):
+            with mock.patch.object(api.MainHTTPHandler, 'store', store), \
+                    mock.patch.object(api.MainHTTPHandler, 'stream_min_clients', min_clients), \
+                    mock.patch('scoring.INTERESTS_CHUNK_SIZE', 4):
+                self.conn.request('POST', '/method/', body, {'Content-Type': 'application/json'})
+                response = self.conn.getresponse()
+                raw[min_clients] = response.read()
+            self.assertEqual(response.status, api.OK)
+            self.assertFalse(response.will_close)
+
+        self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+        self.assertEqual(raw[5], raw[0])
+        self.assertEqual(len(json.loads(raw[5])['response']), len(set(cids)))
+
+    def test_big_numbers(self):
+        # json decoders may return long for them
+        token = hashlib.sha512('horns&hoofsh&f' + api.SALT).hexdigest()
+        store = mock.Mock()
+        store.cache_get.return_value = None
+        store.get_many.side_effect = lambda keys: ['["cars"]'] * len(keys)
+        with mock.patch.object(api.MainHTTPHandler, 'store', store):
+            _, data = self.post(json.dumps({
+                'account': 'horns&hoofs', 'login': 'h&f', 'method': 'online_score', 'token': token,
+                'arguments': {'phone': 79175002040, 'email': 'stupnikov@otus.ru'}}))
+            self.assertEqual(data, {'code': api.OK, 'response': {'score': 3.0}})
+            _, data = self.post(json.dumps({
+                'account': 'horns&hoofs', 'login': 'h&f', 'method': 'clients_interests', 'token': token,
+                'arguments': {'client_ids': [2 ** 40]}}))
+            self.assertEqual(data, {'code': api.OK, 'response': {str(2 ** 40): ['cars']}})
+
+    def test_wrong_content_length(self):
+        self.conn.request('POST', '/method/', '{}', {'Content-Length': '-1'})
+        response = self.conn.getresponse()
+        self.assertEqual(response.status, api.BAD_REQUEST)
+        self.assertTrue(response.will_close)
@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import snapshot
+from utils import cases
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'interests.snap')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    @cases([0, 1, 3, 1000])
+    def test_read_write(self, n):
+        items = [('i:%s' % i, '["cars", %s]' % i if i % 3 else '') for i in range(n)]
+        self.assertEqual(snapshot.write_snapshot(self.path, iter(items)), n)
+
+        backend = snapshot.SnapshotBackend(self.path)
+        self.assertEqual(backend.nkeys, n)
+        self.assertEqual(backend.mget([key for key, _ in items]), [value for _, value in items])
+        self.assertEqual(backend.mget(['i:%s' % n, 'i:', 'uid:1']), [None, None, None])
+        self.assertEqual(backend.get_with_ttl('i:%s' % n), (None, -2))
+        backend.close()
+
+    def test_hash_collisions(self):
+        items = [('i:%s' % i, str(i)) for i in range(50)]
+        # all keys land in the same slot and have the same hash
+        with mock.patch('snapshot.key_hash', return_value=7):
+            snapshot.write_snapshot(self.path, items)
+            backend = snapshot.SnapshotBackend(self.path)
+            self.assertEqual(backend.mget([key for key, _ in items] + ['i:50']), [v for _, v in items] + [None])
+
+    def test_replace(self):
+        snapshot.write_snapshot(self.path, [('i:1', 'old')])
+        backend = snapshot.SnapshotBackend(self.path)
+        snapshot.write_snapshot(self.path, [('i:1', 'new')])
+        self.assertEqual(backend.get('i:1'), 'old')
+        self.assertEqual(snapshot.SnapshotBackend(self.path).get('i:1'), 'new')
+
+    def test_not_snapshot(self):
+        with open(self.path, 'w') as f:
+            f.write('x' * 64)
+        with self.assertRaisesRegexp(ValueError, 'not a snapshot'):
+            snapshot.SnapshotBackend(self.path)
@@ -0,0 +1,65 @@
+import json
+import shutil
+import tempfile
+import unittest
+import os
+
+import mock
+
+import scoring
+import warmup
+from utils import cases
+
+
+class TestWarmup(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_lines(self, lines):
+        path = os.path.join(self.dir, 'users.jsonl')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+
+    @cases([
+        {'phone': '79175002040', 'email': 'stupnikov@otus.ru'},
+        {'first_name': 'a', 'last_name': 'b', 'gender': 1, 'birthday': '01.01.2000'},
+    ])
+    def test_score_line(self, arguments):
+        store = mock.Mock()
+        store.cache_get.return_value = None
+        with mock.patch.object(scoring, '_score_flights', scoring.SingleFlight()):
+            score = scoring.get_score(store, **warmup.OnlineScoreRequest(arguments).asdict())
+
+        # the same key and value as the api caches
+        store.cache_set.assert_called_once_with(mock.ANY, score, scoring.SCORE_CACHE_TTL_SEC)
+        self.assertEqual(warmup.score_line(json.dumps(arguments)), (store.cache_set.call_args[0][0], score))
+
+    @cases(['{', '[]', '{"phone": "79175002040"}'])
+    def test_invalid_line(self, line):
+        self.assertIsNone(warmup.score_line(line))
+
+    def test_score_batch(self):
+        lines = ['{"phone": "79175002040", "email": "a@b.c"}', '{}']
+        store = mock.Mock()
+        store.cache_set_many.return_value = True
+        with mock.patch.object(warmup, '_store', store):
+            self.assertEqual(warmup.score_batch(lines)[:3], (2, 1, 1))
+        (items,), _ = store.cache_set_many.call_args
+        self.assertEqual(items, [warmup.score_line(lines[0]) + (scoring.SCORE_CACHE_TTL_SEC,)])
+
+    def test_run(self):
+        lines = ['{"phone": "7917500%04d", "email": "a@b.c"}' % i for i in range(25)] + ['{}']
+        path = self.write_lines(lines)
+        output = open(os.path.join(self.dir, 'scores.jsonl'), 'w+')
+        with mock.patch.object(warmup, 'MAX_PENDING_PER_PROCESS', 1):
+            progress = warmup.run([path, path], processes=2, batch_size=4, output=output)
+
+        self.assertEqual((progress.lines, progress.invalid, progress.cached), (52, 2, 0))
+        output.seek(0)
+        scores = [json.loads(line) for line in output]
+        self.assertEqual(len(scores), 50)
+        self.assertEqual(len(set(score['key'] for score in scores)), 25)
@@ -29,7 +29,8 @@ def cases(cases):
 def patch_today(return_value):
     orig_date = datetime.date
     # taken from https://stackoverflow.com/a/25652721
-    with mock.patch('datetime.date') as mock_date:
+    with mock.patch('datetime.date') as mock_date, \
+            mock.patch('field.today', return_value=return_value):
         mock_date.today.return_value = return_value
         mock_date.side_effect = lambda *args, **kw: orig_date(*args, **kw)
         yield
@@ -37,8 +38,8 @@ def patch_today(return_value):
 
 @contextlib.contextmanager
 def patch_redis(mock_redis_instance):
-    with mock.patch('redis.Redis', return_value=mock_redis_instance):
-        yield
+    with mock.patch('redis.Redis', return_value=mock_redis_instance) as mock_redis_cls:
+        yield mock_redis_cls
 
 
 def start_redis(redis_port):